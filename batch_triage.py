@@ -0,0 +1,265 @@
+"""
+Triages the unread emails of several Gmail accounts without interaction, one account per worker process.
+
+Each account has its own token file and its own namespace in the shared message cache, so accounts
+never see each other's emails, while the parsed messages and triage decisions of all the accounts
+live in one SQLite file. Gmail calls are paced per account (250 units per second, the per-user
+quota) and by a token bucket shared by all the workers for the per-project quota. Emails are
+pre-classified locally, then looked up in the decision cache, and the others are classified with
+map_reduce_triage. Nothing is marked as read: each account gets a JSON report in the reports directory.
+
+The accounts file is a JSON list of {"name": ..., "token_path": ..., "credentials_path": ...}
+objects. The tokens must exist already: log in once with main.py (or get_gmail_service) per account.
+
+Run from the repository root:
+    python batch_triage.py accounts.json [--workers 4] [--reports reports/] [--max-emails 500]
+"""
+import argparse
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+from utils.cache import MessageCache
+from utils.decisions import DecisionCache
+from utils.email_utils import get_gmail_service, get_user_email
+from utils.functions import fetch_all_emails, get_llm_config
+from utils.preclassifier import DEFAULT_RULES, preclassify_emails
+from utils.scheduler import (
+    DEFAULT_UNITS_PER_SECOND,
+    PROJECT_UNITS_PER_SECOND,
+    RequestScheduler,
+    SharedTokenBucket,
+    get_scheduler,
+    set_scheduler,
+)
+from utils.triage import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_MAX_WORKERS,
+    MARK_AS_READ,
+    Classification,
+    Completion,
+    llm_completion,
+    map_reduce_triage,
+    suggest_bulk_senders,
+    triage_prompt_version,
+)
+
+DEFAULT_CACHE_PATH = "email_cache.sqlite3"
+DEFAULT_REPORTS_DIR = "reports"
+DEFAULT_MAX_EMAILS = 500
+
+
+class Account(NamedTuple):
+    name: str
+    token_path: str
+    credentials_path: str = "credentials.json"
+
+
+class BatchOptions(NamedTuple):
+    cache_path: str = DEFAULT_CACHE_PATH
+    reports_dir: str = DEFAULT_REPORTS_DIR
+    max_emails: int = DEFAULT_MAX_EMAILS
+    units_per_second: float = DEFAULT_UNITS_PER_SECOND
+    chunk_size: int = DEFAULT_CHUNK_SIZE
+    llm_workers: int = DEFAULT_MAX_WORKERS
+    preclassifier_rules: Optional[Sequence[str]] = None
+
+
+# Per-project quota bucket of the worker process, set by init_worker
+_shared_bucket: Optional[SharedTokenBucket] = None
+
+
+def load_accounts(path: str) -> List[Account]:
+    with open(path, encoding="utf-8") as file:
+        entries = json.load(file)
+    accounts = [Account(**entry) for entry in entries]
+    names = [account.name for account in accounts]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Account names must be unique in {path}")
+    return accounts
+
+
+def init_worker(shared_bucket: Optional[SharedTokenBucket]) -> None:
+    global _shared_bucket
+    _shared_bucket = shared_bucket
+
+
+def triage_mailbox(
+    gmail_service,
+    message_cache: MessageCache,
+    decision_cache: DecisionCache,
+    decision_version: str,
+    complete: Completion,
+    options: BatchOptions,
+) -> Dict:
+    """
+    Fetches and classifies the unread emails of one mailbox, without modifying it.
+
+    Args:
+        gmail_service (Resource): Gmail service of the account.
+        message_cache (MessageCache): Cache of the account, in its own namespace.
+        decision_cache (DecisionCache): Triage decisions, shared by all the accounts.
+        decision_version (str): Version of the triage decisions, see triage_prompt_version.
+        complete (Completion): Sends chat messages to the LLM, see llm_completion.
+        options (BatchOptions): Limits of the run.
+
+    Returns:
+        Dict: Report of the mailbox, with the classification of each email and where it came from
+        ("preclassifier", "cache" or "llm").
+    """
+    timings = {}
+    start = time.perf_counter()
+    unread_emails = fetch_all_emails(
+        gmail_service,
+        options.max_emails,
+        cache=message_cache,
+        incremental_sync=True,
+        fetch_format="metadata",
+        verbose=False,
+    )
+    timings["fetch_seconds"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    preclassification = preclassify_emails(unread_emails, DEFAULT_RULES, enabled_rules=options.preclassifier_rules)
+    classifications = {
+        email["message_id"]: (Classification(MARK_AS_READ, "Pre-classified: " + ", ".join(
+            preclassification.reasons[email["message_id"]])), "preclassifier")
+        for email in preclassification.candidates
+    }
+    decisions = decision_cache.get_decisions(preclassification.remainder, decision_version)
+    for email_id, decision in decisions.items():
+        classifications[email_id] = (Classification(decision.classification, decision.summary), "cache")
+    pending_emails = [email for email in preclassification.remainder if email["message_id"] not in decisions]
+    timings["lookup_seconds"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    triage_result = map_reduce_triage(pending_emails, complete, options.chunk_size, options.llm_workers)
+    for email in pending_emails:
+        classification = triage_result.classifications.get(email["message_id"])
+        if classification:
+            decision_cache.put_decision(email, decision_version, *classification)
+            classifications[email["message_id"]] = (classification, "llm")
+    timings["triage_seconds"] = time.perf_counter() - start
+
+    bulk_suggestions = suggest_bulk_senders(unread_emails, {
+        email_id: classification for email_id, (classification, _) in classifications.items()
+    })
+    emails = []
+    for email in unread_emails:
+        classification, source = classifications.get(email["message_id"], (None, None))
+        emails.append({
+            "message_id": email["message_id"],
+            "thread_id": email["thread_id"],
+            "from": email["from"],
+            "subject": email["subject"],
+            "classification": classification.classification if classification else None,
+            "reason": classification.reason if classification else None,
+            "source": source,
+        })
+    sources = [source for _, source in classifications.values()]
+    return {
+        "unread": len(unread_emails),
+        "counts": {
+            "preclassifier": sources.count("preclassifier"),
+            "cache": sources.count("cache"),
+            "llm": sources.count("llm"),
+            "unclassified": len(triage_result.unclassified_ids),
+        },
+        "emails": emails,
+        "bulk_suggestions": [suggestion._asdict() for suggestion in bulk_suggestions],
+        "timings": timings,
+    }
+
+
+def report_path(reports_dir: str, account_name: str) -> str:
+    return os.path.join(reports_dir, re.sub(r"[^\w.@-]", "_", account_name) + ".json")
+
+
+def triage_account(account: Account, decision_version: str, options: BatchOptions) -> Dict:
+    """Triages one account in a worker process and writes its report, returns a summary of it."""
+    start = time.perf_counter()
+    # Each account gets its own per-user quota, on top of the per-project bucket
+    set_scheduler(RequestScheduler(units_per_second=options.units_per_second, shared_bucket=_shared_bucket))
+    report = {"account": account.name}
+    message_cache = decision_cache = None
+    try:
+        gmail_service = get_gmail_service(account.token_path, account.credentials_path, interactive=False)
+        report["user_email"] = get_user_email(gmail_service)
+        message_cache = MessageCache(options.cache_path, namespace=account.name)
+        decision_cache = DecisionCache(options.cache_path)
+        report.update(triage_mailbox(
+            gmail_service, message_cache, decision_cache, decision_version, llm_completion(get_llm_config()), options
+        ))
+    except Exception as e:
+        print(f"Failed to triage {account.name}: {e}")
+        report["error"] = str(e)
+    finally:
+        for cache in (message_cache, decision_cache):
+            if cache is not None:
+                cache.close()
+    report["quota"] = get_scheduler().stats()
+    report["seconds"] = time.perf_counter() - start
+
+    path = report_path(options.reports_dir, account.name)
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    summary = {key: report[key] for key in ("account", "unread", "counts", "error", "seconds") if key in report}
+    summary["report"] = path
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("accounts", help="JSON file listing the accounts")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Accounts processed in parallel")
+    parser.add_argument("--reports", default=DEFAULT_REPORTS_DIR, help="Directory of the per-account reports")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH, help="SQLite cache shared by the accounts")
+    parser.add_argument("--max-emails", type=int, default=DEFAULT_MAX_EMAILS, help="Unread emails triaged per account")
+    parser.add_argument("--units-per-second", type=float, default=DEFAULT_UNITS_PER_SECOND,
+                        help="Gmail quota of each account")
+    parser.add_argument("--project-units-per-second", type=float, default=PROJECT_UNITS_PER_SECOND,
+                        help="Gmail quota shared by all the accounts")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Emails per LLM call")
+    parser.add_argument("--llm-workers", type=int, default=DEFAULT_MAX_WORKERS,
+                        help="Concurrent LLM calls per account")
+    parser.add_argument("--rules", nargs="*", help="Pre-classifier rules to apply, all of them by default")
+    args = parser.parse_args()
+
+    accounts = load_accounts(args.accounts)
+    options = BatchOptions(args.cache, args.reports, args.max_emails, args.units_per_second, args.chunk_size,
+                           args.llm_workers, args.rules)
+    os.makedirs(options.reports_dir, exist_ok=True)
+
+    # Cleaned once here rather than by every worker
+    decision_version = triage_prompt_version(get_llm_config())
+    decision_cache = DecisionCache(options.cache_path)
+    decision_cache.invalidate(decision_version)
+    decision_cache.evict()
+    decision_cache.close()
+
+    shared_bucket = SharedTokenBucket(args.project_units_per_second)
+    start = time.perf_counter()
+    summaries = []
+    with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(accounts))), initializer=init_worker,
+                             initargs=(shared_bucket,)) as executor:
+        futures = [executor.submit(triage_account, account, decision_version, options) for account in accounts]
+        for future in as_completed(futures):
+            summary = future.result()
+            summaries.append(summary)
+            if "error" in summary:
+                print(f"{summary['account']}: failed ({summary['error']})")
+            else:
+                print(f"{summary['account']}: {summary['unread']} unread, {summary['counts']}, "
+                      f"{summary['seconds']:.1f}s, report in {summary['report']}")
+
+    failed = sum("error" in summary for summary in summaries)
+    print(f"Triaged {len(summaries) - failed} of {len(accounts)} accounts in {time.perf_counter() - start:.1f}s")
+    with open(os.path.join(options.reports_dir, "summary.json"), "w", encoding="utf-8") as file:
+        json.dump(sorted(summaries, key=lambda summary: summary["account"]), file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+"""
+Fake Gmail API service serving a generated corpus of Gmail-shaped messages, for offline benchmarks.
+
+FakeGmailService mimics the parts of googleapiclient's Resource used by utils/: messages().list/get/
+modify/batchModify, threads().get, history().list, getProfile and new_batch_http_request. Every
+request (and every batch request, as one round trip) sleeps for `latency` seconds.
+"""
+import base64
+import glob
+import os
+import random
+import time
+from typing import Callable, Dict, List, Optional
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "newsletters")
+
+# Share of each kind of message in the generated corpus
+MESSAGE_KINDS = {
+    "plain": 0.35,
+    "alternative": 0.25,
+    "newsletter": 0.2,
+    "attachment": 0.1,
+    "thread": 0.1,
+}
+
+# Number of messages of the threads generated for the "thread" kind
+THREAD_LENGTH = 20
+
+SENDERS = [
+    '"GitHub" <notifications@github.com>',
+    "Alice Martin <alice.martin@example.com>",
+    "bob@example.org",
+    "Deals Weekly <deals@news.shop.example>",
+    "Engineering Digest <digest@eng.example.net>",
+    '"Product Team" <noreply@product.example.io>',
+    "Carol <carol@example.com>",
+    "Dave Smith <DAVE@Example.com>",
+]
+
+WORDS = (
+    "meeting project update invoice release review deadline schedule report budget customer "
+    "feedback design launch roadmap agenda follow-up proposal contract travel"
+).split()
+
+
+def encode(text: str) -> str:
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")
+
+
+def load_newsletters() -> List[str]:
+    """Returns the base64url-encoded newsletter fixtures, shared by all the generated newsletters."""
+    newsletters = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, "*.html"))):
+        with open(path, encoding="utf-8") as file:
+            newsletters.append(encode(file.read()))
+    return newsletters
+
+
+def text_part(mime_type: str, data: str) -> Dict:
+    return {
+        "mimeType": mime_type,
+        "headers": [{"name": "Content-Type", "value": f"{mime_type}; charset=utf-8"}],
+        "body": {"size": len(data) * 3 // 4, "data": data},
+    }
+
+
+def generate_corpus(size: int, seed: int = 0) -> List[Dict]:
+    """
+    Generates `size` Gmail message resources (format="full"), newest first.
+
+    The corpus mixes plain text messages, multipart/alternative messages, HTML newsletters,
+    messages with attachments (multipart/mixed trees) and long threads.
+    """
+    rng = random.Random(seed)
+    newsletters = load_newsletters()
+    kinds = list(MESSAGE_KINDS)
+    weights = list(MESSAGE_KINDS.values())
+    base_date = 1700000000000
+    messages = []
+    thread_id = None
+    thread_left = 0
+
+    for index in range(size):
+        if thread_left:
+            kind = "thread"
+            thread_left -= 1
+        else:
+            kind = rng.choices(kinds, weights)[0]
+            thread_id = f"t{index:07d}"
+            if kind == "thread":
+                thread_left = THREAD_LENGTH - 1
+        message_id = f"m{index:07d}"
+        sentence = " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 120)))
+        sender = rng.choice(SENDERS)
+        headers = [
+            {"name": "Subject", "value": f"{rng.choice(WORDS).title()} {rng.choice(WORDS)} #{index}"},
+            {"name": "From", "value": sender},
+            {"name": "To", "value": "me@example.com"},
+            {"name": "Message-ID", "value": f"<{message_id}@mail.example.com>"},
+        ]
+
+        if kind == "plain" or kind == "thread":
+            payload = {"partId": "", **text_part("text/plain", encode(sentence))}
+        elif kind == "alternative":
+            payload = {
+                "mimeType": "multipart/alternative",
+                "parts": [
+                    text_part("text/plain", encode(sentence)),
+                    text_part("text/html", encode(f"<html><body><p>{sentence}</p></body></html>")),
+                ],
+            }
+        elif kind == "newsletter":
+            headers.append({"name": "List-Id", "value": "<weekly.news.shop.example>"})
+            headers.append({"name": "List-Unsubscribe", "value": "<mailto:unsubscribe@news.shop.example>"})
+            payload = {
+                "mimeType": "multipart/alternative",
+                "parts": [text_part("text/html", rng.choice(newsletters))],
+            }
+        else:
+            payload = {
+                "mimeType": "multipart/mixed",
+                "parts": [
+                    {
+                        "mimeType": "multipart/alternative",
+                        "parts": [
+                            text_part("text/plain", encode(sentence)),
+                            text_part("text/html", encode(f"<div>{sentence}</div>")),
+                        ],
+                    },
+                    {
+                        "mimeType": "application/pdf",
+                        "filename": f"report-{index}.pdf",
+                        "headers": [{"name": "Content-Disposition", "value": "attachment"}],
+                        "body": {"attachmentId": f"att-{message_id}", "size": rng.randint(10_000, 2_000_000)},
+                    },
+                ],
+            }
+        payload["headers"] = headers + payload.get("headers", [])
+
+        messages.append({
+            "id": message_id,
+            "threadId": thread_id,
+            "labelIds": ["UNREAD", "INBOX"],
+            "snippet": sentence[:100],
+            "historyId": str(100000 + index),
+            "internalDate": str(base_date - index * 60000),
+            "sizeEstimate": 2000,
+            "payload": payload,
+        })
+    return messages
+
+
+class FakeRequest:
+    """Stands in for googleapiclient.http.HttpRequest."""
+
+    def __init__(self, service: "FakeGmailService", method_id: str, response: Callable[[], Dict]):
+        self.service = service
+        self.methodId = method_id
+        self._response = response
+
+    def execute(self, http=None, num_retries: int = 0) -> Dict:
+        self.service.round_trip(self.methodId)
+        return self._response()
+
+
+class FakeBatchRequest:
+    """Stands in for googleapiclient.http.BatchHttpRequest: one round trip for all its requests."""
+
+    def __init__(self, service: "FakeGmailService", callback: Optional[Callable] = None):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request: FakeRequest, callback: Optional[Callable] = None, request_id: Optional[str] = None):
+        self.requests.append((request, callback or self.callback, request_id or str(len(self.requests))))
+
+    def execute(self, http=None) -> None:
+        self.service.round_trip("batch")
+        for request, callback, request_id in self.requests:
+            response = request._response()
+            if callback is not None:
+                callback(request_id, response, None)
+
+
+class FakeGmailService:
+    """
+    In-memory Gmail API service over a list of message resources.
+
+    Args:
+        messages (List[Dict]): Message resources in format="full", e.g. from generate_corpus.
+        latency (float): Seconds slept by every round trip.
+        page_size (int): Number of messages per messages().list page.
+    """
+
+    def __init__(self, messages: List[Dict], latency: float = 0.0, page_size: int = 100):
+        self.corpus = {message["id"]: message for message in messages}
+        self.order = [message["id"] for message in messages]
+        self.latency = latency
+        self.page_size = page_size
+        self.calls: Dict[str, int] = {}
+        self._threads: Dict[str, List[str]] = {}
+        for message in messages:
+            self._threads.setdefault(message["threadId"], []).append(message["id"])
+
+    def round_trip(self, method_id: str) -> None:
+        self.calls[method_id] = self.calls.get(method_id, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def new_batch_http_request(self, callback: Optional[Callable] = None) -> FakeBatchRequest:
+        return FakeBatchRequest(self, callback)
+
+    def users(self) -> "FakeGmailService":
+        return self
+
+    def messages(self) -> "_Messages":
+        return _Messages(self)
+
+    def threads(self) -> "_Threads":
+        return _Threads(self)
+
+    def history(self) -> "_History":
+        return _History(self)
+
+    def getProfile(self, userId: str) -> FakeRequest:
+        return FakeRequest(self, "gmail.users.getProfile", lambda: {
+            "emailAddress": "me@example.com",
+            "messagesTotal": len(self.corpus),
+            "historyId": str(100000 + len(self.corpus)),
+        })
+
+    def format_message(self, message: Dict, format: str = "full", metadata_headers: Optional[List[str]] = None):
+        if format == "full":
+            return message
+        result = {key: value for key, value in message.items() if key != "payload"}
+        if format == "metadata":
+            wanted = {name.lower() for name in metadata_headers or []}
+            headers = [
+                header for header in message["payload"]["headers"]
+                if not wanted or header["name"].lower() in wanted
+            ]
+            result["payload"] = {"mimeType": message["payload"]["mimeType"], "headers": headers}
+        return result
+
+
+class _Messages:
+    def __init__(self, service: FakeGmailService):
+        self.service = service
+
+    def list(self, userId: str, labelIds=None, pageToken=None, maxResults=None, q=None, **kwargs) -> FakeRequest:
+        service = self.service
+        start = int(pageToken or 0)
+        end = start + (maxResults or service.page_size)
+
+        def response():
+            message_ids = [
+                message_id for message_id in service.order[start:end]
+                if not labelIds or set(labelIds) <= set(service.corpus[message_id]["labelIds"])
+            ]
+            result = {
+                "messages": [
+                    {"id": message_id, "threadId": service.corpus[message_id]["threadId"]}
+                    for message_id in message_ids
+                ],
+                "resultSizeEstimate": len(message_ids),
+            }
+            if end < len(service.order):
+                result["nextPageToken"] = str(end)
+            return result
+
+        return FakeRequest(service, "gmail.users.messages.list", response)
+
+    def get(self, userId: str, id: str, format: str = "full", metadataHeaders=None, **kwargs) -> FakeRequest:
+        service = self.service
+        return FakeRequest(
+            service,
+            "gmail.users.messages.get",
+            lambda: service.format_message(service.corpus[id], format, metadataHeaders),
+        )
+
+    def modify(self, userId: str, id: str, body: Dict) -> FakeRequest:
+        return self.batchModify(userId, {"ids": [id], **body})
+
+    def batchModify(self, userId: str, body: Dict) -> FakeRequest:
+        service = self.service
+
+        def response():
+            for message_id in body["ids"]:
+                labels = service.corpus[message_id]["labelIds"]
+                labels[:] = [label for label in labels if label not in body.get("removeLabelIds", [])]
+                labels.extend(label for label in body.get("addLabelIds", []) if label not in labels)
+            return {}
+
+        return FakeRequest(service, "gmail.users.messages.batchModify", response)
+
+
+class _Threads:
+    def __init__(self, service: FakeGmailService):
+        self.service = service
+
+    def get(self, userId: str, id: str, format: str = "full", metadataHeaders=None, fields=None) -> FakeRequest:
+        service = self.service
+
+        def response():
+            messages = [service.corpus[message_id] for message_id in reversed(service._threads[id])]
+            return {
+                "id": id,
+                "historyId": max(message["historyId"] for message in messages),
+                "messages": [service.format_message(message, format, metadataHeaders) for message in messages],
+            }
+
+        return FakeRequest(service, "gmail.users.threads.get", response)
+
+
+class _History:
+    def __init__(self, service: FakeGmailService):
+        self.service = service
+
+    def list(self, userId: str, startHistoryId: str, historyTypes=None, pageToken=None) -> FakeRequest:
+        # The corpus never changes, so there is no history to report
+        return FakeRequest(self.service, "gmail.users.history.list", lambda: {
+            "history": [],
+            "historyId": str(100000 + len(self.service.corpus)),
+        })
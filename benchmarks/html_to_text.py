@@ -0,0 +1,58 @@
+"""
+Compares the HTML-to-text engines of utils/html_text.py on the newsletter fixtures.
+
+Run from the repository root:
+    python -m benchmarks.html_to_text [--iterations 50]
+"""
+import argparse
+import glob
+import os
+import time
+
+from utils.html_text import HTML_TEXT_ENGINES, html_to_text, lxml_available
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "newsletters")
+
+
+def load_fixtures():
+    fixtures = {}
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, "*.html"))):
+        with open(path, encoding="utf-8") as file:
+            fixtures[os.path.basename(path)] = file.read()
+    return fixtures
+
+
+def benchmark_engine(engine, fixtures, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for html in fixtures.values():
+            html_to_text(html, engine=engine, max_chars=None)
+    elapsed = time.perf_counter() - start
+    documents = iterations * len(fixtures)
+    total_bytes = iterations * sum(len(html.encode("utf-8")) for html in fixtures.values())
+    return {
+        "engine": engine,
+        "ms_per_document": elapsed * 1000 / documents,
+        "mb_per_second": total_bytes / elapsed / 1e6,
+        "text_chars": sum(len(html_to_text(html, engine=engine, max_chars=None)) for html in fixtures.values()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=50, help="Number of passes over the fixtures")
+    args = parser.parse_args()
+
+    fixtures = load_fixtures()
+    engines = [engine for engine in HTML_TEXT_ENGINES if engine != "lxml" or lxml_available()]
+    print(f"{len(fixtures)} fixtures, {sum(len(html) for html in fixtures.values()) / 1024:.0f} KiB of HTML")
+    print(f"{'engine':<10} {'ms/doc':>8} {'MB/s':>8} {'text chars':>11}")
+    for engine in engines:
+        result = benchmark_engine(engine, fixtures, args.iterations)
+        print(f"{result['engine']:<10} {result['ms_per_document']:>8.2f} {result['mb_per_second']:>8.1f} {result['text_chars']:>11}")
+    if "lxml" not in engines:
+        print("lxml is not installed, skipped its engine")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Benchmarks the email ingestion stages offline, against a fake Gmail service (benchmarks/fake_gmail.py).
+
+For each inbox size, the stages below run on a generated corpus and report messages per second,
+p50/p99 latency and the peak memory allocated by the stage (measured with tracemalloc in a
+separate pass, so it does not slow down the timed pass):
+
+- fetch_all_emails: list and fetch the whole inbox with batch requests, with the simulated latency
+  (p50/p99 over --repeat runs).
+- iter_unread_emails_first_batch: the same up to the first FIRST_BATCH_SIZE emails streamed by
+  iter_unread_emails, i.e. the wait before triage can start, which should not grow with the inbox.
+- parse_email_data: fetch and parse each message, without latency (p50/p99 per message).
+- extract_email_body_and_attachments: walk and decode the MIME tree of each message (p50/p99 per message).
+- group_emails_by_sender and get_context: on the parsed inbox (p50/p99 over --repeat runs).
+
+Run from the repository root:
+    python -m benchmarks.ingestion [--sizes 100 1000 10000 100000] [--latency 0.005]
+        [--output benchmarks/results/ingestion.json] [--baseline previous.json]
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import platform
+import statistics
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Callable, Dict, List
+
+from benchmarks.fake_gmail import FakeGmailService, generate_corpus
+from utils.email_utils import extract_email_body_and_attachments, group_emails_by_sender, parse_email_data
+from utils.functions import fetch_all_emails, get_context, iter_unread_emails
+from utils.scheduler import RequestScheduler, set_scheduler
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(__file__), "results", "ingestion.json")
+
+# Emails streamed before the triage starts, as first_batch_size in main.py
+FIRST_BATCH_SIZE = 50
+
+# Quota high enough for the scheduler to never throttle the fake service
+UNTHROTTLED_UNITS_PER_SECOND = 1e9
+
+
+def percentile(samples: List[float], share: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def summarize(samples: List[float], messages: int, passes: int, peak_bytes: int) -> Dict[str, float]:
+    total = sum(samples)
+    return {
+        "messages": messages,
+        "seconds": total,
+        "messages_per_second": messages * passes / total if total else None,
+        "p50_ms": percentile(samples, 0.5) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "mean_ms": statistics.fmean(samples) * 1000,
+        "peak_memory_mb": peak_bytes / 1e6,
+    }
+
+
+def time_calls(function: Callable, items: List) -> List[float]:
+    samples = []
+    for item in items:
+        start = time.perf_counter()
+        function(item)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def peak_memory(function: Callable, items: List) -> int:
+    tracemalloc.start()
+    try:
+        for item in items:
+            function(item)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_stage(
+    function: Callable, items: List, messages: int, measure_memory: bool, per_message: bool = False
+) -> Dict[str, float]:
+    """Times `function` on each item: each message if `per_message`, else each run over the whole inbox."""
+    samples = time_calls(function, items)
+    passes = 1 if per_message else len(items)
+    return summarize(samples, messages, passes, peak_memory(function, items) if measure_memory else 0)
+
+
+def benchmark_size(size: int, latency: float, repeat: int, fetch_format: str, measure_memory: bool) -> Dict:
+    corpus = generate_corpus(size)
+    runs = range(repeat)
+    stages = {}
+
+    # fetch_all_emails prints every email, keep the output out of the report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        stages["fetch_all_emails"] = run_stage(
+            lambda _: fetch_all_emails(FakeGmailService(corpus, latency), size, fetch_format=fetch_format),
+            runs,
+            size,
+            measure_memory,
+        )
+    first_batch = min(size, FIRST_BATCH_SIZE)
+    stages["iter_unread_emails_first_batch"] = run_stage(
+        lambda _: list(itertools.islice(
+            iter_unread_emails(FakeGmailService(corpus, latency), size, fetch_format=fetch_format), first_batch)),
+        runs,
+        first_batch,
+        measure_memory,
+    )
+
+    service = FakeGmailService(corpus)
+    message_infos = [{"id": message["id"]} for message in corpus]
+    emails = []
+    stages["parse_email_data"] = run_stage(
+        lambda message_info: emails.append(parse_email_data(service, message_info, fetch_format)),
+        message_infos,
+        size,
+        False,
+        per_message=True,
+    )
+    if measure_memory:
+        # Peak memory of the parsed inbox, built once more under tracemalloc
+        parsed = []
+        stages["parse_email_data"]["peak_memory_mb"] = peak_memory(
+            lambda message_info: parsed.append(parse_email_data(service, message_info, fetch_format)),
+            message_infos,
+        ) / 1e6
+        del parsed
+
+    stages["extract_email_body_and_attachments"] = run_stage(
+        lambda message: extract_email_body_and_attachments([message["payload"]], strip_html=True),
+        corpus,
+        size,
+        measure_memory,
+        per_message=True,
+    )
+    stages["group_emails_by_sender"] = run_stage(lambda _: group_emails_by_sender(emails), runs, size, measure_memory)
+    stages["get_context"] = run_stage(lambda _: get_context(emails), runs, size, measure_memory)
+    return {"size": size, "stages": stages}
+
+
+def compare(results: List[Dict], baseline: Dict) -> None:
+    baseline_stages = {
+        (result["size"], stage): stats
+        for result in baseline.get("results", [])
+        for stage, stats in result["stages"].items()
+    }
+    print("\nChange of p50 against the baseline:")
+    for result in results:
+        for stage, stats in result["stages"].items():
+            previous = baseline_stages.get((result["size"], stage))
+            if previous and previous["p50_ms"]:
+                change = (stats["p50_ms"] / previous["p50_ms"] - 1) * 100
+                print(f"{result['size']:>7} {stage:<36} {change:>+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Inbox sizes to benchmark")
+    parser.add_argument("--latency", type=float, default=0.005, help="Simulated seconds per round trip")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of the whole-inbox stages")
+    parser.add_argument("--format", default="full", choices=["full", "metadata"], help="Format of the fetched messages")
+    parser.add_argument("--units-per-second", type=float, default=UNTHROTTLED_UNITS_PER_SECOND,
+                        help="Gmail quota of the request scheduler, e.g. 250 to benchmark at the real limit")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc passes")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="JSON file to write the results to")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    set_scheduler(RequestScheduler(units_per_second=args.units_per_second))
+    results = []
+    print(f"{'size':>7} {'stage':<36} {'msgs/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'peak MB':>8}")
+    for size in args.sizes:
+        result = benchmark_size(size, args.latency, args.repeat, args.format, not args.no_memory)
+        results.append(result)
+        for stage, stats in result["stages"].items():
+            print(f"{size:>7} {stage:<36} {stats['messages_per_second']:>10.0f} {stats['p50_ms']:>9.3f} "
+                  f"{stats['p99_ms']:>9.3f} {stats['peak_memory_mb']:>8.1f}")
+
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "latency": args.latency,
+        "format": args.format,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Benchmarks the memory held by the parsed unread emails, as plain dicts and as EmailRecords.
+
+Messages of a generated corpus (benchmarks/fake_gmail.py) are serialized to JSON beforehand and
+parsed one by one from it, as from Gmail responses, so every email gets its own strings. For each
+representation, the Python memory still allocated once the inbox is parsed and grouped by sender
+is measured with tracemalloc:
+
+- dict: the email data dicts returned by parse_email_message before EmailRecord, bodies included.
+- record: the EmailRecords returned by parse_email_message, with the bodies in a BodyStore; the
+  size of the store file is reported separately, since it lives in the page cache, not the heap.
+
+Run from the repository root:
+    python -m benchmarks.memory [--sizes 1000 10000] [--format full]
+        [--output benchmarks/results/memory.json] [--baseline previous.json]
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Callable, Dict, List
+
+from benchmarks.fake_gmail import FakeGmailService, generate_corpus
+from utils.email_utils import group_emails_by_sender, parse_email_message
+from utils.records import BodyStore, set_body_store
+
+DEFAULT_SIZES = [1000, 10000]
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(__file__), "results", "memory.json")
+
+
+def parse_as_dict(response: str, include_body: bool) -> Dict:
+    # Fresh strings for every email, as the email data dicts had
+    return json.loads(json.dumps(dict(parse_email_message(json.loads(response), include_body))))
+
+
+def parse_as_record(response: str, include_body: bool):
+    return parse_email_message(json.loads(response), include_body)
+
+
+def retained_memory(parse: Callable, responses: List[str], include_body: bool) -> Dict[str, float]:
+    """Parses and groups the inbox under tracemalloc, returns the memory still allocated and the peak."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        emails = [parse(response, include_body) for response in responses]
+        grouped = group_emails_by_sender(emails)
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del emails, grouped
+    return {"retained_mb": current / 1e6, "peak_mb": peak / 1e6}
+
+
+def benchmark_size(size: int, fetch_format: str) -> Dict:
+    service = FakeGmailService(generate_corpus(size))
+    responses = [json.dumps(service.format_message(message, fetch_format, metadata_headers=[]))
+                 for message in service.corpus.values()]
+    include_body = fetch_format == "full"
+
+    results = {"dict": retained_memory(parse_as_dict, responses, include_body)}
+    store = BodyStore()
+    set_body_store(store)
+    results["record"] = retained_memory(parse_as_record, responses, include_body)
+    results["record"]["body_store_mb"] = store.size / 1e6
+    store.close()
+    set_body_store(BodyStore())
+    for stats in results.values():
+        stats["bytes_per_email"] = stats["retained_mb"] * 1e6 / size
+    return results
+
+
+def compare(results: List[Dict], baseline: Dict) -> None:
+    previous_results = {
+        (result["size"], name): stats
+        for result in baseline.get("results", [])
+        for name, stats in result["representations"].items()
+    }
+    print("\nChange of the retained memory against the baseline:")
+    for result in results:
+        for name, stats in result["representations"].items():
+            previous = previous_results.get((result["size"], name))
+            if previous and previous["retained_mb"]:
+                change = (stats["retained_mb"] / previous["retained_mb"] - 1) * 100
+                print(f"{result['size']:>7} {name:<8} {change:>+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Inbox sizes to benchmark")
+    parser.add_argument("--format", default="full", choices=["full", "metadata"], help="Format of the fetched messages")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="JSON file to write the results to")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'size':>7} {'representation':<15} {'retained MB':>12} {'peak MB':>9} {'bytes/email':>12} {'store MB':>9}")
+    for size in args.sizes:
+        representations = benchmark_size(size, args.format)
+        results.append({"size": size, "representations": representations})
+        for name, stats in representations.items():
+            store = f"{stats['body_store_mb']:>9.1f}" if "body_store_mb" in stats else f"{'-':>9}"
+            print(f"{size:>7} {name:<15} {stats['retained_mb']:>12.1f} {stats['peak_mb']:>9.1f} "
+                  f"{stats['bytes_per_email']:>12.0f} {store}")
+
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "format": args.format,
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Benchmarks the startup of the assistant: import times and building the Gmail service.
+
+Each import is timed in a fresh interpreter (median over --repeat runs), since a module is only
+imported once per process:
+
+- the modules imported by main.py before the first Gmail request (utils.functions and the other
+  utils modules), which must stay cheap;
+- the heavy modules that are loaded lazily (autogen and its swarm, the OAuth login flow, bs4,
+  the MIME builders), for reference;
+- service_ready: a fresh interpreter importing the utils modules of main.py and building the Gmail
+  service from (dummy) credentials, i.e. the time before the first Gmail request can be sent.
+
+Building the service is also timed in-process, with googleapiclient's build() and with
+get_gmail_service, which parses the static discovery document once per process.
+
+Run from the repository root:
+    python -m benchmarks.startup [--repeat 5] [--importtime] [--output benchmarks/results/startup.json]
+        [--baseline previous.json]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, List
+
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(__file__), "results", "startup.json")
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imported by main.py before the first Gmail request
+STARTUP_MODULES = [
+    "utils.email_utils",
+    "utils.functions",
+    "utils.async_gmail",
+    "utils.triage",
+    "utils.preclassifier",
+    "utils.decisions",
+    "utils.mailbox",
+]
+
+# Loaded lazily, only when they are needed
+LAZY_MODULES = [
+    "autogen",
+    "autogen.agentchat.contrib.swarm_agent",
+    "google_auth_oauthlib.flow",
+    "bs4",
+    "email.mime.multipart",
+]
+
+SERVICE_READY = f"""
+import {", ".join(STARTUP_MODULES)}
+from google.oauth2.credentials import Credentials
+from utils.email_utils import get_gmail_service
+get_gmail_service(credentials=Credentials(token="dummy"))
+"""
+
+
+def time_in_fresh_interpreter(code: str, repeat: int) -> Dict[str, float]:
+    """Runs `code` in `repeat` new interpreters, returns the median and min of its duration in ms."""
+    timed = f"import time\nstart = time.perf_counter()\n{code}\nprint(time.perf_counter() - start)"
+    samples = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", timed], cwd=REPOSITORY_ROOT, capture_output=True, text=True, check=True
+        ).stdout
+        samples.append(float(output.strip().splitlines()[-1]) * 1000)
+    return {"median_ms": statistics.median(samples), "min_ms": min(samples)}
+
+
+def import_times(modules: List[str], repeat: int) -> Dict[str, Dict[str, float]]:
+    return {module: time_in_fresh_interpreter(f"import {module}", repeat) for module in modules}
+
+
+def slowest_imports(code: str, count: int = 15) -> List[str]:
+    """Returns the `count` imports with the largest cumulative time, from python -X importtime."""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code], cwd=REPOSITORY_ROOT, capture_output=True, text=True,
+        check=True,
+    ).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), name.rstrip()))
+    rows.sort(reverse=True)
+    return [f"{cumulative / 1000:>8.1f} ms {name}" for cumulative, name in rows[:count]]
+
+
+def service_build_times(repeat: int) -> Dict[str, float]:
+    from google.oauth2.credentials import Credentials
+    from googleapiclient.discovery import build
+
+    from utils.email_utils import get_gmail_service
+
+    credentials = Credentials(token="dummy")
+    results = {}
+    for name, function in (
+        ("build", lambda: build("gmail", "v1", credentials=credentials)),
+        ("get_gmail_service", lambda: get_gmail_service(credentials=credentials)),
+    ):
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            samples.append((time.perf_counter() - start) * 1000)
+        results[f"{name}_median_ms"] = statistics.median(samples)
+    return results
+
+
+def compare(results: Dict, baseline: Dict) -> None:
+    print("\nChange of the median import time against the baseline:")
+    previous_imports = {**baseline.get("imports", {}), **baseline.get("lazy_imports", {})}
+    for module, stats in {**results["imports"], **results["lazy_imports"]}.items():
+        previous = previous_imports.get(module)
+        if previous and previous["median_ms"]:
+            print(f"{module:<40} {(stats['median_ms'] / previous['median_ms'] - 1) * 100:>+7.1f}%")
+    previous = baseline.get("service_ready")
+    if previous and previous["median_ms"]:
+        change = (results["service_ready"]["median_ms"] / previous["median_ms"] - 1) * 100
+        print(f"{'service_ready':<40} {change:>+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per measurement")
+    parser.add_argument("--importtime", action="store_true",
+                        help="Also print the slowest imports of service_ready, from python -X importtime")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="JSON file to write the results to")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    empty = time_in_fresh_interpreter("pass", args.repeat)
+    print(f"{'empty interpreter':<40} {empty['median_ms']:>9.1f} ms")
+    results = {"imports": import_times(STARTUP_MODULES, args.repeat)}
+    results["lazy_imports"] = import_times(LAZY_MODULES, args.repeat)
+    results["service_ready"] = time_in_fresh_interpreter(SERVICE_READY, args.repeat)
+    results["service_build"] = service_build_times(args.repeat)
+
+    for title, imports in (("Startup imports", results["imports"]), ("Lazy imports", results["lazy_imports"])):
+        print(f"\n{title}:")
+        for module, stats in imports.items():
+            print(f"{module:<40} {stats['median_ms']:>9.1f} ms")
+    print(f"\n{'service_ready':<40} {results['service_ready']['median_ms']:>9.1f} ms")
+    for name, value in results["service_build"].items():
+        print(f"{name:<40} {value:>9.2f} ms")
+    if args.importtime:
+        print("\nSlowest imports of service_ready:")
+        print("\n".join(slowest_imports(SERVICE_READY)))
+
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        **results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
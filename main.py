@@ -1,50 +1,177 @@
+import functools
 import random
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Union
 from utils.email_utils import (
-    create_draft,
-    fetch_email_thread,
-    group_emails_by_sender,
-    mark_email_as_read,
-    send_draft,
+    get_gmail_service,
+    load_email_body,
+    mark_emails_as_read,
 )
-from autogen import UserProxyAgent, ConversableAgent
-from autogen.agentchat.contrib.swarm_agent import (
-    AfterWork,
-    AfterWorkOption,
-    initiate_swarm_chat,
-    OnCondition,
-    register_hand_off,
+
+from utils import instrumentation
+from utils.async_gmail import AsyncGmailClient, BackgroundEventLoop
+from utils.cache import MessageCache
+from utils.decisions import DecisionCache
+from utils.instrumentation import traced
+from utils.mailbox import MailboxStore
+from utils.preclassifier import format_candidate, preclassify_emails
+from utils.triage import (
+    Classification,
+    TRIAGE_INSTRUCTIONS,
+    format_bulk_suggestions,
+    llm_completion,
+    map_reduce_triage,
+    suggest_bulk_senders,
+    triage_prompt_version,
+)
+from utils.scheduler import RequestScheduler, get_scheduler, set_scheduler
+from utils.functions import (
+    format_email_context,
+    get_context,
+    get_gmail_info,
+    get_llm_config,
+    iter_unread_emails,
+    preload_modules,
 )
+from utils.ingestion import BackgroundLoader
+from utils.thread_digest import ThreadDigester, ThreadSummaryCache, thread_summary_version
 
-from utils.functions import fetch_all_emails, get_context, get_gmail_info, get_llm_config, sort_and_trim_emails
+# The agent framework is the slowest import, it is loaded in the background while the mailbox is fetched
+preload_modules("autogen", "autogen.agentchat.contrib.swarm_agent")
 
 # handle thread id
 
-llm_config = get_llm_config()
-user_email, gmail_service = get_gmail_info()
 max_unread_emails_limit = 20
 is_mock_read_email = False
+# Number of threads fetching emails in parallel, 0 to use batch requests on a single connection
+fetch_concurrency = 0
+# Only list the changes since the previous run, instead of the whole unread label
+use_incremental_sync = True
+# "metadata" only fetches the headers needed for triage, bodies are loaded when a tool needs them
+fetch_format = "metadata"
+# Estimated number of tokens of the emails listed in the triage prompt, the others are paged with a tool
+context_token_budget = 4000
+# Gmail quota units per second shared by all the Gmail calls, 250 is the per-user limit
+gmail_units_per_second = 250
+# Record latency histograms and counters of the Gmail calls and tools, written to metrics_path at the end
+enable_instrumentation = False
+metrics_path = "metrics.prom"
+# With instrumentation enabled, also log every span to this JSON lines file (None to disable)
+span_log_path = None
+# Rules flagging obvious bulk mail from its headers, without the LLM (see utils/preclassifier.py), [] to disable
+preclassifier_rules = ["list_unsubscribe", "bulk_precedence", "promotions", "updates", "noreply_sender"]
+# "map_reduce" classifies the emails in concurrent chunks of triage_chunk_size before the chat starts,
+# "swarm" leaves the whole classification to the triage agent
+triage_mode = "swarm"
+triage_chunk_size = 20
+triage_workers = 4
+# Emails fetched before the chat starts, the others are loaded in the background and pulled with get_new_emails
+first_batch_size = 50
+# Latest messages of a thread returned in full by get_full_thread, the older ones are summarized once and cached
+thread_full_bodies = 2
+
+if enable_instrumentation:
+    instrumentation.enable(span_log_path)
+
+set_scheduler(RequestScheduler(units_per_second=gmail_units_per_second))
+
+startup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="startup")
+user_email, gmail_service, gmail_credentials = get_gmail_info(startup_executor)
+
+# Parsed emails and threads are kept on disk between runs
+message_cache = MessageCache("email_cache.sqlite3")
+
+# Unread emails are streamed: the chat starts after the first batch while the rest loads in the background,
+# on a service of its own since httplib2 is not thread-safe
+email_loader = BackgroundLoader(iter_unread_emails(
+    get_gmail_service(credentials=gmail_credentials),
+    max_unread_emails_limit,
+    service_factory=functools.partial(get_gmail_service, credentials=gmail_credentials) if fetch_concurrency else None,
+    concurrency=fetch_concurrency,
+    cache=message_cache,
+    incremental_sync=use_incremental_sync,
+    fetch_format=fetch_format,
+))
+unread_emails = email_loader.take(first_batch_size)
+email_loader.start()
+
+quota_stats = get_scheduler().stats()
+print(f"Gmail quota: {quota_stats['units']} units, {quota_stats['retries']} retries, "
+      f"{quota_stats['throttled_seconds'] + quota_stats['backoff_seconds']:.1f}s throttled")
+
+# Indexed by message id, thread id, sender and label, shared by all the tools
+mailbox = MailboxStore(unread_emails)
 
-# Fetch unread emails
-unread_emails = fetch_all_emails(gmail_service, max_unread_emails_limit)
+read_email_ids = []
 
-# group_by_sender
-grouped_emails = group_emails_by_sender(unread_emails)
-sorted_grouped_emails = sort_and_trim_emails(grouped_emails)
+# The thread and draft tools share one async client and its connection pool
+async_loop = BackgroundEventLoop()
+async_gmail = AsyncGmailClient(gmail_credentials)
+# Message-ID headers of the threads retrieved with get_full_thread
+thread_reply_ids = {}
 
-read_email_ids = []
+llm_config = get_llm_config()
 
-context_variables = get_context(unread_emails)
+# Obvious bulk mail is flagged locally, only the rest is listed in the triage prompt
+preclassification = preclassify_emails(unread_emails, enabled_rules=preclassifier_rules)
+print(f"Pre-classified {len(preclassification.candidates)} bulk emails, "
+      f"about {preclassification.tokens_saved} prompt tokens saved")
+
+# Hash of the triage instructions and models: editing them invalidates the cached decisions
+decision_version = triage_prompt_version(llm_config)
+
+# Triage decisions of the emails that stay unread are reused across runs
+decision_cache = DecisionCache("email_cache.sqlite3")
+decision_cache.invalidate(decision_version)
+decision_cache.evict()
+triage_decisions = decision_cache.get_decisions(preclassification.remainder, decision_version)
+print(f"Reusing {len(triage_decisions)} triage decisions from previous runs")
+
+# Summaries of the thread messages, each message is summarized once across calls and runs
+summary_cache = ThreadSummaryCache("email_cache.sqlite3")
+summary_version = thread_summary_version(llm_config)
+summary_cache.invalidate(summary_version)
+summary_cache.evict()
+# The LLM client is only created when a thread is first summarized
+summary_completion = functools.lru_cache(maxsize=None)(functools.partial(llm_completion, llm_config))
+thread_digester = ThreadDigester(summary_cache, summary_version, lambda messages: summary_completion()(messages),
+                                 full_bodies=thread_full_bodies)
+
+bulk_suggestions = []
+if triage_mode == "map_reduce":
+    pending_emails = [email for email in preclassification.remainder if email["message_id"] not in triage_decisions]
+    triage_result = map_reduce_triage(pending_emails, llm_completion(llm_config), triage_chunk_size, triage_workers)
+    for email in pending_emails:
+        classification = triage_result.classifications.get(email["message_id"])
+        if classification:
+            decision_cache.put_decision(email, decision_version, *classification)
+    triage_decisions.update(decision_cache.get_decisions(pending_emails, decision_version))
+    print(f"Classified {len(triage_result.classifications)} emails in chunks, "
+          f"{len(triage_result.unclassified_ids)} left to the triage agent")
+    # Reduce over all the emails, including the ones classified in previous runs
+    bulk_suggestions = suggest_bulk_senders(preclassification.remainder, {
+        email_id: Classification(decision.classification, decision.summary)
+        for email_id, decision in triage_decisions.items()
+    })
+
+context_variables = get_context(preclassification.remainder, context_token_budget, preclassification.candidates,
+                                triage_decisions)
+if bulk_suggestions:
+    context_variables["user_emails_context"] += (
+        "Senders suggested to mark as read in bulk:\n" + format_bulk_suggestions(bulk_suggestions))
+if not email_loader.done:
+    context_variables["user_emails_context"] += (
+        "More unread emails are still loading, use get_new_emails to list them once these are triaged.\n")
 
 print(context_variables)
 
 # -------- Tools ----------
 
 
+@traced("tool_call_seconds")
 def mark_all_from_sender_as_read(sender: str) -> str:
-    try:
-        emails = sorted_grouped_emails[sender]
-    except KeyError:
+    emails = mailbox.by_sender(sender, label="UNREAD")
+    if not emails:
         return f"No emails found from {sender}."
     # print warning message: sender, first 10 email subjects and random 3 email bodies
     print("*" * 100)
@@ -55,7 +182,10 @@ def mark_all_from_sender_as_read(sender: str) -> str:
 
     random_emails = random.sample(emails, 1)
     for email in random_emails:
-        print(f"Selected Email Body: {email['body']}")
+        try:
+            print(f"Selected Email Body: {load_email_body(gmail_service, email, message_cache)}")
+        except Exception as e:
+            print(f"Failed to load the email body: {e}")
 
     print("*" * 100)
     print("*" * 100)
@@ -63,38 +193,138 @@ def mark_all_from_sender_as_read(sender: str) -> str:
     if user_input.lower() == "yes" or user_input.lower() == "y":
         print("Marking all emails as read...")
         # mark all emails as read
-        for email in emails:
-            read_email_ids.append(email["message_id"])
-            if not is_mock_read_email:
-                mark_email_as_read(gmail_service, email["message_id"])
+        failed_ids = mark_as_read([email["message_id"] for email in emails])
+        if failed_ids:
+            return f"Failed to mark {len(failed_ids)} of {len(emails)} emails as read: {', '.join(failed_ids)}"
         return "All emails marked as read successfully!"
     else:
         return "Operation cancelled by user."
 
 
+def mark_as_read(email_ids: List[str]) -> List[str]:
+    """Marks emails as read with batched requests, returns the ids that could not be marked."""
+    if is_mock_read_email:
+        read_email_ids.extend(email_ids)
+        mailbox.mark_as_read(email_ids)
+        return []
+    failed_ids = []
+    for result in mark_emails_as_read(gmail_service, email_ids):
+        if result["success"]:
+            read_email_ids.extend(result["message_ids"])
+            mailbox.mark_as_read(result["message_ids"])
+            message_cache.update_labels(result["message_ids"], remove_label_ids=["UNREAD"])
+        else:
+            failed_ids.extend(result["message_ids"])
+    return failed_ids
+
+
+@traced("tool_call_seconds")
 def mark_one_email_as_read(email_id: str) -> str:
     """ Marks a single email as read based on its id after user confirmation"""
-    read_email_ids.append(email_id)
-    if is_mock_read_email:
-        return "Successfully marked email as read."
-    return mark_email_as_read(
-        gmail_service, email_id
-    )
+    # The mailbox and the cache are only updated once Gmail marked the email as read
+    if mark_as_read([email_id]):
+        return f"Failed to mark email {email_id} as read."
+    return f"Email {email_id} marked as read."
 
 
-def get_email_body(email_id: str) -> str:
-    """Get the body of an email by email id"""
-    for email in unread_emails:
-        if email["message_id"] == email_id:
-            return email["body"]
-    return "Email not found."
+@traced("tool_call_seconds")
+def mark_multiple_emails_as_read(email_ids: List[str]) -> str:
+    """ Marks several emails as read based on their ids after user confirmation"""
+    failed_ids = mark_as_read(email_ids)
+    if failed_ids:
+        return f"Failed to mark {len(failed_ids)} of {len(email_ids)} emails as read: {', '.join(failed_ids)}"
+    return f"Successfully marked {len(email_ids)} emails as read."
 
 
+@traced("tool_call_seconds")
+def get_email_body(email_id: str) -> str:
+    """Get the body of an email by email id"""
+    email = mailbox.get(email_id)
+    if email is None:
+        return "Email not found."
+    try:
+        return load_email_body(gmail_service, email, message_cache)
+    except Exception as e:
+        return f"Failed to load the email body: {e}"
+
+
+@traced("tool_call_seconds")
+def get_more_emails(page: int = 0) -> str:
+    """List the emails that are not in the context, 20 per page starting at page 0"""
+    page_size = 20
+    omitted_ids = context_variables["omitted_email_ids"][page * page_size:(page + 1) * page_size]
+    if not omitted_ids:
+        return "No more emails."
+    entries = [format_email_context(mailbox.get(email_id)) for email_id in omitted_ids if email_id in mailbox]
+    pages = -(-len(context_variables["omitted_email_ids"]) // page_size)
+    return f"Page {page + 1} of {pages}:\n\n" + "\n".join(entries)
+
+
+@traced("tool_call_seconds")
+def get_preclassified_emails(page: int = 0) -> str:
+    """List the emails pre-classified as bulk mail to mark as read and why, 20 per page starting at page 0"""
+    page_size = 20
+    email_ids = context_variables["preclassified_email_ids"]
+    page_ids = email_ids[page * page_size:(page + 1) * page_size]
+    if not page_ids:
+        return "No more pre-classified emails."
+    entries = [format_candidate(mailbox.get(email_id), preclassification.reasons)
+               for email_id in page_ids if email_id in mailbox]
+    pages = -(-len(email_ids) // page_size)
+    return f"Page {page + 1} of {pages}:\n\n" + "\n".join(entries)
+
+
+@traced("tool_call_seconds")
+def get_new_emails() -> str:
+    """List the unread emails loaded since the chat started"""
+    new_emails = email_loader.drain()
+    if not new_emails:
+        return "All unread emails are already listed." if email_loader.done else "No new emails yet, try again later."
+    mailbox.add_all(new_emails)
+    new_preclassification = preclassify_emails(new_emails, enabled_rules=preclassifier_rules)
+    preclassification.reasons.update(new_preclassification.reasons)
+    new_decisions = decision_cache.get_decisions(new_preclassification.remainder, decision_version)
+    triage_decisions.update(new_decisions)
+    new_context = get_context(new_preclassification.remainder, context_token_budget, new_preclassification.candidates,
+                              new_decisions)
+    # The emails that do not fit are paged with get_more_emails and get_preclassified_emails
+    context_variables["omitted_email_ids"].extend(new_context["omitted_email_ids"])
+    context_variables["preclassified_email_ids"].extend(new_context["preclassified_email_ids"])
+    status = "all unread emails are now listed" if email_loader.done else "more are still loading"
+    return f"{len(new_emails)} new emails, {status}. " + new_context["user_emails_context"]
+
+
+@traced("tool_call_seconds")
+def record_triage_decision(email_id: str, classification: str, key_points: str = "") -> str:
+    """Save the classification ("Mark as read" or "Read full email to decide") and key points of an email for the next runs"""
+    email = mailbox.get(email_id)
+    if email is None:
+        return "Email not found."
+    decision_cache.put_decision(email, decision_version, classification, key_points)
+    return f"Decision recorded for email {email_id}."
+
+
+@traced("tool_call_seconds")
+def get_top_senders(count: int = 10) -> str:
+    """List the senders with the most unread emails, with their mailing list, to suggest bulk mark as read"""
+    top_senders = mailbox.senders.top_senders(count)
+    if not top_senders:
+        return "No unread emails."
+    return "\n".join(stats.describe() for stats in top_senders)
+
+
+@traced("tool_call_seconds")
 def get_full_thread(email_thread_id: str) -> str:
-    """Get the full thread of an email."""
-    return fetch_email_thread(gmail_service, email_thread_id)
+    """Get the thread of an email: a summary of each older message and the latest messages in full."""
+    emails = async_loop.run(async_gmail.fetch_email_thread(email_thread_id, cache=message_cache))
+    # Keep the Message-ID headers, a reply drafted right after does not need to fetch them again
+    if emails and all("rfc_message_id" in email for email in emails):
+        thread_reply_ids[email_thread_id] = [
+            email["rfc_message_id"] for email in emails if email["rfc_message_id"]]
+    return thread_digester.digest(emails)
 
 
+@traced("tool_call_seconds")
 def write_draft(to: str, subject: str, body: str, cc: Union[str, List[str]] = None,
                 bcc: Union[str, List[str]] = None, attachment_paths: List[str] = None,
                 thread_id: str = None) -> str:
@@ -110,14 +340,27 @@ def write_draft(to: str, subject: str, body: str, cc: Union[str, List[str]] = No
     Returns:
         String with draft creation result
     """
-    return create_draft(gmail_service, to, subject, body, cc, bcc, attachment_paths, thread_id)
+    return async_loop.run(async_gmail.create_draft(
+        to, subject, body, cc, bcc, attachment_paths, thread_id,
+        reply_message_ids=thread_reply_ids.get(thread_id)))
 
 
+@traced("tool_call_seconds")
 def send(draft_id: str) -> str:
     """ Send a draft by draft id """
-    return send_draft(gmail_service, draft_id)
+    return async_loop.run(async_gmail.send_draft(draft_id))
 
 
+# Already loaded by preload_modules in most cases
+from autogen import UserProxyAgent, ConversableAgent  # noqa: E402
+from autogen.agentchat.contrib.swarm_agent import (  # noqa: E402
+    AfterWork,
+    AfterWorkOption,
+    initiate_swarm_chat,
+    OnCondition,
+    register_hand_off,
+)
+
 user_proxy = UserProxyAgent(
     name="user_proxy",
     human_input_mode="ALWAYS",
@@ -133,21 +376,9 @@ triage_agent = ConversableAgent(
     llm_config=llm_config,
     system_message=f"""You are a triage agent for emails.
 All emails with id, sender and subject will be provided to you through context variables: {context_variables['user_emails_context']}.
-
-1. Classify ALL the emails into:
-- "Mark as read": If you think the email could be marked as read based on subject, from and body's email. Explain why the mail was classified like this.
-- "Read full email to decide": If you need to read the full email to decide. Explain why the mail was classified like this.
-
-2. After full emails are retrieved, outline the key points in short, concise sentences for each email. Make it short and informative.
-
-3. Please identify what sender's email are less important and can be marked as read in bulk.
-Given your suggestions on what emails by sender can be marked as read and always ask the user for confirmation before marking them as read.
-
-4. Identify if any email requires a response and suggest this action.
-
-If no further actions are needed, please reply with TERMINATE.
-""",
-    functions=[mark_one_email_as_read, get_email_body],
+""" + TRIAGE_INSTRUCTIONS,
+    functions=[mark_one_email_as_read, mark_multiple_emails_as_read, get_email_body, get_more_emails,
+               get_top_senders, get_preclassified_emails, record_triage_decision, get_new_emails],
 )
 
 writer_agent = ConversableAgent(
@@ -208,3 +439,9 @@ initiate_swarm_chat(
     after_work=AfterWork(AfterWorkOption.REVERT_TO_USER),
     context_variables=context_variables
 )
+
+if enable_instrumentation:
+    for agent in (triage_agent, writer_agent):
+        instrumentation.record_llm_usage(agent)
+    instrumentation.write_prometheus(metrics_path)
+    print(f"Metrics written to {metrics_path}")
@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+# The tests import the utils and benchmarks packages from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.scheduler import RequestScheduler  # noqa: E402
+
+
+@pytest.fixture
+def scheduler() -> RequestScheduler:
+    """A scheduler that never throttles nor waits before retrying."""
+    return RequestScheduler(units_per_second=1e9, base_delay=0.0, max_delay=0.0)
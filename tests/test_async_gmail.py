@@ -0,0 +1,252 @@
+import asyncio
+import json
+from typing import Callable, Dict, List, Optional, Type, Union
+
+import httpx
+import pytest
+from google.oauth2.credentials import Credentials
+
+from benchmarks.fake_gmail import FakeGmailService, generate_corpus
+from utils.async_gmail import AsyncGmailClient
+from utils.cache import MessageCache
+
+API_URL = "https://gmail.test/gmail/v1/users/me"
+UPLOAD_URL = "https://gmail.test/upload/gmail/v1/users/me"
+SESSION_URL = "https://gmail.test/upload/session/1"
+
+
+class FakeGmailServer:
+    """
+    Serves the REST endpoints used by AsyncGmailClient from a FakeGmailService corpus, through an
+    httpx.MockTransport. `failures` maps a "METHOD path" to the status codes returned, or the
+    httpx.TransportError classes raised, before it succeeds.
+    """
+
+    def __init__(
+        self,
+        messages: List[Dict],
+        page_size: int = 100,
+        failures: Optional[Dict[str, List[Union[int, Type[httpx.TransportError]]]]] = None,
+        latency: float = 0.0,
+    ):
+        self.service = FakeGmailService(messages, page_size=page_size)
+        self.failures = {key: list(statuses) for key, statuses in (failures or {}).items()}
+        self.latency = latency
+        self.requests: List[httpx.Request] = []
+        self.drafts: Dict[str, Dict] = {}
+        self.upload = bytearray()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handle_async)
+
+    def calls(self, method: str, path: str) -> List[httpx.Request]:
+        return [request for request in self.requests if request.method == method and request.url.path == path]
+
+    async def handle_async(self, request: httpx.Request) -> httpx.Response:
+        # Requests sleep `latency` seconds, counting how many are served at the same time
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            return self.handle(request)
+        finally:
+            self.in_flight -= 1
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        failures = self.failures.get(f"{request.method} {request.url.path}")
+        if failures:
+            failure = failures.pop(0)
+            if not isinstance(failure, int):
+                raise failure("injected failure", request=request)
+            return httpx.Response(failure, json={"error": {"message": "injected failure"}})
+        path = request.url.path.removeprefix("/gmail/v1/users/me")
+        params = request.url.params
+        if request.url.path.startswith("/upload/"):
+            return self.handle_upload(request)
+        if request.method == "GET" and path == "/messages":
+            labels = params.get_list("labelIds")
+            return httpx.Response(200, json=self.service.users().messages().list(
+                userId="me", labelIds=labels, pageToken=params.get("pageToken")).execute())
+        if request.method == "GET" and path.startswith("/messages/"):
+            message = self.service.corpus[path.rsplit("/", 1)[1]]
+            return httpx.Response(200, json=self.service.format_message(
+                message, params.get("format", "full"), params.get_list("metadataHeaders")))
+        if request.method == "GET" and path.startswith("/threads/"):
+            thread = self.service.users().threads().get(
+                userId="me", id=path.rsplit("/", 1)[1], format=params.get("format", "full")).execute()
+            return httpx.Response(200, json=thread)
+        if request.method == "POST" and path == "/drafts":
+            return httpx.Response(200, json=self.create_draft(json.loads(request.content)))
+        if request.method == "POST" and path == "/drafts/send":
+            draft = self.drafts[json.loads(request.content)["id"]]
+            return httpx.Response(200, json={"id": f"sent-{draft['id']}", "labelIds": ["SENT"]})
+        return httpx.Response(404, json={"error": {"message": f"Unknown endpoint {request.method} {path}"}})
+
+    def create_draft(self, body: Dict) -> Dict:
+        draft = {"id": f"d{len(self.drafts) + 1}", "message": body.get("message", {})}
+        self.drafts[draft["id"]] = draft
+        return draft
+
+    def handle_upload(self, request: httpx.Request) -> httpx.Response:
+        if request.method == "POST":
+            # Start of a resumable upload session
+            self.upload_metadata = json.loads(request.content)
+            self.upload_size = int(request.headers["X-Upload-Content-Length"])
+            return httpx.Response(200, headers={"Location": SESSION_URL})
+        content_range = request.headers["Content-Range"]
+        if content_range.startswith("bytes */"):
+            # Status query
+            headers = {"Range": f"bytes=0-{len(self.upload) - 1}"} if self.upload else {}
+            return httpx.Response(308, headers=headers)
+        start = int(content_range.split()[1].split("-")[0])
+        del self.upload[start:]
+        self.upload.extend(request.content)
+        if len(self.upload) < self.upload_size:
+            return httpx.Response(308, headers={"Range": f"bytes=0-{len(self.upload) - 1}"})
+        return httpx.Response(200, json=self.create_draft(self.upload_metadata))
+
+
+def run(server: FakeGmailServer, scheduler, coroutine: Callable[[AsyncGmailClient], object]):
+    async def main():
+        async with AsyncGmailClient(
+            Credentials(token="test-token"), base_url=API_URL, upload_url=UPLOAD_URL, scheduler=scheduler,
+            transport=server.transport(),
+        ) as client:
+            return await coroutine(client)
+
+    return asyncio.run(main())
+
+
+@pytest.fixture
+def corpus() -> List[Dict]:
+    return generate_corpus(60)
+
+
+def test_fetch_emails_pages_through_the_listing(corpus, scheduler):
+    server = FakeGmailServer(corpus, page_size=25)
+
+    async def list_all(client):
+        message_ids, page_token = [], None
+        while True:
+            messages, page_token = await client.fetch_emails(page_token)
+            message_ids.extend(message["id"] for message in messages)
+            if not page_token:
+                return message_ids
+
+    assert run(server, scheduler, list_all) == [message["id"] for message in corpus]
+    listings = server.calls("GET", "/gmail/v1/users/me/messages")
+    assert len(listings) == 3
+    assert all(request.url.params.get_list("labelIds") == ["UNREAD"] for request in listings)
+    assert all(request.headers["Authorization"] == "Bearer test-token" for request in server.requests)
+
+
+def test_parse_emails_data_keeps_the_listing_order(corpus, scheduler):
+    server = FakeGmailServer(corpus)
+    message_infos = [{"id": message["id"]} for message in corpus]
+
+    emails = run(server, scheduler, lambda client: client.parse_emails_data(message_infos, format="metadata"))
+
+    assert [email["message_id"] for email in emails] == [message["id"] for message in corpus]
+    assert all(email["body"] is None for email in emails)
+    newsletters = [email for email in emails if email["list_id"]]
+    assert newsletters and all(email["list_unsubscribe"] for email in newsletters)
+    request = server.calls("GET", f"/gmail/v1/users/me/messages/{corpus[0]['id']}")[0]
+    assert request.url.params["format"] == "metadata"
+    assert "List-Id" in request.url.params.get_list("metadataHeaders")
+
+
+def test_rate_limited_requests_are_retried(corpus, scheduler):
+    path = f"/gmail/v1/users/me/messages/{corpus[0]['id']}"
+    server = FakeGmailServer(corpus, failures={f"GET {path}": [429, 503]})
+
+    email = run(server, scheduler, lambda client: client.parse_email_data({"id": corpus[0]["id"]}))
+
+    assert email["message_id"] == corpus[0]["id"]
+    assert len(server.calls("GET", path)) == 3
+    assert scheduler.stats()["retries"] == 2
+
+
+def test_concurrent_fetches_overlap(corpus, scheduler):
+    server = FakeGmailServer(corpus, latency=0.01)
+    message_infos = [{"id": message["id"]} for message in corpus]
+
+    emails = run(server, scheduler, lambda client: client.parse_emails_data(message_infos, concurrency=10))
+
+    assert len(emails) == len(corpus)
+    assert server.max_in_flight == 10
+
+
+@pytest.mark.parametrize("error", [httpx.ConnectError, httpx.ReadTimeout])
+def test_connection_errors_are_retried(corpus, scheduler, error):
+    path = f"/gmail/v1/users/me/messages/{corpus[0]['id']}"
+    server = FakeGmailServer(corpus, failures={f"GET {path}": [error, 503]})
+
+    email = run(server, scheduler, lambda client: client.parse_email_data({"id": corpus[0]["id"]}))
+
+    assert email["message_id"] == corpus[0]["id"]
+    assert len(server.calls("GET", path)) == 3
+
+
+def test_connection_errors_of_send_draft_are_not_retried(corpus, scheduler):
+    server = FakeGmailServer(corpus, failures={"POST /gmail/v1/users/me/drafts/send": [httpx.ReadTimeout]})
+
+    result = run(server, scheduler, lambda client: client.send_draft("d1"))
+
+    assert "error" in result
+    assert len(server.calls("POST", "/gmail/v1/users/me/drafts/send")) == 1
+
+
+def test_server_errors_of_send_draft_are_not_retried(corpus, scheduler):
+    server = FakeGmailServer(corpus, failures={"POST /gmail/v1/users/me/drafts/send": [503]})
+
+    result = run(server, scheduler, lambda client: client.send_draft("d1"))
+
+    assert "error" in result
+    assert len(server.calls("POST", "/gmail/v1/users/me/drafts/send")) == 1
+
+
+def test_fetch_email_thread_is_cached_by_history_id(corpus, scheduler, tmp_path):
+    thread_id = next(message["threadId"] for message in corpus
+                     if sum(other["threadId"] == message["threadId"] for other in corpus) > 1)
+    server = FakeGmailServer(corpus)
+    cache = MessageCache(str(tmp_path / "cache.sqlite3"))
+    try:
+        first = run(server, scheduler, lambda client: client.fetch_email_thread(thread_id, cache=cache))
+        second = run(server, scheduler, lambda client: client.fetch_email_thread(thread_id, cache=cache))
+    finally:
+        cache.close()
+
+    assert len(first) > 1 and second == first
+    thread_requests = server.calls("GET", f"/gmail/v1/users/me/threads/{thread_id}")
+    formats = [request.url.params["format"] for request in thread_requests]
+    assert formats == ["minimal", "full", "minimal"]
+
+
+def test_create_draft_without_attachments(corpus, scheduler):
+    server = FakeGmailServer(corpus)
+
+    draft = run(server, scheduler, lambda client: client.create_draft(
+        "friend@example.com", "Hello", "Hi there", thread_id="t1", reply_message_ids=["<a@example.com>"]))
+
+    assert draft["id"] == "d1"
+    assert server.drafts["d1"]["message"]["threadId"] == "t1"
+
+
+@pytest.mark.parametrize("failure", [503, httpx.ReadTimeout])
+def test_create_draft_with_attachment_resumes_the_upload(corpus, scheduler, tmp_path, failure):
+    attachment = tmp_path / "report.pdf"
+    attachment.write_bytes(bytes(range(256)) * 400)
+    server = FakeGmailServer(corpus, failures={"PUT /upload/session/1": [failure]})
+
+    draft = run(server, scheduler, lambda client: client.create_draft(
+        "friend@example.com", "Report", "Attached", attachment_paths=[str(attachment)]))
+
+    assert draft["id"] == "d1"
+    # The failed chunk, the status query, then the chunk again
+    assert len(server.calls("PUT", "/upload/session/1")) == 3
+    assert len(server.upload) == server.upload_size
+    assert b"Content-Disposition: attachment" in bytes(server.upload)
+    assert b'filename="report.pdf"' in bytes(server.upload)
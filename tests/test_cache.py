@@ -0,0 +1,111 @@
+import json
+import sqlite3
+
+import pytest
+
+from utils.cache import MessageCache
+from utils.records import BodyStore, EmailRecord, get_body_store, set_body_store
+
+# messages table of the caches created before the parser version was recorded
+OLD_MESSAGES_TABLE = (
+    "CREATE TABLE messages (message_id TEXT PRIMARY KEY, thread_id TEXT, history_id TEXT, data TEXT NOT NULL)"
+)
+EMAIL = {"message_id": "m1", "thread_id": "t1", "from": "a@example.com", "labels": ["UNREAD"], "snippet": "Hi"}
+
+
+@pytest.fixture
+def path(tmp_path) -> str:
+    return str(tmp_path / "cache.sqlite3")
+
+
+@pytest.fixture
+def store():
+    previous = get_body_store()
+    store = BodyStore()
+    set_body_store(store)
+    yield store
+    set_body_store(previous)
+    store.close()
+
+
+def test_cached_messages_round_trip_as_records(path):
+    cache = MessageCache(path)
+    cache.put_messages([EmailRecord({**EMAIL, "body": "Hello"})])
+
+    email_data = cache.get_message("m1")
+
+    assert isinstance(email_data, EmailRecord)
+    assert email_data["snippet"] == "Hi" and email_data["body"] == "Hello"
+    cache.close()
+
+
+def test_messages_cached_before_the_parser_version_are_misses(path):
+    # Cache file of an older version, with fewer fields
+    conn = sqlite3.connect(path)
+    conn.execute(OLD_MESSAGES_TABLE)
+    conn.execute("INSERT INTO messages VALUES ('m1', 't1', '1', ?)",
+                 (json.dumps({"message_id": "m1", "thread_id": "t1", "from": "a@example.com", "labels": []}),))
+    conn.commit()
+    conn.close()
+
+    cache = MessageCache(path)
+    assert cache.get_messages(["m1"]) == {}
+
+    cache.put_messages([EMAIL])
+    assert cache.get_message("m1")["snippet"] == "Hi"
+    cache.close()
+
+
+def test_messages_of_another_parser_version_are_misses(path):
+    cache = MessageCache(path)
+    cache.put_messages([EMAIL])
+    with cache._conn:
+        cache._conn.execute("UPDATE messages SET parser_version = 'old'")
+
+    assert cache.get_messages(["m1"]) == {}
+    cache.close()
+
+
+def test_caches_opened_together_share_the_migration(path):
+    conn = sqlite3.connect(path)
+    conn.execute(OLD_MESSAGES_TABLE)
+    conn.close()
+
+    caches = [MessageCache(path, namespace=name) for name in ("a", "b")]
+
+    for cache in caches:
+        cache.put_messages([EMAIL])
+        assert cache.get_message("m1")["message_id"] == "m1"
+        cache.close()
+
+
+def test_update_labels_rewrites_only_the_labels(path, store):
+    cache = MessageCache(path)
+    cache.put_messages([EmailRecord({**EMAIL, "labels": ["UNREAD", "INBOX"], "body": "Hello " * 1000})])
+    size = store.size
+
+    for _ in range(10):
+        cache.update_labels(["m1", "missing"], add_label_ids=["STARRED"], remove_label_ids=["UNREAD"])
+
+    assert store.size == size
+    email_data = cache.get_message("m1")
+    assert email_data["labels"] == ["INBOX", "STARRED"]
+    assert email_data["body"] == "Hello " * 1000 and email_data["snippet"] == "Hi"
+    assert cache.get_messages(["missing"]) == {}
+    cache.close()
+
+
+def test_reading_cached_messages_again_does_not_grow_the_body_store(path, store):
+    cache = MessageCache(path)
+    cache.put_messages([EmailRecord({**EMAIL, "body": "Hello " * 1000})])
+    email_data = cache.get_message("m1")
+    size = store.size
+
+    for _ in range(10):
+        cache.get_message("m1")
+    # Setting the body it already has keeps its offset
+    email_data["body"] = "Hello " * 1000
+
+    assert store.size == size
+    assert cache.get_message("m1")["body"] == email_data["body"] == "Hello " * 1000
+    cache.close()
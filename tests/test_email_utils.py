@@ -0,0 +1,78 @@
+from typing import Dict, List
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from utils.email_utils import batch_modify_labels
+from utils.scheduler import get_scheduler, set_scheduler
+
+
+@pytest.fixture(autouse=True)
+def unthrottled(scheduler):
+    previous = get_scheduler()
+    set_scheduler(scheduler)
+    yield
+    set_scheduler(previous)
+
+
+class FakeBatchModify:
+    """messages().batchModify failing with `status` on chunks holding a bad id, or on all chunks without `bad_ids`."""
+
+    def __init__(self, status: int, bad_ids=None):
+        self.status = status
+        self.bad_ids = bad_ids
+        self.chunks: List[List[str]] = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def batchModify(self, userId: str, body: Dict):
+        return FakeRequest(self, body["ids"])
+
+
+class FakeRequest:
+    methodId = "gmail.users.messages.batchModify"
+
+    def __init__(self, service: FakeBatchModify, ids: List[str]):
+        self.service = service
+        self.ids = ids
+
+    def execute(self, http=None, num_retries: int = 0) -> Dict:
+        self.service.chunks.append(self.ids)
+        if self.service.bad_ids is None or set(self.ids) & set(self.service.bad_ids):
+            raise HttpError(httplib2.Response({"status": self.service.status}), b"error")
+        return {}
+
+
+def failed_ids(results: List[Dict]) -> List[str]:
+    return [message_id for result in results if not result["success"] for message_id in result["message_ids"]]
+
+
+def test_batch_modify_labels_isolates_invalid_ids():
+    message_ids = [f"m{index}" for index in range(1000)]
+    service = FakeBatchModify(400, bad_ids=["m10", "m700"])
+
+    results = batch_modify_labels(service, message_ids, remove_label_ids=["UNREAD"])
+
+    assert failed_ids(results) == ["m10", "m700"]
+    succeeded = [message_id for result in results if result["success"] for message_id in result["message_ids"]]
+    assert sorted(succeeded + ["m10", "m700"]) == sorted(message_ids)
+    # Bisection: about two requests per level for each bad id, not one per message
+    assert len(service.chunks) < 50
+
+
+@pytest.mark.parametrize("status", [401, 403, 429, 500, 503])
+def test_batch_modify_labels_fails_whole_chunks_on_other_errors(status):
+    message_ids = [f"m{index}" for index in range(1500)]
+    service = FakeBatchModify(status)
+
+    results = batch_modify_labels(service, message_ids, remove_label_ids=["UNREAD"])
+
+    assert failed_ids(results) == message_ids
+    assert [len(result["message_ids"]) for result in results] == [1000, 500]
+    # One request per chunk, plus the scheduler's retries of the retryable errors
+    assert len(service.chunks) == 2 * (1 + (get_scheduler().max_retries if status in (429, 500, 503) else 0))
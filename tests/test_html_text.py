@@ -0,0 +1,20 @@
+import pytest
+
+from utils.html_text import HTML_TEXT_ENGINES, html_to_text, lxml_available
+
+ENGINES = [engine for engine in HTML_TEXT_ENGINES if engine != "lxml" or lxml_available()]
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+@pytest.mark.parametrize("html", ["", "   \n\t ", "<!-- tracking pixel -->"])
+def test_empty_documents_convert_to_empty_text(engine, html):
+    assert html_to_text(html, engine=engine) == ""
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_xml_declaration_with_an_encoding(engine):
+    html = ('<?xml version="1.0" encoding="utf-8"?>\n'
+            "<html><head><style>p {color: red}</style></head>"
+            "<body><p>Weekly deals</p><p>50% &amp; more</p></body></html>")
+
+    assert html_to_text(html, engine=engine).split() == ["Weekly", "deals", "50%", "&", "more"]
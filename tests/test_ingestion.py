@@ -0,0 +1,73 @@
+from typing import Callable
+
+import pytest
+
+from benchmarks.fake_gmail import FakeGmailService, generate_corpus
+from utils.ingestion import BackgroundLoader, ingest_messages
+from utils.scheduler import get_scheduler, set_scheduler
+
+
+@pytest.fixture(autouse=True)
+def unthrottled(scheduler):
+    previous = get_scheduler()
+    set_scheduler(scheduler)
+    yield
+    set_scheduler(previous)
+
+
+def failing_listing(service: FakeGmailService, after_pages: int) -> Callable[[], FakeGmailService]:
+    """Service factory whose messages().list fails once `after_pages` pages were listed."""
+    def factory():
+        messages = service.messages
+
+        def patched_messages():
+            resource = messages()
+            list_messages = resource.list
+
+            def list_page(**kwargs):
+                if int(kwargs.get("pageToken") or 0) >= after_pages * service.page_size:
+                    raise RuntimeError("listing failed")
+                return list_messages(**kwargs)
+
+            resource.list = list_page
+            return resource
+
+        service.messages = patched_messages
+        return service
+
+    return factory
+
+
+def test_ingest_messages_yields_every_message_in_order():
+    corpus = generate_corpus(250)
+
+    emails = list(ingest_messages(lambda: FakeGmailService(corpus), concurrency=4))
+
+    assert [email["message_id"] for email in emails] == [message["id"] for message in corpus]
+
+
+def test_ingest_messages_raises_when_the_service_cannot_be_built():
+    def factory():
+        raise RuntimeError("token expired")
+
+    with pytest.raises(RuntimeError, match="token expired"):
+        list(ingest_messages(factory))
+
+
+def test_ingest_messages_raises_after_the_messages_listed_before_the_error():
+    service = FakeGmailService(generate_corpus(250))
+    emails = []
+
+    with pytest.raises(RuntimeError, match="listing failed"):
+        for email_data in ingest_messages(failing_listing(service, after_pages=1), concurrency=2):
+            emails.append(email_data)
+
+    assert len(emails) == service.page_size
+
+
+def test_background_loader_take_raises_instead_of_blocking():
+    def factory():
+        raise RuntimeError("token expired")
+
+    with pytest.raises(RuntimeError, match="token expired"):
+        BackgroundLoader(ingest_messages(factory)).take(10)
@@ -0,0 +1,45 @@
+from typing import Dict
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+
+class FailingRequest:
+    """HttpRequest failing with `status` a number of times before it succeeds."""
+
+    def __init__(self, method_id: str, status: int, failures: int):
+        self.methodId = method_id
+        self.status = status
+        self.failures = failures
+        self.calls = 0
+
+    def execute(self, http=None, num_retries: int = 0) -> Dict:
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise HttpError(httplib2.Response({"status": self.status}), b"error")
+        return {"id": "ok"}
+
+
+@pytest.mark.parametrize("method_id", ["gmail.users.messages.get", "gmail.users.messages.batchModify"])
+def test_server_errors_of_idempotent_methods_are_retried(scheduler, method_id):
+    request = FailingRequest(method_id, 503, failures=2)
+
+    assert scheduler.execute(request) == {"id": "ok"}
+    assert request.calls == 3
+
+
+@pytest.mark.parametrize("method_id", ["gmail.users.drafts.create", "gmail.users.drafts.send"])
+def test_server_errors_of_drafts_create_and_send_are_not_retried(scheduler, method_id):
+    request = FailingRequest(method_id, 503, failures=1)
+
+    with pytest.raises(HttpError):
+        scheduler.execute(request)
+    assert request.calls == 1
+
+
+def test_rate_limits_of_drafts_send_are_retried(scheduler):
+    request = FailingRequest("gmail.users.drafts.send", 429, failures=1)
+
+    assert scheduler.execute(request) == {"id": "ok"}
+    assert request.calls == 2
@@ -0,0 +1,36 @@
+import random
+
+from utils.senders import SenderAggregator, SenderStats
+
+
+def email(message_id: str, date: int, sender: str = "News <news@shop.example>"):
+    return {"message_id": message_id, "from": sender, "internal_date": date}
+
+
+def test_oldest_and_newest_follow_additions_and_removals():
+    stats = SenderStats("news@shop.example")
+    dates = {}
+    rng = random.Random(0)
+    for step in range(3000):
+        message_id = f"m{rng.randrange(100)}"
+        if rng.random() < 0.4:
+            stats.remove(email(message_id, 0))
+            dates.pop(message_id, None)
+        else:
+            # Adding an email again may change its date
+            dates[message_id] = rng.randrange(1000)
+            stats.add(email(message_id, dates[message_id]), "News")
+        assert stats.oldest == (min(dates.values()) if dates else None), step
+        assert stats.newest == (max(dates.values()) if dates else None), step
+
+
+def test_aggregator_drops_senders_without_emails():
+    aggregator = SenderAggregator([email("m1", 10), email("m2", 30), email("m3", 20, "a@mail.example")])
+
+    aggregator.remove(email("m2", 30))
+    stats = aggregator.get("news@shop.example")
+    assert (stats.count, stats.oldest, stats.newest) == (1, 10, 10)
+
+    aggregator.remove(email("m1", 10))
+    assert aggregator.get("news@shop.example") is None
+    assert [stats.key for stats in aggregator.top_senders()] == ["a@mail.example"]
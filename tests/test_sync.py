@@ -0,0 +1,82 @@
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from benchmarks.fake_gmail import FakeGmailService, generate_corpus
+from utils.cache import MessageCache
+from utils.functions import iter_emails_in_batches
+from utils.scheduler import get_scheduler, set_scheduler
+from utils.sync import HISTORY_ID_KEY, sync_unread_ids
+
+
+@pytest.fixture(autouse=True)
+def unthrottled(scheduler):
+    previous = get_scheduler()
+    set_scheduler(scheduler)
+    yield
+    set_scheduler(previous)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = MessageCache(str(tmp_path / "cache.sqlite3"))
+    yield cache
+    cache.close()
+
+
+class FailingListService(FakeGmailService):
+    """Fake service whose messages().list fails with `status` from the page at `fail_at` on."""
+
+    def __init__(self, messages, status: int, fail_at: int, page_size: int = 100):
+        super().__init__(messages, page_size=page_size)
+        self.status = status
+        self.fail_at = fail_at
+
+    def messages(self):
+        resource = super().messages()
+        list_page = resource.list
+
+        def failing_list(**kwargs):
+            request = list_page(**kwargs)
+            if int(kwargs.get("pageToken") or 0) >= self.fail_at:
+                def execute(http=None, num_retries=0):
+                    raise HttpError(httplib2.Response({"status": self.status}), b"error")
+                request.execute = execute
+            return request
+
+        resource.list = failing_list
+        return resource
+
+
+def test_full_sync_lists_every_page(cache):
+    corpus = generate_corpus(250)
+
+    assert sync_unread_ids(FakeGmailService(corpus), cache) == [message["id"] for message in corpus]
+    assert cache.get_state(HISTORY_ID_KEY)
+
+
+@pytest.mark.parametrize("fail_at", [0, 100])
+def test_failed_full_sync_leaves_the_cache_unchanged(cache, fail_at):
+    corpus = generate_corpus(250)
+    cache.replace_unread_ids(["previous"])
+
+    with pytest.raises(HttpError):
+        sync_unread_ids(FailingListService(corpus, 403, fail_at), cache)
+
+    # No history id is stored, so the next run lists the whole label again
+    assert cache.get_state(HISTORY_ID_KEY) is None
+    assert cache.get_unread_ids() == ["previous"]
+    assert sync_unread_ids(FakeGmailService(corpus), cache) == [message["id"] for message in corpus]
+
+
+@pytest.mark.parametrize("status", [403, 503])
+def test_failed_listing_is_raised_instead_of_ending_the_inbox(status):
+    corpus = generate_corpus(250)
+    emails = iter_emails_in_batches(FailingListService(corpus, status, fail_at=100), 1000, fetch_format="metadata")
+
+    # The first page is yielded, the error of the second one ends the iteration
+    fetched = []
+    with pytest.raises(HttpError):
+        for email_data in emails:
+            fetched.append(email_data["message_id"])
+    assert fetched == [message["id"] for message in corpus[:100]]
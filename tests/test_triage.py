@@ -0,0 +1,102 @@
+import json
+import re
+import threading
+from typing import Dict, List, Optional
+
+from utils.triage import CHUNK_SYSTEM_MESSAGE, MARK_AS_READ, READ_FULL_EMAIL, map_reduce_triage
+
+NEWSLETTER = "News <news@shop.example>"
+
+
+def make_emails() -> List[Dict]:
+    emails = []
+    for index in range(7):
+        emails.append({"message_id": f"n{index}", "thread_id": f"t{index}", "from": NEWSLETTER,
+                       "subject": f"Weekly deals #{index}", "snippet": "Up to 50% off"})
+    for index in range(5):
+        emails.append({"message_id": f"p{index}", "thread_id": f"u{index}",
+                       "from": f"Friend {index} <f{index}@mail.example>", "subject": "Dinner on Friday?",
+                       "snippet": "Are you free?"})
+    return emails
+
+
+class StubCompletion:
+    """Stands in for the LLM: newsletters are marked as read, the rest needs the full email."""
+
+    def __init__(self, answers: Optional[Dict[str, str]] = None):
+        self.answers = answers or {}
+        self.prompts: List[List[Dict[str, str]]] = []
+        self._lock = threading.Lock()
+
+    def __call__(self, messages: List[Dict[str, str]]) -> str:
+        with self._lock:
+            self.prompts.append(messages)
+        prompt = messages[-1]["content"]
+        email_ids = re.findall(r"Email ID: (\S+)", prompt)
+        if any(email_id in self.answers for email_id in email_ids):
+            return self.answers[next(email_id for email_id in email_ids if email_id in self.answers)]
+        return json.dumps({"emails": [
+            {"email_id": email_id,
+             "classification": MARK_AS_READ if email_id.startswith("n") else READ_FULL_EMAIL,
+             "reason": "Newsletter" if email_id.startswith("n") else "Personal email"}
+            for email_id in email_ids
+        ]})
+
+
+def test_map_reduce_triage_classifies_every_chunk():
+    emails = make_emails()
+    complete = StubCompletion()
+
+    result = map_reduce_triage(emails, complete, chunk_size=5, max_workers=2)
+
+    assert len(complete.prompts) == 3
+    assert all(prompt[0] == {"role": "system", "content": CHUNK_SYSTEM_MESSAGE} for prompt in complete.prompts)
+    assert set(result.classifications) == {email["message_id"] for email in emails}
+    assert result.classifications["n0"].classification == MARK_AS_READ
+    assert result.classifications["p0"].classification == READ_FULL_EMAIL
+    assert result.unclassified_ids == []
+
+
+def test_map_reduce_triage_suggests_senders_to_mark_as_read_in_bulk():
+    result = map_reduce_triage(make_emails(), StubCompletion(), chunk_size=4)
+
+    assert len(result.bulk_suggestions) == 1
+    suggestion = result.bulk_suggestions[0]
+    assert suggestion.sender == "news@shop.example"
+    assert sorted(suggestion.email_ids) == [f"n{index}" for index in range(7)]
+    assert suggestion.reasons == ["Newsletter"]
+
+
+def test_map_reduce_triage_leaves_failed_chunks_unclassified():
+    emails = make_emails()
+    # Chunks of 5: the chunk of n0 gets an answer that is not JSON, the chunk of n5 to p2 an invalid classification
+    complete = StubCompletion({
+        "n0": "Sorry, I cannot help with that.",
+        "n5": json.dumps({"emails": [{"email_id": "n5", "classification": "Delete"}]}),
+    })
+
+    result = map_reduce_triage(emails, complete, chunk_size=5)
+
+    assert result.unclassified_ids == ["n0", "n1", "n2", "n3", "n4", "n5", "n6", "p0", "p1", "p2"]
+    assert set(result.classifications) == {"p3", "p4"}
+    # A sender only gets a bulk suggestion once all its emails are classified as "Mark as read"
+    assert result.bulk_suggestions == []
+
+
+def test_map_reduce_triage_survives_a_failing_completion():
+    def complete(messages):
+        raise TimeoutError("LLM unavailable")
+
+    result = map_reduce_triage(make_emails(), complete)
+
+    assert result.classifications == {}
+    assert len(result.unclassified_ids) == 12
+
+
+def test_map_reduce_triage_without_emails_does_not_call_the_llm():
+    complete = StubCompletion()
+
+    result = map_reduce_triage([], complete)
+
+    assert complete.prompts == []
+    assert result.classifications == {} and result.unclassified_ids == []
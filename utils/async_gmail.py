@@ -0,0 +1,377 @@
+import asyncio
+import threading
+from typing import IO, Any, Callable, Coroutine, Dict, List, Optional, Tuple, Union
+
+import httpx
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+
+from utils import instrumentation
+from utils.cache import MessageCache
+from utils.email_utils import (
+    METADATA_HEADERS,
+    UPLOAD_CHUNK_SIZE,
+    add_reply_headers,
+    build_draft_body,
+    build_draft_message,
+    get_rfc_message_ids,
+    parse_email_message,
+    parse_thread_messages,
+    print_upload_progress,
+    spool_draft_message,
+)
+from utils.scheduler import (
+    DEFAULT_QUOTA_UNITS,
+    QUOTA_UNITS,
+    RequestScheduler,
+    get_scheduler,
+    is_retryable_error,
+    retries_server_errors,
+)
+
+GMAIL_API_URL = "https://gmail.googleapis.com/gmail/v1/users/me"
+GMAIL_UPLOAD_URL = "https://gmail.googleapis.com/upload/gmail/v1/users/me"
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class AsyncGmailClient:
+    """
+    asyncio-native Gmail client talking to the REST endpoints with httpx.
+
+    All requests share one connection pool (HTTP/2 with keep-alive when the h2 package is
+    installed), so concurrent calls overlap instead of queuing behind each other. Point
+    `base_url` to a local server to run against a fake Gmail API, or pass an httpx `transport`
+    (e.g. httpx.MockTransport) to serve the requests in-process.
+
+    Requests take their quota units from `scheduler` (the scheduler shared with email_utils by
+    default) and rate limited requests are retried with its backoff, as are the server and connection
+    errors of the idempotent ones (see retries_server_errors).
+    """
+
+    def __init__(
+        self,
+        credentials: Optional[Credentials] = None,
+        base_url: str = GMAIL_API_URL,
+        max_connections: int = 20,
+        timeout: float = 60.0,
+        scheduler: Optional[RequestScheduler] = None,
+        upload_url: str = GMAIL_UPLOAD_URL,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.credentials = credentials
+        self.upload_url = upload_url
+        self.scheduler = scheduler or get_scheduler()
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=timeout,
+            transport=transport,
+        )
+        self._refresh_lock = threading.Lock()
+
+    async def __aenter__(self) -> "AsyncGmailClient":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+    async def _auth_headers(self) -> Dict[str, str]:
+        if self.credentials is None:
+            return {}
+        if not self.credentials.valid:
+            # Refreshing is a blocking HTTP call, keep it off the event loop
+            await asyncio.to_thread(self._refresh_credentials)
+        return {"Authorization": f"Bearer {self.credentials.token}"}
+
+    def _refresh_credentials(self) -> None:
+        with self._refresh_lock:
+            if not self.credentials.valid:
+                self.credentials.refresh(Request())
+
+    async def _request(self, method: str, path: str, method_id: str, **kwargs) -> Dict:
+        span = instrumentation.start_span(f"gmail {method_id}", method=method_id)
+        error = None
+        try:
+            return await self._send(method, path, method_id, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if span is not None:
+                instrumentation.observe("gmail_request_seconds", span.end(error), method=method_id)
+
+    async def _send(self, method: str, path: str, method_id: str, **kwargs) -> Dict:
+        response = await self._send_response(method, path, method_id, **kwargs)
+        return response.json() if response.content else {}
+
+    async def _send_response(
+        self,
+        method: str,
+        path: str,
+        method_id: str,
+        headers: Optional[Dict[str, str]] = None,
+        retry_server_errors: Optional[bool] = None,
+        **kwargs,
+    ) -> httpx.Response:
+        units = QUOTA_UNITS.get(method_id, DEFAULT_QUOTA_UNITS)
+        if retry_server_errors is None:
+            retry_server_errors = retries_server_errors(method_id)
+        for attempt in range(self.scheduler.max_retries + 1):
+            delay = self.scheduler.reserve(units)
+            if delay:
+                await asyncio.sleep(delay)
+            try:
+                response = await self._client.request(
+                    method, path, headers={**await self._auth_headers(), **(headers or {})}, **kwargs
+                )
+            except httpx.TransportError as e:
+                # The request may have reached Gmail, so only idempotent ones are sent again
+                if attempt == self.scheduler.max_retries or not retry_server_errors:
+                    raise
+                await asyncio.sleep(self.scheduler.retry_delay(attempt, e))
+                continue
+            try:
+                response.raise_for_status()
+            except httpx.HTTPStatusError as e:
+                if attempt == self.scheduler.max_retries or not is_retryable_error(e, retry_server_errors):
+                    raise
+                await asyncio.sleep(self.scheduler.retry_delay(attempt, e))
+                continue
+            self.scheduler.on_success()
+            instrumentation.increment("gmail_response_bytes_total", len(response.content), method=method_id)
+            return response
+
+    async def _upload_resumable(
+        self,
+        path: str,
+        method_id: str,
+        metadata: Dict,
+        file: IO[bytes],
+        size: int,
+        mimetype: str,
+        on_progress: Optional[Callable[[int, int], None]] = print_upload_progress,
+        chunk_size: int = UPLOAD_CHUNK_SIZE,
+    ) -> Dict:
+        """
+        Uploads `file` with the resumable upload protocol, one chunk in memory at a time.
+
+        A chunk failing with a rate limit, server or connection error is retried with the scheduler's
+        backoff, after asking the server how many bytes it has, so the upload resumes where it stopped.
+        """
+        start = await self._send_response(
+            "POST", self.upload_url + path, method_id, params={"uploadType": "resumable"}, json=metadata,
+            headers={"X-Upload-Content-Type": mimetype, "X-Upload-Content-Length": str(size)},
+            # Starting an upload session creates nothing yet, it is safe to repeat
+            retry_server_errors=True,
+        )
+        session_url = start.headers["Location"]
+        offset = 0
+        attempt = 0
+        query_status = False
+        while True:
+            if query_status:
+                content, content_range = b"", f"bytes */{size}"
+            else:
+                await asyncio.to_thread(file.seek, offset)
+                content = await asyncio.to_thread(file.read, chunk_size)
+                content_range = f"bytes {offset}-{offset + len(content) - 1}/{size}" if content else f"bytes */{size}"
+            try:
+                response = await self._client.put(
+                    session_url, content=content, headers={**await self._auth_headers(), "Content-Range": content_range}
+                )
+            except httpx.TransportError as e:
+                # Part of the chunk may have been received, ask the server where to resume
+                if attempt == self.scheduler.max_retries:
+                    raise
+                await asyncio.sleep(self.scheduler.retry_delay(attempt, e))
+                attempt += 1
+                query_status = True
+                continue
+            if response.status_code in (200, 201):
+                return response.json() if response.content else {}
+            if response.status_code == 308:
+                # The Range header holds the bytes received so far, none if it is missing
+                received = response.headers.get("range")
+                offset = int(received.rsplit("-", 1)[1]) + 1 if received else 0
+                if on_progress is not None and not query_status:
+                    on_progress(offset, size)
+                attempt = 0
+                query_status = False
+                continue
+            try:
+                response.raise_for_status()
+            except httpx.HTTPStatusError as e:
+                if attempt == self.scheduler.max_retries or not is_retryable_error(e):
+                    raise
+                await asyncio.sleep(self.scheduler.retry_delay(attempt, e))
+                attempt += 1
+                query_status = True
+
+    async def fetch_emails(
+        self,
+        page_token: Optional[str],
+        filter_by: Optional[Union[str, List[str]]] = ["UNREAD"],
+    ) -> Tuple[List[Dict[str, Union[str, List[str]]]], Optional[str]]:
+        """Async version of email_utils.fetch_emails."""
+        params = {"labelIds": filter_by if filter_by else []}
+        if page_token:
+            params["pageToken"] = page_token
+        results = await self._request("GET", "/messages", "gmail.users.messages.list", params=params)
+        return results.get("messages", []), results.get("nextPageToken")
+
+    async def parse_email_data(
+        self, message_info: Dict[str, Union[str, List[str]]], format: str = "full"
+    ) -> Dict[str, Union[str, List[str]]]:
+        """Async version of email_utils.parse_email_data."""
+        params = {"format": format}
+        if format == "metadata":
+            params["metadataHeaders"] = METADATA_HEADERS
+        msg = await self._request(
+            "GET", f"/messages/{message_info['id']}", "gmail.users.messages.get", params=params
+        )
+        return parse_email_message(msg, include_body=format == "full")
+
+    async def parse_emails_data(
+        self,
+        message_infos: List[Dict[str, Union[str, List[str]]]],
+        format: str = "full",
+        concurrency: int = 10,
+    ) -> List[Dict[str, Union[str, List[str]]]]:
+        """
+        Fetches and parses several emails concurrently.
+
+        Args:
+            message_infos (List[Dict[str, Union[str, List[str]]]]): Messages as returned by fetch_emails.
+            format (str): "full", or "metadata" for the triage headers only.
+            concurrency (int): Maximum number of requests in flight.
+
+        Returns:
+            List[Dict[str, Union[str, List[str]]]]: Parsed emails, in the same order as `message_infos`.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def parse(message_info):
+            async with semaphore:
+                return await self.parse_email_data(message_info, format)
+
+        emails = await asyncio.gather(*(parse(message_info) for message_info in message_infos))
+        return [email_data for email_data in emails if email_data]
+
+    async def fetch_email_thread(
+        self, thread_id: str, cache: Optional[MessageCache] = None
+    ) -> List[Dict[str, Union[str, List[str]]]]:
+        """Async version of email_utils.fetch_email_thread."""
+        try:
+            history_id = None
+            if cache is not None:
+                minimal = await self._request(
+                    "GET",
+                    f"/threads/{thread_id}",
+                    "gmail.users.threads.get",
+                    params={"format": "minimal", "fields": "historyId"},
+                )
+                history_id = minimal.get("historyId")
+                cached_emails = cache.get_thread(thread_id, history_id)
+                if cached_emails is not None:
+                    return cached_emails
+
+            thread = await self._request(
+                "GET", f"/threads/{thread_id}", "gmail.users.threads.get", params={"format": "full"}
+            )
+            emails = parse_thread_messages(thread)
+            if cache is not None:
+                cache.put_thread(thread_id, thread.get("historyId", history_id), emails)
+            return emails
+        except Exception as e:
+            print(f"Error fetching thread {thread_id}: {e}")
+            return []
+
+    async def create_draft(
+        self,
+        to: Union[str, List[str]],
+        subject: str,
+        body: str,
+        cc: Optional[Union[str, List[str]]] = None,
+        bcc: Optional[Union[str, List[str]]] = None,
+        attachment_paths: Optional[List[str]] = None,
+        thread_id: Optional[str] = None,
+        reply_message_ids: Optional[List[str]] = None,
+    ) -> Dict:
+        """Async version of email_utils.create_draft."""
+        message = build_draft_message(to, subject, body, cc, bcc)
+
+        try:
+            if thread_id:
+                if reply_message_ids is None:
+                    thread = await self._request(
+                        "GET",
+                        f"/threads/{thread_id}",
+                        "gmail.users.threads.get",
+                        params={"format": "metadata", "metadataHeaders": ["Message-ID"]},
+                    )
+                    reply_message_ids = get_rfc_message_ids(thread["messages"])
+                add_reply_headers(message, reply_message_ids)
+
+            if attachment_paths:
+                # Reading attachments is blocking file I/O
+                spool, size = await asyncio.to_thread(spool_draft_message, message, attachment_paths)
+                with spool:
+                    metadata = {"message": {"threadId": thread_id}} if thread_id else {}
+                    draft = await self._upload_resumable(
+                        "/drafts", "gmail.users.drafts.create", metadata, spool, size, "message/rfc822"
+                    )
+            else:
+                draft = await self._request(
+                    "POST", "/drafts", "gmail.users.drafts.create", json=build_draft_body(message, thread_id)
+                )
+            print(f"Draft created with ID: {draft['id']}")
+            return draft
+        except Exception as e:
+            print(f"An error occurred while creating the draft: {e}")
+            return {"error": str(e)}
+
+    async def send_draft(self, draft_id: str) -> Dict:
+        """Async version of email_utils.send_draft."""
+        try:
+            sent_message = await self._request(
+                "POST", "/drafts/send", "gmail.users.drafts.send", json={"id": draft_id}
+            )
+            print(f"Draft with ID {draft_id} sent successfully.")
+            return sent_message
+        except Exception as e:
+            print(f"An error occurred while sending the draft: {e}")
+            return {"error": str(e)}
+
+
+class BackgroundEventLoop:
+    """
+    Runs an event loop in a daemon thread, so synchronous code (such as the agent tools) can
+    share one AsyncGmailClient and its connection pool.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="gmail-async", daemon=True)
+        self._thread.start()
+
+    def submit(self, coroutine: Coroutine):
+        """Schedules a coroutine and returns a concurrent.futures.Future for its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine: Coroutine) -> Any:
+        """Runs a coroutine on the background loop and waits for its result."""
+        return self.submit(coroutine).result()
+
+    def close(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
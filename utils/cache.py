@@ -0,0 +1,241 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Union
+
+from utils.records import EMAIL_FIELDS, EmailRecord
+
+DEFAULT_CACHE_PATH = "email_cache.sqlite3"
+
+# Revision of parse_email_message, bump it whenever the parsed values change (body or HTML
+# conversion, header decoding, ...) without a change of EMAIL_FIELDS
+PARSER_REVISION = 1
+
+# Version of the parsed email data: messages cached with other fields or by another revision are parsed again
+PARSER_VERSION = hashlib.sha256(
+    f"{PARSER_REVISION}:{','.join(EMAIL_FIELDS)}".encode("utf-8")
+).hexdigest()[:16]
+
+
+class MessageCache:
+    """
+    On-disk SQLite cache of parsed emails and threads.
+
+    Gmail messages are immutable apart from their labels, so parsed messages are keyed by message id
+    and only their labels are updated. Threads change whenever a message is added or relabeled, which
+    bumps the thread's historyId, so cached threads are only returned for a matching historyId.
+
+    Several mailboxes (and processes) can share one cache file: each mailbox uses its own `namespace`,
+    which prefixes its message ids, thread ids, unread set and state keys.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, namespace: Optional[str] = None):
+        self.path = path
+        self.namespace = namespace
+        self._prefix = f"{namespace}/" if namespace else ""
+        self._lock = threading.Lock()
+        # Wait for the other processes writing to the same file instead of failing
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS messages (
+                    message_id TEXT PRIMARY KEY,
+                    thread_id TEXT,
+                    history_id TEXT,
+                    data TEXT NOT NULL,
+                    parser_version TEXT
+                );
+                CREATE TABLE IF NOT EXISTS threads (
+                    thread_id TEXT PRIMARY KEY,
+                    history_id TEXT,
+                    data TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS unread (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    message_id TEXT UNIQUE NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                """
+            )
+            # Caches created before the parser version was recorded, their messages are all stale
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(messages)")]
+            if "parser_version" not in columns:
+                try:
+                    self._conn.execute("ALTER TABLE messages ADD COLUMN parser_version TEXT")
+                except sqlite3.OperationalError as e:
+                    # Another process sharing the file added it first
+                    if "duplicate column" not in str(e):
+                        raise
+
+    def _key(self, key: str) -> str:
+        return self._prefix + key
+
+    def _unread_clause(self) -> str:
+        # Gmail ids never contain "/", so ids without a namespace have no "/" at all
+        if self._prefix:
+            return f"substr(message_id, 1, {len(self._prefix)}) = ?"
+        return "instr(message_id, '/') = 0 AND ? = ''"
+
+    def get_messages(self, message_ids: Iterable[str]) -> Dict[str, Dict[str, Union[str, List[str]]]]:
+        """
+        Looks up parsed emails by message id. Emails cached by another version of the parser (see
+        PARSER_VERSION) are treated as missing, so they are fetched and parsed again.
+
+        Args:
+            message_ids (Iterable[str]): Message ids to look up.
+
+        Returns:
+            Dict[str, Dict[str, Union[str, List[str]]]]: Parsed emails keyed by message id, for the ids found in the cache.
+        """
+        message_ids = list(message_ids)
+        found = {}
+        with self._lock:
+            # Stay well below SQLite's limit on the number of bound parameters
+            for start in range(0, len(message_ids), 500):
+                chunk = [self._key(message_id) for message_id in message_ids[start:start + 500]]
+                rows = self._conn.execute(
+                    f"SELECT data FROM messages "
+                    f"WHERE message_id IN ({', '.join('?' * len(chunk))}) AND parser_version = ?",
+                    chunk + [PARSER_VERSION],
+                ).fetchall()
+                for data, in rows:
+                    email_data = EmailRecord(json.loads(data))
+                    found[email_data["message_id"]] = email_data
+        return found
+
+    def get_message(self, message_id: str) -> Optional[Dict[str, Union[str, List[str]]]]:
+        return self.get_messages([message_id]).get(message_id)
+
+    def put_messages(self, emails: Iterable[Dict[str, Union[str, List[str]]]]) -> None:
+        """Stores parsed emails, as returned by parse_email_data."""
+        rows = [
+            (self._key(email_data["message_id"]), self._key(email_data["thread_id"]),
+             email_data.get("history_id"), json.dumps(dict(email_data)), PARSER_VERSION)
+            for email_data in emails
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO messages (message_id, thread_id, history_id, data, parser_version) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def update_labels(
+        self,
+        message_ids: Iterable[str],
+        add_label_ids: Optional[List[str]] = None,
+        remove_label_ids: Optional[List[str]] = None,
+    ) -> None:
+        """
+        Applies a label change to cached emails, keeping them valid without refetching.
+
+        Only the labels of the cached JSON are rewritten, in SQL: the emails are not parsed back into
+        records, which would store their bodies again.
+        """
+        add_label_ids = add_label_ids or []
+        remove_label_ids = remove_label_ids or []
+        message_ids = [self._key(message_id) for message_id in message_ids]
+        with self._lock, self._conn:
+            updates = []
+            for start in range(0, len(message_ids), 500):
+                chunk = message_ids[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT message_id, json_extract(data, '$.labels') FROM messages "
+                    f"WHERE message_id IN ({', '.join('?' * len(chunk))}) AND parser_version = ?",
+                    chunk + [PARSER_VERSION],
+                ).fetchall()
+                for message_id, labels in rows:
+                    labels = [label for label in json.loads(labels or "[]") if label not in remove_label_ids]
+                    labels.extend(label for label in add_label_ids if label not in labels)
+                    updates.append((json.dumps(labels), message_id))
+            self._conn.executemany(
+                "UPDATE messages SET data = json_set(data, '$.labels', json(?)) WHERE message_id = ?", updates
+            )
+
+    def invalidate_messages(self, message_ids: Iterable[str]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM messages WHERE message_id = ?", [(self._key(message_id),) for message_id in message_ids]
+            )
+
+    def get_thread(self, thread_id: str, history_id: Optional[str]) -> Optional[List[Dict[str, Union[str, List[str]]]]]:
+        """
+        Looks up a thread, as returned by fetch_email_thread.
+
+        Args:
+            thread_id (str): The thread ID of the email conversation.
+            history_id (Optional[str]): Current historyId of the thread.
+
+        Returns:
+            Optional[List[Dict[str, Union[str, List[str]]]]]: The cached thread, or None if it is missing or stale.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT history_id, data FROM threads WHERE thread_id = ?", (self._key(thread_id),)
+            ).fetchone()
+        if row is None or history_id is None or row[0] != history_id:
+            return None
+        return json.loads(row[1])
+
+    def put_thread(self, thread_id: str, history_id: Optional[str], emails: List[Dict[str, Union[str, List[str]]]]) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO threads (thread_id, history_id, data) VALUES (?, ?, ?)",
+                (self._key(thread_id), history_id, json.dumps(emails)),
+            )
+
+    def invalidate_threads(self, thread_ids: Iterable[str]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM threads WHERE thread_id = ?", [(self._key(thread_id),) for thread_id in thread_ids]
+            )
+
+    def get_state(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM state WHERE key = ?", (self._key(key),)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key: str, value: Optional[str]) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (self._key(key), value))
+
+    def get_unread_ids(self) -> List[str]:
+        """Returns the locally known unread message ids, newest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT message_id FROM unread WHERE {self._unread_clause()} ORDER BY seq DESC", (self._prefix,)
+            ).fetchall()
+        return [message_id[len(self._prefix):] for message_id, in rows]
+
+    def replace_unread_ids(self, message_ids: List[str]) -> None:
+        """Replaces the local unread set with a full listing, given newest first."""
+        with self._lock, self._conn:
+            self._conn.execute(f"DELETE FROM unread WHERE {self._unread_clause()}", (self._prefix,))
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO unread (message_id) VALUES (?)",
+                [(self._key(message_id),) for message_id in reversed(message_ids)],
+            )
+
+    def add_unread_ids(self, message_ids: Iterable[str]) -> None:
+        """Adds message ids to the local unread set, given oldest first."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO unread (message_id) VALUES (?)",
+                [(self._key(message_id),) for message_id in message_ids],
+            )
+
+    def remove_unread_ids(self, message_ids: Iterable[str]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM unread WHERE message_id = ?", [(self._key(message_id),) for message_id in message_ids]
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
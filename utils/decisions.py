@@ -0,0 +1,146 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, NamedTuple, Union
+
+from utils.cache import DEFAULT_CACHE_PATH
+
+EmailData = Dict[str, Union[str, List[str]]]
+
+# Decisions older than this are classified again
+DEFAULT_DECISION_TTL = 30 * 24 * 3600
+
+# Least recently used decisions beyond this number are evicted
+DEFAULT_MAX_DECISIONS = 10000
+
+# Characters of the body (or snippet) included in the decision key
+BODY_PREFIX_CHARS = 500
+
+
+class Decision(NamedTuple):
+    classification: str
+    summary: str
+    created_at: float
+
+
+def prompt_version(*prompt_parts: str) -> str:
+    """Returns a short hash of the triage instructions and model, changing whenever they do."""
+    return hashlib.sha256("\0".join(prompt_parts).encode("utf-8")).hexdigest()[:16]
+
+
+def decision_key(email_data: EmailData, version: str) -> str:
+    """
+    Content address of a triage decision: a hash of the message id, subject, sender, body prefix and
+    prompt version, so an edited draft, a changed subject or new instructions never reuse a decision.
+    """
+    # The snippet is fetched in both formats, unlike the body which may be loaded later
+    body_prefix = (email_data.get("snippet") or email_data.get("body") or "")[:BODY_PREFIX_CHARS]
+    content = json.dumps(
+        [email_data["message_id"], email_data.get("subject"), email_data.get("from"), body_prefix, version]
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class DecisionCache:
+    """
+    On-disk SQLite cache of the triage agent's decisions, so emails that stay unread are not
+    classified again at every run.
+
+    Decisions expire after `ttl` seconds, and the least recently used ones are evicted beyond
+    `max_entries`. Decisions made with other triage instructions are deleted by `invalidate`.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_PATH,
+        ttl: float = DEFAULT_DECISION_TTL,
+        max_entries: int = DEFAULT_MAX_DECISIONS,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # Shared with the MessageCache and the batch triage processes, see MessageCache
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS decisions (
+                    key TEXT PRIMARY KEY,
+                    message_id TEXT NOT NULL,
+                    prompt_version TEXT NOT NULL,
+                    classification TEXT NOT NULL,
+                    summary TEXT,
+                    created_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS decisions_last_used_at ON decisions (last_used_at);
+                """
+            )
+
+    def get_decisions(self, emails: Iterable[EmailData], version: str) -> Dict[str, Decision]:
+        """
+        Looks up the decisions of emails, and marks them as recently used.
+
+        Args:
+            emails (Iterable[EmailData]): Parsed emails.
+            version (str): Current prompt version, see prompt_version.
+
+        Returns:
+            Dict[str, Decision]: Decisions keyed by message id, for the emails with a fresh decision.
+        """
+        keys = {decision_key(email_data, version): email_data["message_id"] for email_data in emails}
+        key_list = list(keys)
+        now = time.time()
+        found = {}
+        with self._lock, self._conn:
+            # Stay well below SQLite's limit on the number of bound parameters
+            for start in range(0, len(key_list), 500):
+                chunk = key_list[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, classification, summary, created_at FROM decisions "
+                    f"WHERE key IN ({', '.join('?' * len(chunk))}) AND created_at >= ?",
+                    chunk + [now - self.ttl],
+                ).fetchall()
+                found.update((key, Decision(classification, summary or "", created_at))
+                             for key, classification, summary, created_at in rows)
+            self._conn.executemany(
+                "UPDATE decisions SET last_used_at = ? WHERE key = ?", [(now, key) for key in found]
+            )
+        return {keys[key]: decision for key, decision in found.items()}
+
+    def put_decision(self, email_data: EmailData, version: str, classification: str, summary: str = "") -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO decisions "
+                "(key, message_id, prompt_version, classification, summary, created_at, last_used_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (decision_key(email_data, version), email_data["message_id"], version, classification, summary,
+                 now, now),
+            )
+
+    def invalidate(self, version: str) -> int:
+        """Deletes the decisions of other prompt versions, returns how many were deleted."""
+        with self._lock, self._conn:
+            return self._conn.execute("DELETE FROM decisions WHERE prompt_version != ?", (version,)).rowcount
+
+    def evict(self) -> int:
+        """Deletes the expired decisions and the least recently used ones beyond max_entries."""
+        with self._lock, self._conn:
+            deleted = self._conn.execute(
+                "DELETE FROM decisions WHERE created_at < ?", (time.time() - self.ttl,)
+            ).rowcount
+            deleted += self._conn.execute(
+                "DELETE FROM decisions WHERE key IN "
+                "(SELECT key FROM decisions ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+        return deleted
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -1,26 +1,72 @@
-from bs4 import BeautifulSoup
 from googleapiclient.discovery import Resource
 import base64
+import functools
+import json
 import os
-from typing import Dict, List, Optional, Union, Tuple
+from typing import TYPE_CHECKING, Dict, List, Optional, Union, Tuple
 from collections import defaultdict
-from googleapiclient.discovery import build, Resource
-from google_auth_oauthlib.flow import InstalledAppFlow
+from googleapiclient.discovery import build, build_from_document, Resource
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from datetime import datetime
-import email.mime.text
-import email.mime.multipart
-import email.mime.application
-import mimetypes
+import re
+import tempfile
+import time
+import uuid
+from googleapiclient.errors import HttpError
+
+from utils.cache import MessageCache
+from utils.html_text import html_to_text
+from utils.instrumentation import traced
+from utils.records import EmailRecord
+from utils.scheduler import (
+    error_response,
+    execute_request,
+    get_scheduler,
+    instrument_request,
+    is_retryable_error,
+    request_units,
+)
+from utils.senders import parse_sender
+
+if TYPE_CHECKING:
+    from email.mime.multipart import MIMEMultipart
 
 # several functions are adapted from https://github.com/Tylerbryy/zinbo/blob/main/src/gmail_service.py
 
 SCOPES = ["https://mail.google.com/"]
 
+# Maximum number of calls the Gmail API accepts in a single batch request
+MAX_BATCH_SIZE = 100
 
+# Maximum number of message ids accepted by a single batchModify request
+MAX_BATCH_MODIFY_SIZE = 1000
+
+# batchModify errors that some of the ids can cause, the failed chunk is split to isolate them
+SPLITTABLE_ERROR_STATUSES = (400, 404)
+
+CHARSET_REGEX = re.compile(r'charset="?([^";\s]+)"?', re.IGNORECASE)
+
+# Drafts with attachments are uploaded in chunks of this size (a multiple of 256 KiB, as the API requires)
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Largest message accepted by drafts.create, attachments included after their base64 encoding (35 MB)
+MAX_DRAFT_UPLOAD_SIZE = 36700160
+
+# MIME messages of drafts are kept in memory up to this size, and spooled to a temporary file beyond
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# Attachments are read and base64-encoded in blocks of this size: a multiple of 57 bytes, so each block
+# encodes to whole 76-character lines
+ATTACHMENT_READ_SIZE = 57 * 1024
+
+# Headers requested when fetching messages with format="metadata"
+METADATA_HEADERS = ["Subject", "From", "To", "Cc", "List-Id", "List-Unsubscribe", "Precedence"]
+
+
+@traced("gmail_call_seconds")
 def get_user_email(gmail: Resource) -> str:
-    profile = gmail.users().getProfile(userId="me").execute()
+    profile = execute_request(gmail.users().getProfile(userId="me"))
     return profile.get("emailAddress", "")
 
 
@@ -33,46 +79,28 @@ def extract_email_body_and_attachments(
     Extracts and decodes the email body, preferring 'text/plain' but falling back to 'text/html' if needed.
     Also extracts attachment filenames.
 
+    The MIME tree is walked recursively, so bodies nested in multipart containers (e.g. multipart/alternative
+    inside multipart/mixed) and single-part messages are found. Only the selected body part is decoded,
+    using the charset from its Content-Type header; attachment payloads are never decoded.
+
     Args:
-        parts (List[Dict[str, Union[str, Dict]]]): List of email parts from Gmail API.
-        strip_html (bool): If True, removes HTML tags and returns plain text.
+        parts (List[Dict[str, Union[str, Dict]]]): List of email parts from Gmail API, e.g. [message["payload"]].
+        strip_html (bool): If True, converts an HTML body to plain text (see html_text.html_to_text).
         exclude_prev_msg (bool): If True, removes previous messages from the body (usually prefixed with '>').
 
     Returns:
         Tuple[str, List[str]]: Decoded email body and a list of attachment filenames.
     """
-    body = ""
-    attachments = []
-    for part in parts:
-        mime_type = part.get("mimeType", "")
-        filename = part.get("filename", "")
-        data = part.get("body", {}).get("data", "")
-
-        # Extract plain text or HTML body
-        if data:
-            try:
-                decoded_body = base64.urlsafe_b64decode(data.encode("ASCII")).decode(
-                    "utf-8"
-                )
-
-                if mime_type == "text/plain" and not body:  # Prefer plain text
-                    body = decoded_body
-                elif (
-                    mime_type == "text/html" and not body
-                ):  # Use HTML if no plain text is found
-                    body = decoded_body
-            except Exception as decode_error:
-                print(f"Failed to decode email body: {decode_error}")
+    plain_part, html_part, attachments = find_body_parts(parts)
 
-        # Extract attachments
-        if filename:
-            if "body" in part and "attachmentId" in part["body"]:
-                attachments.append(filename)
+    body = ""
+    body_part = plain_part or html_part
+    if body_part is not None:
+        body = decode_part_body(body_part)
 
     # Convert HTML to plain text if strip_html=True
-    if strip_html and body:
-        soup = BeautifulSoup(body, "html.parser")
-        body = soup.get_text(separator="\n").strip()
+    if strip_html and body and body_part is html_part:
+        body = html_to_text(body)
 
     # Remove previous messages in the thread (if exclude_prev_msg=True)
     if exclude_prev_msg and body:
@@ -87,8 +115,75 @@ def extract_email_body_and_attachments(
     return body, attachments
 
 
+def find_body_parts(
+    parts: List[Dict[str, Union[str, Dict]]],
+) -> Tuple[Optional[Dict], Optional[Dict], List[str]]:
+    """
+    Walks a MIME tree depth-first, without decoding anything.
+
+    Args:
+        parts (List[Dict[str, Union[str, Dict]]]): List of email parts from Gmail API.
+
+    Returns:
+        Tuple[Optional[Dict], Optional[Dict], List[str]]: The first 'text/plain' part with data, the first
+        'text/html' part with data, and the attachment filenames.
+    """
+    plain_part = None
+    html_part = None
+    attachments = []
+    stack = list(reversed(parts))
+    while stack:
+        part = stack.pop()
+        mime_type = part.get("mimeType", "")
+        filename = part.get("filename", "")
+        part_body = part.get("body", {})
+
+        if mime_type.startswith("multipart/"):
+            stack.extend(reversed(part.get("parts", [])))
+            continue
+
+        # Extract attachments
+        if filename:
+            if "attachmentId" in part_body:
+                attachments.append(filename)
+            continue
+
+        if not part_body.get("data"):
+            continue
+        if mime_type == "text/plain" and plain_part is None:  # Prefer plain text
+            plain_part = part
+        elif mime_type == "text/html" and html_part is None:  # Use HTML if no plain text is found
+            html_part = part
+
+    return plain_part, html_part, attachments
+
+
+def decode_part_body(part: Dict[str, Union[str, Dict]]) -> str:
+    """Decodes the base64url body data of a MIME part, using the charset declared in its headers."""
+    charset = "utf-8"
+    content_type = next(
+        (header["value"] for header in part.get("headers", []) if header["name"].lower() == "content-type"),
+        "",
+    )
+    match = CHARSET_REGEX.search(content_type)
+    if match:
+        charset = match.group(1)
+
+    try:
+        data = base64.urlsafe_b64decode(part["body"]["data"].encode("ASCII"))
+    except Exception as decode_error:
+        print(f"Failed to decode email body: {decode_error}")
+        return ""
+    try:
+        return data.decode(charset, errors="replace")
+    except LookupError:
+        # Unknown charset name
+        return data.decode("utf-8", errors="replace")
+
+
+@traced("gmail_call_seconds")
 def fetch_email_thread(
-    gmail: Resource, thread_id: str
+    gmail: Resource, thread_id: str, cache: Optional[MessageCache] = None
 ) -> List[Dict[str, Union[str, List[str]]]]:
     """
     Fetches all emails in a thread given a thread ID.
@@ -96,104 +191,172 @@ def fetch_email_thread(
     Args:
         gmail (Resource): Gmail API service instance.
         thread_id (str): The thread ID of the email conversation.
+        cache (Optional[MessageCache]): If set, the thread is only downloaded when its historyId changed.
 
     Returns:
         List[Dict[str, Union[str, List[str]]]]: List of email messages in the thread.
     """
     try:
+        history_id = None
+        if cache is not None:
+            # A minimal request is enough to tell whether the cached thread is still current
+            history_id = execute_request(
+                gmail.users()
+                .threads()
+                .get(userId="me", id=thread_id, format="minimal", fields="historyId")
+            ).get("historyId")
+            cached_emails = cache.get_thread(thread_id, history_id)
+            if cached_emails is not None:
+                return cached_emails
+
         # Fetch the full thread details
-        thread = (
+        thread = execute_request(
             gmail.users()
             .threads()
             .get(userId="me", id=thread_id, format="full")
-            .execute()
         )
 
-        emails = []
-        for message in thread.get("messages", []):
-            email_data = {
-                "message_id": message["id"],
-                "thread_id": message["threadId"],
-                "subject": next(
-                    (
-                        header["value"]
-                        for header in message["payload"]["headers"]
-                        if header["name"] == "Subject"
-                    ),
-                    "No Subject",
+        emails = parse_thread_messages(thread)
+
+        if cache is not None:
+            cache.put_thread(thread_id, thread.get("historyId", history_id), emails)
+        return emails
+
+    except Exception as e:
+        print(f"Error fetching thread {thread_id}: {e}")
+        return []
+
+
+def parse_thread_messages(thread: Dict) -> List[Dict[str, Union[str, List[str]]]]:
+    """
+    Parses the messages of a thread resource fetched with format="full".
+
+    Args:
+        thread (Dict): Thread resource returned by the Gmail API.
+
+    Returns:
+        List[Dict[str, Union[str, List[str]]]]: List of email messages in the thread.
+    """
+    emails = []
+    for message in thread.get("messages", []):
+        email_data = {
+            "message_id": message["id"],
+            "thread_id": message["threadId"],
+            "subject": next(
+                (
+                    header["value"]
+                    for header in message["payload"]["headers"]
+                    if header["name"] == "Subject"
                 ),
-                "from": next(
-                    (
-                        header["value"]
-                        for header in message["payload"]["headers"]
-                        if header["name"] == "From"
-                    ),
-                    "Unknown",
+                "No Subject",
+            ),
+            "from": next(
+                (
+                    header["value"]
+                    for header in message["payload"]["headers"]
+                    if header["name"] == "From"
                 ),
-                "to": next(
-                    (
-                        header["value"]
-                        for header in message["payload"]["headers"]
-                        if header["name"] == "To"
-                    ),
-                    "Unknown",
+                "Unknown",
+            ),
+            "to": next(
+                (
+                    header["value"]
+                    for header in message["payload"]["headers"]
+                    if header["name"] == "To"
                 ),
-                "date": next(
-                    (
-                        header["value"]
-                        for header in message["payload"]["headers"]
-                        if header["name"] == "Date"
-                    ),
-                    "Unknown",
+                "Unknown",
+            ),
+            "date": next(
+                (
+                    header["value"]
+                    for header in message["payload"]["headers"]
+                    if header["name"] == "Date"
                 ),
-                "body": "",
-                "attachments": [],
-            }
-
-            # Extract the email body (text/plain only)
-            parts = message.get("payload", {}).get("parts", [])
-            body, attachments = extract_email_body_and_attachments(
-                parts, strip_html=True, exclude_prev_msg=True
-            )
-            email_data["body"] = body
-            if len(attachments) > 0:
-                email_data["attachments"] = attachments
+                "Unknown",
+            ),
+            "rfc_message_id": next(
+                (
+                    header["value"]
+                    for header in message["payload"]["headers"]
+                    if header["name"].lower() == "message-id"
+                ),
+                None,
+            ),
+            "body": "",
+            "attachments": [],
+        }
 
-            emails.append(email_data)
+        # Extract the email body, preferring text/plain
+        parts = [message.get("payload", {})]
+        body, attachments = extract_email_body_and_attachments(
+            parts, strip_html=True, exclude_prev_msg=True
+        )
+        email_data["body"] = body
+        if len(attachments) > 0:
+            email_data["attachments"] = attachments
 
-        return emails
+        emails.append(email_data)
 
-    except Exception as e:
-        print(f"Error fetching thread {thread_id}: {e}")
-        return []
+    return emails
 
 
+@traced("gmail_call_seconds")
 def fetch_emails(
     gmail: Resource,
     page_token: Optional[str],
     filter_by: Optional[Union[str, List[str]]] = ["UNREAD"],
 ) -> Tuple[List[Dict[str, Union[str, List[str]]]], Optional[str]]:
-    try:
-        results = (
-            gmail.users()
-            .messages()
-            .list(
-                userId="me",
-                labelIds=filter_by if filter_by else [],
-                pageToken=page_token,  # Include the page token in the request if there is one
-            )
-            .execute()
-        )
-    except Exception as e:
-        print(f"Failed to fetch emails: {e}")
-        return [], None
+    """
+    Lists one page of messages with the given labels.
 
+    Returns:
+        Tuple[List[Dict[str, Union[str, List[str]]]], Optional[str]]: Message ids and thread ids, and the
+        token of the next page.
+
+    Raises:
+        Exception: The error of the request, once the scheduler gave up retrying it. An empty page would
+            silently end the listing early.
+    """
+    results = execute_request(list_messages_request(gmail, page_token, filter_by))
     messages: List[Dict[str, Union[str, List[str]]]
                    ] = results.get("messages", [])
     page_token = results.get("nextPageToken")
     return messages, page_token
 
 
+@traced("gmail_call_seconds")
+def fetch_history(
+    gmail: Resource,
+    start_history_id: str,
+    page_token: Optional[str] = None,
+) -> Tuple[List[Dict], Optional[str], Optional[str]]:
+    """
+    Fetches one page of mailbox changes since a history id.
+
+    Args:
+        gmail (Resource): Gmail API service instance.
+        start_history_id (str): History id to list changes from.
+        page_token (Optional[str]): Token of the page to fetch.
+
+    Returns:
+        Tuple[List[Dict], Optional[str], Optional[str]]: History records, next page token and the mailbox's current history id.
+
+    Raises:
+        HttpError: With status 404 if `start_history_id` is too old and a full sync is needed.
+    """
+    results = execute_request(
+        gmail.users()
+        .history()
+        .list(
+            userId="me",
+            startHistoryId=start_history_id,
+            historyTypes=["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"],
+            pageToken=page_token,
+        )
+    )
+    return results.get("history", []), results.get("nextPageToken"), results.get("historyId")
+
+
 def convert_timestamp_to_local(timestamp_ms):
     """
     Convert a Unix timestamp in milliseconds to local time.
@@ -216,42 +379,128 @@ def convert_timestamp_to_local(timestamp_ms):
     return formatted_time
 
 
-def get_gmail_service():
+@functools.lru_cache(maxsize=None)
+def load_discovery_document(api: str = "gmail", version: str = "v1") -> Dict:
+    """
+    Returns the discovery document of an API, parsed once per process.
+
+    The document is read from the static copy bundled with google-api-python-client instead of
+    being downloaded, so building a service needs no network round trip.
+    """
+    from googleapiclient import discovery_cache
+
+    # Older versions of google-api-python-client have no static documents
+    get_static_doc = getattr(discovery_cache, "get_static_doc", None)
+    document = get_static_doc(api, version) if get_static_doc else None
+    if document is None:
+        raise ValueError(f"No static discovery document for {api} {version}")
+    return json.loads(document)
+
+
+def get_gmail_service(token_path: str = "token.json", credentials_path: str = "credentials.json",
+                      interactive: bool = True, credentials: Optional[Credentials] = None):
+    if credentials is None:
+        credentials = get_gmail_credentials(token_path, credentials_path, interactive)
+    try:
+        document = load_discovery_document()
+    except ValueError:
+        return build("gmail", "v1", credentials=credentials)
+    return build_from_document(document, credentials=credentials)
+
+
+def get_gmail_credentials(token_path: str = "token.json", credentials_path: str = "credentials.json",
+                          interactive: bool = True) -> Credentials:
+    """
+    Loads the credentials of one Gmail account, refreshing or creating its token when needed.
+
+    Args:
+        token_path (str): File storing the account's access and refresh tokens.
+        credentials_path (str): OAuth client secrets, used when the account must log in.
+        interactive (bool): If False, raise instead of opening the browser to log in, for batch runs.
+
+    Returns:
+        Credentials: Valid credentials of the account.
+    """
     creds = None
-    # The file token.json stores the user's access and refresh tokens, and is
+    # The token file stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first time.
-    if os.path.exists("token.json"):
-        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+    if os.path.exists(token_path):
+        creds = Credentials.from_authorized_user_file(token_path, SCOPES)
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
+        elif not interactive:
+            raise RuntimeError(f"No valid token in {token_path}, log in once interactively to create it")
         else:
+            # Only needed the first time an account logs in
+            from google_auth_oauthlib.flow import InstalledAppFlow
+
             flow = InstalledAppFlow.from_client_secrets_file(
-                "credentials.json", SCOPES)
+                credentials_path, SCOPES)
             creds = flow.run_local_server(port=0)
         # Save the credentials for the next run
-        with open("token.json", "w") as token:
+        with open(token_path, "w") as token:
             token.write(creds.to_json())
 
-    return build("gmail", "v1", credentials=creds)
+    return creds
 
 
+def list_messages_request(gmail: Resource, page_token: Optional[str], filter_by: Optional[Union[str, List[str]]]):
+    """Builds a messages.list request for one page of the messages with the given labels."""
+    return gmail.users().messages().list(
+        userId="me",
+        labelIds=filter_by if filter_by else [],
+        pageToken=page_token,  # Include the page token in the request if there is one
+    )
+
+
+def get_message_request(gmail: Resource, message_id: str, format: str = "full"):
+    """
+    Builds a messages.get request.
+
+    Args:
+        gmail (Resource): Gmail API service instance.
+        message_id (str): Id of the message to fetch.
+        format (str): "full" for the whole message, or "metadata" for the triage headers only.
+
+    Returns:
+        HttpRequest: The request, not executed yet.
+    """
+    if format == "metadata":
+        return gmail.users().messages().get(
+            userId="me", id=message_id, format="metadata", metadataHeaders=METADATA_HEADERS
+        )
+    return gmail.users().messages().get(userId="me", id=message_id, format=format)
+
+
+@traced("gmail_call_seconds")
 def parse_email_data(
-    gmail, message_info: Dict[str, Union[str, List[str]]]
+    gmail, message_info: Dict[str, Union[str, List[str]]], format: str = "full"
 ) -> Dict[str, Union[str, List[str]]]:
-    """Fetches and parses email data, including subject, sender, body, and attachments."""
-    try:
-        msg = (
-            gmail.users()
-            .messages()
-            .get(userId="me", id=message_info["id"], format="full")
-            .execute()
-        )
-    except Exception as e:
-        print(f"Failed to fetch email data: {e}")
-        return {}
+    """
+    Fetches and parses email data, including subject, sender, body, and attachments.
+
+    Raises:
+        Exception: The error of the request, once the scheduler gave up retrying it.
+    """
+    msg = execute_request(get_message_request(gmail, message_info["id"], format))
+    return parse_email_message(msg, include_body=format == "full")
+
 
+def parse_email_message(msg: Dict, include_body: bool = True) -> Union[EmailRecord, Dict]:
+    """
+    Parses a message resource returned by the Gmail API into the email data, an EmailRecord.
+    Changing the parsed values requires bumping cache.PARSER_REVISION, so cached emails are parsed again.
+
+    Args:
+        msg (Dict): Message resource fetched with format="full", or format="metadata".
+        include_body (bool): If False, the message was fetched without its body: "body" and
+            "attachments" are left to None until load_email_body is called.
+
+    Returns:
+        Union[EmailRecord, Dict]: Parsed email data, or an empty dict if the headers are malformed.
+    """
     try:
         headers = msg["payload"]["headers"]
         subject = next(
@@ -265,21 +514,26 @@ def parse_email_data(
             (header["value"]
              for header in headers if header["name"] == "Cc"), None
         )
+        # Headers whose name case varies between senders
+        other_headers = {header["name"].lower(): header["value"] for header in headers}
         msg_id = msg["id"]
         thread_id = msg["threadId"]
-        receive_time = convert_timestamp_to_local(int(msg["internalDate"]))
+        internal_date = int(msg["internalDate"])
+        receive_time = convert_timestamp_to_local(internal_date)
     except Exception as e:
         print(f"Failed to parse email headers: {e}")
         return {}
 
     # Extract the plain text body
-    parts = msg["payload"].get("parts", [])
-    body, attachments = extract_email_body_and_attachments(
-        parts, strip_html=True, exclude_prev_msg=False
-    )
+    body, attachments = None, None
+    if include_body:
+        parts = [msg["payload"]]
+        body, attachments = extract_email_body_and_attachments(
+            parts, strip_html=True, exclude_prev_msg=False
+        )
 
-    # Parse email data
-    email_data_parsed: Dict[str, Union[str, List[str]]] = {
+    # Parse email data, the body goes to the body store
+    return EmailRecord({
         "message_id": msg_id,
         "thread_id": thread_id,
         "subject": subject,
@@ -287,12 +541,141 @@ def parse_email_data(
         "from": sender,
         "cc": cc,
         "received_time": receive_time,
+        "internal_date": internal_date,  # Milliseconds since the epoch
+        "list_id": other_headers.get("list-id"),
+        "list_unsubscribe": other_headers.get("list-unsubscribe"),
+        "precedence": other_headers.get("precedence"),
         "labels": msg.get("labelIds", []),
+        "history_id": msg.get("historyId"),
+        "snippet": msg.get("snippet"),
         "body": body,
         "attachments": attachments,  # List of attachment filenames
-    }
+    })
+
+
+@traced("gmail_call_seconds")
+def load_email_body(
+    gmail: Resource,
+    email_data: Dict[str, Union[str, List[str]]],
+    cache: Optional[MessageCache] = None,
+) -> str:
+    """
+    Returns the body of a parsed email, fetching it first if it was parsed from metadata only.
+
+    The body and attachments are stored in `email_data` (and in the cache, if given), so each
+    body is downloaded at most once.
+
+    Args:
+        gmail (Resource): Gmail API service instance.
+        email_data (Dict[str, Union[str, List[str]]]): Parsed email data.
+        cache (Optional[MessageCache]): Cache to update with the loaded body.
+
+    Returns:
+        str: The email body, or an empty string if the message could not be parsed.
+
+    Raises:
+        Exception: The error of the request, if the body could not be fetched.
+    """
+    if email_data.get("body") is not None:
+        return email_data["body"]
 
-    return email_data_parsed
+    full_email = parse_email_data(gmail, {"id": email_data["message_id"]})
+    if not full_email:
+        return ""
+    email_data["body"] = full_email["body"]
+    email_data["attachments"] = full_email["attachments"]
+    if cache is not None:
+        cache.put_messages([email_data])
+    return email_data["body"]
+
+
+@traced("gmail_call_seconds")
+def batch_parse_email_data(
+    gmail: Resource,
+    message_infos: List[Dict[str, Union[str, List[str]]]],
+    batch_size: int = MAX_BATCH_SIZE,
+    max_retries: int = 3,
+    format: str = "full",
+) -> List[Dict[str, Union[str, List[str]]]]:
+    """
+    Fetches and parses several emails using Gmail batch HTTP requests.
+
+    Each batch carries up to `batch_size` messages.get calls in a single HTTP request,
+    paced to the quota by the shared RequestScheduler. Failures are isolated per message:
+    sub-requests that were rate limited or hit a server error are retried (with the
+    scheduler's backoff) up to `max_retries` times, any other failure only drops the
+    affected message.
+
+    Args:
+        gmail (Resource): Gmail API service instance.
+        message_infos (List[Dict[str, Union[str, List[str]]]]): Messages as returned by fetch_emails.
+        batch_size (int): Number of messages.get calls per batch request (max 100).
+        max_retries (int): Number of retry rounds for failed sub-requests.
+        format (str): "full", or "metadata" to leave the bodies for load_email_body.
+
+    Returns:
+        List[Dict[str, Union[str, List[str]]]]: Parsed emails, in the same order as `message_infos`.
+    """
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    message_ids = [message_info["id"] for message_info in message_infos]
+    fetched: Dict[str, Dict] = {}
+    pending = list(dict.fromkeys(message_ids))
+    scheduler = get_scheduler()
+    last_error = None
+
+    for attempt in range(max_retries + 1):
+        if attempt:
+            time.sleep(scheduler.retry_delay(attempt - 1, last_error))
+        retry = []
+
+        def callback(request_id, response, exception):
+            nonlocal last_error
+            if exception is None:
+                fetched[request_id] = response
+            elif is_retryable_error(exception):
+                last_error = exception
+                retry.append(request_id)
+            else:
+                print(f"Failed to fetch email data for {request_id}: {exception}")
+
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+            batch = gmail.new_batch_http_request(callback=callback)
+            units = 0
+            for message_id in chunk:
+                request = get_message_request(gmail, message_id, format)
+                instrument_request(request)
+                units += request_units(request)
+                batch.add(request, request_id=message_id)
+            try:
+                scheduler.execute_batch(batch, units)
+            except Exception as e:
+                if isinstance(e, HttpError) and not is_retryable_error(e):
+                    print(f"Failed to fetch email batch: {e}")
+                    continue
+                # The whole batch failed: retry the sub-requests without a response
+                print(f"Email batch failed, will retry: {e}")
+                last_error = e
+                retry.extend(
+                    message_id for message_id in chunk
+                    if message_id not in fetched and message_id not in retry
+                )
+
+        pending = retry
+        if not pending:
+            break
+    else:
+        for message_id in pending:
+            print(f"Giving up on email {message_id} after {max_retries} retries")
+
+    emails = []
+    for message_id in message_ids:
+        if message_id in fetched:
+            email_data = parse_email_message(
+                fetched[message_id], include_body=format == "full")
+            if email_data:
+                emails.append(email_data)
+    return emails
 
 
 def group_emails_by_sender(
@@ -301,6 +684,8 @@ def group_emails_by_sender(
     """
     Groups emails by sender email.
 
+    Senders are normalized to their lowercased address, so 'News <a@x.com>' and 'a@x.com' are one group.
+
     Args:
         email_list (List[Dict[str, Union[str, List[str]]]]): List of parsed email data.
 
@@ -314,48 +699,100 @@ def group_emails_by_sender(
         sender = email_data.get(
             "from", "Unknown Sender"
         )  # Default to 'Unknown Sender' if missing
-        grouped_emails[sender].append(email_data)
-    # print(f"Grouped emails {dict(grouped_emails)}")
+        grouped_emails[parse_sender(sender).address].append(email_data)
     return dict(grouped_emails)
 
 
+@traced("gmail_call_seconds")
 def mark_email_as_read(gmail_service, message_id):
     """Marks an email as read by removing the 'UNREAD' label."""
     try:
-        gmail_service.users().messages().modify(
+        execute_request(gmail_service.users().messages().modify(
             userId="me", id=message_id, body={"removeLabelIds": ["UNREAD"]}
-        ).execute()
+        ))
         return f"Email {message_id} marked as read."
     except Exception as e:
         return f"Failed to mark email as read: {e}"
 
 
-def create_draft(
+@traced("gmail_call_seconds")
+def batch_modify_labels(
     gmail_service: Resource,
-    to: Union[str, List[str]],
-    subject: str,
-    body: str,
-    cc: Optional[Union[str, List[str]]] = None,
-    bcc: Optional[Union[str, List[str]]] = None,
-    attachment_paths: Optional[List[str]] = None,
-    thread_id: Optional[str] = None
-) -> Dict:
+    message_ids: List[str],
+    add_label_ids: Optional[List[str]] = None,
+    remove_label_ids: Optional[List[str]] = None,
+    chunk_size: int = MAX_BATCH_MODIFY_SIZE,
+) -> List[Dict[str, Union[bool, str, List[str]]]]:
     """
-    Creates a draft email in Gmail.
+    Adds and removes labels on many messages with users.messages.batchModify.
+
+    Messages are sent in chunks of up to `chunk_size` ids per request. A chunk rejected because of
+    an invalid or missing id (400 or 404) is split in two and each half is retried, down to single
+    messages, so one bad id does not fail the others. Other errors fail the whole chunk.
 
     Args:
         gmail_service (Resource): Gmail API service instance.
-        to (Union[str, List[str]]): Email address(es) of the recipient(s).
-        subject (str): Email subject.
-        body (str): Plain text body of the email.
-        cc (Optional[Union[str, List[str]]]): Email address(es) to CC.
-        bcc (Optional[Union[str, List[str]]]): Email address(es) to BCC.
-        attachment_paths (Optional[List[str]]): List of file paths to attach.
-        thread_id (Optional[str]): Thread ID to add this draft to (for replies).
+        message_ids (List[str]): Ids of the messages to modify.
+        add_label_ids (Optional[List[str]]): Label ids to add.
+        remove_label_ids (Optional[List[str]]): Label ids to remove.
+        chunk_size (int): Number of ids per request (max 1000).
 
     Returns:
-        Dict: Response from the Gmail API containing the created draft information.
+        List[Dict[str, Union[bool, str, List[str]]]]: One result per request that succeeded, or per message that
+        failed, with the keys "message_ids", "success" and "error".
     """
+    chunk_size = max(1, min(chunk_size, MAX_BATCH_MODIFY_SIZE))
+    body = {}
+    if add_label_ids:
+        body["addLabelIds"] = add_label_ids
+    if remove_label_ids:
+        body["removeLabelIds"] = remove_label_ids
+
+    results = []
+
+    def modify(chunk: List[str]) -> None:
+        try:
+            execute_request(gmail_service.users().messages().batchModify(
+                userId="me", body={"ids": chunk, **body}
+            ))
+            results.append({"message_ids": chunk, "success": True, "error": None})
+        except Exception as e:
+            # Only an invalid or missing id fails a whole chunk because of some of its messages: auth,
+            # quota and server errors would fail every half too, and the scheduler already retried them
+            status, _, _ = error_response(e)
+            if len(chunk) == 1 or status not in SPLITTABLE_ERROR_STATUSES:
+                results.append({"message_ids": chunk, "success": False, "error": str(e)})
+                return
+            middle = len(chunk) // 2
+            modify(chunk[:middle])
+            modify(chunk[middle:])
+
+    for start in range(0, len(message_ids), chunk_size):
+        modify(message_ids[start:start + chunk_size])
+    return results
+
+
+def mark_emails_as_read(
+    gmail_service: Resource, message_ids: List[str]
+) -> List[Dict[str, Union[bool, str, List[str]]]]:
+    """Marks several emails as read by removing the 'UNREAD' label, see batch_modify_labels."""
+    return batch_modify_labels(gmail_service, message_ids, remove_label_ids=["UNREAD"])
+
+
+def build_draft_message(
+    to: Union[str, List[str]],
+    subject: str,
+    body: str,
+    cc: Optional[Union[str, List[str]]] = None,
+    bcc: Optional[Union[str, List[str]]] = None,
+    attachment_paths: Optional[List[str]] = None,
+) -> "MIMEMultipart":
+    """Builds the MIME message of a draft, see create_draft for the arguments."""
+    # The MIME builders are only needed to draft emails, not at startup
+    import email.mime.application
+    import email.mime.multipart
+    import email.mime.text
+
     # Create a multipart message
     message = email.mime.multipart.MIMEMultipart("alternative")
 
@@ -386,12 +823,7 @@ def create_draft(
                 print(f"Warning: Attachment {file_path} not found, skipping")
                 continue
 
-            # Guess the content type based on the file's extension
-            content_type, encoding = mimetypes.guess_type(file_path)
-            if content_type is None or encoding is not None:
-                content_type = 'application/octet-stream'  # Default type
-
-            main_type, sub_type = content_type.split('/', 1)
+            main_type, sub_type = attachment_content_type(file_path)
 
             with open(file_path, 'rb') as file:
                 attachment = email.mime.application.MIMEApplication(
@@ -405,33 +837,161 @@ def create_draft(
                                   'attachment', filename=filename)
             message.attach(attachment)
 
-    if thread_id:
-        thread = gmail_service.users().threads().get(
-            userId="me", id=thread_id, format="full").execute()
-
-        last_msg = thread["messages"][-1]
-        reply_to_message_id = next(
-            (h["value"] for h in last_msg["payload"]
-             ["headers"] if h["name"] == "Message-ID"),
-            None)
-
-        references = []
-        for msg in thread["messages"]:
-            mid = next((h["value"] for h in msg["payload"]
-                       ["headers"] if h["name"] == "Message-ID"), None)
-            if mid:
-                references.append(mid)
-
-        if reply_to_message_id:
-            if not reply_to_message_id.startswith('<'):
-                reply_to_message_id = f'<{reply_to_message_id}>'
-            message["In-Reply-To"] = reply_to_message_id
-
-        if references:
-            refs_fixed = [f'<{ref.strip("<>")}>' if not ref.startswith(
-                '<') else ref for ref in references]
-            message["References"] = " ".join(refs_fixed)
+    return message
+
 
+def attachment_content_type(file_path: str) -> Tuple[str, str]:
+    """Guesses the main and sub content type of an attachment from its file extension."""
+    import mimetypes
+
+    content_type, encoding = mimetypes.guess_type(file_path)
+    if content_type is None or encoding is not None:
+        content_type = 'application/octet-stream'  # Default type
+    main_type, sub_type = content_type.split('/', 1)
+    return main_type, sub_type
+
+
+def spool_draft_message(message: "MIMEMultipart", attachment_paths: List[str]) -> Tuple[tempfile.SpooledTemporaryFile, int]:
+    """
+    Writes a draft's MIME message with its attachments to a spooled temporary file, for a resumable upload.
+
+    Unlike build_draft_message, the attachments are never loaded whole: each one is read and
+    base64-encoded block by block straight into the file, which stays in memory up to SPOOL_MAX_SIZE
+    and moves to disk beyond.
+
+    Args:
+        message (email.mime.multipart.MIMEMultipart): The draft without attachments, see build_draft_message.
+        attachment_paths (List[str]): List of file paths to attach.
+
+    Returns:
+        Tuple[tempfile.SpooledTemporaryFile, int]: The file, positioned at its start, and its size in bytes.
+
+    Raises:
+        ValueError: If the message is larger than Gmail accepts, before anything is uploaded.
+    """
+    import email.mime.base
+
+    boundary = f"==============={uuid.uuid4().hex}=="
+    message.set_boundary(boundary)
+    closing = f"--{boundary}--".encode()
+    head = message.as_bytes()
+
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    # The headers and body of the message, the attachments are added before the closing boundary
+    spool.write(head[:head.rindex(closing)])
+    for file_path in attachment_paths:
+        if not os.path.isfile(file_path):
+            print(f"Warning: Attachment {file_path} not found, skipping")
+            continue
+
+        part = email.mime.base.MIMEBase(*attachment_content_type(file_path))
+        part["Content-Transfer-Encoding"] = "base64"
+        part.add_header('Content-Disposition', 'attachment', filename=os.path.basename(file_path))
+        spool.write(f"--{boundary}\n".encode())
+        # Only the headers: the part has no payload yet
+        spool.write(part.as_bytes())
+        with open(file_path, 'rb') as file:
+            while block := file.read(ATTACHMENT_READ_SIZE):
+                spool.write(base64.encodebytes(block))
+        spool.write(b"\n")
+    spool.write(closing + b"\n")
+
+    size = spool.tell()
+    if size > MAX_DRAFT_UPLOAD_SIZE:
+        spool.close()
+        raise ValueError(f"The draft takes {size} bytes with its attachments encoded, "
+                         f"above Gmail's limit of {MAX_DRAFT_UPLOAD_SIZE} bytes")
+    spool.seek(0)
+    return spool, size
+
+
+def print_upload_progress(uploaded: int, total: int) -> None:
+    print(f"Uploaded {uploaded / total if total else 1:.0%} of the draft ({uploaded} of {total} bytes)")
+
+
+def execute_resumable(request, on_progress=print_upload_progress) -> Dict:
+    """
+    Uploads the media of a googleapiclient HttpRequest in chunks, within the quota of the shared scheduler.
+
+    A chunk failing with a rate limit or server error is retried with the scheduler's backoff; the
+    upload then resumes from the last byte the server acknowledged instead of starting over.
+
+    Args:
+        request (HttpRequest): A request with a resumable media_body.
+        on_progress (Callable[[int, int], None]): Called with the bytes uploaded so far and the total
+            size after each chunk, None to disable.
+
+    Returns:
+        Dict: The response of the request.
+    """
+    scheduler = get_scheduler()
+    scheduler.acquire(request_units(request))
+    response = None
+    attempt = 0
+    while response is None:
+        try:
+            status, response = request.next_chunk()
+        except HttpError as e:
+            if attempt == scheduler.max_retries or not is_retryable_error(e):
+                raise
+            time.sleep(scheduler.retry_delay(attempt, e))
+            attempt += 1
+            continue
+        attempt = 0
+        if status is not None and on_progress is not None:
+            on_progress(status.resumable_progress, status.total_size)
+    scheduler.on_success()
+    return response
+
+
+def get_rfc_message_ids(thread_messages: List[Dict]) -> List[str]:
+    """Returns the Message-ID headers of the message resources of a thread, in thread order."""
+    message_ids = []
+    for msg in thread_messages:
+        mid = next((h["value"] for h in msg["payload"]["headers"]
+                    if h["name"].lower() == "message-id"), None)
+        if mid:
+            message_ids.append(mid)
+    return message_ids
+
+
+@traced("gmail_call_seconds")
+def fetch_reply_message_ids(gmail_service: Resource, thread_id: str) -> List[str]:
+    """
+    Fetches the Message-ID headers of a thread, without downloading the message bodies.
+
+    Args:
+        gmail_service (Resource): Gmail API service instance.
+        thread_id (str): The thread ID of the email conversation.
+
+    Returns:
+        List[str]: The Message-ID headers, in thread order.
+    """
+    thread = execute_request(gmail_service.users().threads().get(
+        userId="me", id=thread_id, format="metadata", metadataHeaders=["Message-ID"]))
+    return get_rfc_message_ids(thread["messages"])
+
+
+def add_reply_headers(message: "MIMEMultipart", references: List[str]) -> None:
+    """
+    Sets the In-Reply-To and References headers of a reply from the Message-IDs of its thread.
+
+    Args:
+        message (email.mime.multipart.MIMEMultipart): The reply being drafted.
+        references (List[str]): Message-ID headers of the thread, in thread order.
+    """
+    if not references:
+        return
+
+    refs_fixed = [f'<{ref.strip("<>")}>' if not ref.startswith(
+        '<') else ref for ref in references]
+    message["In-Reply-To"] = refs_fixed[-1]
+    message["References"] = " ".join(refs_fixed)
+
+
+def build_draft_body(message: "MIMEMultipart", thread_id: Optional[str] = None) -> Dict:
+    """Builds the request body of drafts.create for a MIME message."""
+    if thread_id:
         draft_body = {
             'message': {
                 'threadId': thread_id
@@ -444,13 +1004,69 @@ def create_draft(
 
     encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
     draft_body['message']['raw'] = encoded_message
+    return draft_body
+
+
+@traced("gmail_call_seconds")
+def create_draft(
+    gmail_service: Resource,
+    to: Union[str, List[str]],
+    subject: str,
+    body: str,
+    cc: Optional[Union[str, List[str]]] = None,
+    bcc: Optional[Union[str, List[str]]] = None,
+    attachment_paths: Optional[List[str]] = None,
+    thread_id: Optional[str] = None,
+    reply_message_ids: Optional[List[str]] = None,
+) -> Dict:
+    """
+    Creates a draft email in Gmail.
+
+    Args:
+        gmail_service (Resource): Gmail API service instance.
+        to (Union[str, List[str]]): Email address(es) of the recipient(s).
+        subject (str): Email subject.
+        body (str): Plain text body of the email.
+        cc (Optional[Union[str, List[str]]]): Email address(es) to CC.
+        bcc (Optional[Union[str, List[str]]]): Email address(es) to BCC.
+        attachment_paths (Optional[List[str]]): List of file paths to attach, sent in a resumable upload
+            of the whole message (see spool_draft_message), so large files are never held in memory.
+        thread_id (Optional[str]): Thread ID to add this draft to (for replies).
+        reply_message_ids (Optional[List[str]]): Message-ID headers of the thread, e.g. the "rfc_message_id"
+            of the emails returned by fetch_email_thread. Fetched from the thread's metadata if not given.
+
+    Returns:
+        Dict: Response from the Gmail API containing the created draft information.
+    """
+    # Attachments are streamed in a resumable upload instead of being inlined in the request body
+    message = build_draft_message(to, subject, body, cc, bcc)
 
     try:
-        # Create the draft
-        draft = gmail_service.users().drafts().create(
-            userId="me",
-            body=draft_body
-        ).execute()
+        if thread_id:
+            if reply_message_ids is None:
+                reply_message_ids = fetch_reply_message_ids(gmail_service, thread_id)
+            add_reply_headers(message, reply_message_ids)
+
+        if attachment_paths:
+            from googleapiclient.http import MediaIoBaseUpload
+
+            spool, _ = spool_draft_message(message, attachment_paths)
+            with spool:
+                media = MediaIoBaseUpload(spool, mimetype="message/rfc822", chunksize=UPLOAD_CHUNK_SIZE,
+                                          resumable=True)
+                draft = execute_resumable(gmail_service.users().drafts().create(
+                    userId="me",
+                    body={"message": {"threadId": thread_id}} if thread_id else {},
+                    media_body=media,
+                ))
+        else:
+            draft_body = build_draft_body(message, thread_id)
+
+            # Create the draft
+            draft = execute_request(gmail_service.users().drafts().create(
+                userId="me",
+                body=draft_body
+            ))
 
         print(f"Draft created with ID: {draft['id']}")
         return draft
@@ -459,6 +1075,7 @@ def create_draft(
         return {"error": str(e)}
 
 
+@traced("gmail_call_seconds")
 def send_draft(gmail_service: Resource, draft_id: str) -> Dict:
     """
     Sends an existing draft email in Gmail.
@@ -472,10 +1089,10 @@ def send_draft(gmail_service: Resource, draft_id: str) -> Dict:
     """
     try:
         # Send the draft
-        sent_message = gmail_service.users().drafts().send(
+        sent_message = execute_request(gmail_service.users().drafts().send(
             userId="me",
             body={"id": draft_id}
-        ).execute()
+        ))
 
         print(f"Draft with ID {draft_id} sent successfully.")
         return sent_message
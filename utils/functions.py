@@ -1,11 +1,26 @@
 
-import re
-from autogen import config_list_from_json
+import importlib
+import threading
+from concurrent.futures import Executor, Future
+from typing import Tuple
 
-from utils.email_utils import fetch_emails, get_gmail_service, get_user_email, parse_email_data
+from utils.email_utils import (
+    MAX_BATCH_SIZE,
+    batch_parse_email_data,
+    fetch_emails,
+    get_gmail_credentials,
+    get_gmail_service,
+    get_user_email,
+)
+from utils.senders import parse_sender
+from utils.ingestion import ingest_messages
+from utils.sync import sync_unread_ids
 
 
 def get_llm_config():
+    # autogen takes most of the startup time, it is only imported once the LLM is needed
+    from autogen import config_list_from_json
+
     config_list = config_list_from_json(
         "OAI_CONFIG_LIST",
         filter_dict={"model": ["gpt-4o-mini"]},
@@ -14,22 +29,80 @@ def get_llm_config():
     return llm_config
 
 
-def get_gmail_info():
+def get_gmail_info(executor: Executor) -> Tuple[Future, object, object]:
     # -------------- Connect to Google Email --------------
-    # Get the Gmail service (this will prompt you to authenticate if needed)
-    gmail_service = get_gmail_service()
+    # Get the Gmail credentials (this will prompt you to authenticate if needed)
+    credentials = get_gmail_credentials()
+    # The discovery document is read from the local static copy, building the service costs no round trip
+    gmail_service = get_gmail_service(credentials=credentials)
     print(f"Got gmail_service: {gmail_service}")
 
-    # Get the logged-in user's email address
-    user_email = get_user_email(gmail_service)
-    print(f"Logged in as: {user_email}")
+    # The logged-in user's email address is fetched on its own connection while the mailbox is listed
+    user_email = executor.submit(lambda: get_user_email(get_gmail_service(credentials=credentials)))
+    user_email.add_done_callback(
+        lambda future: print(f"Logged in as: {future.result()}") if not future.exception() else None)
+
+    return user_email, gmail_service, credentials
+
+
+def preload_modules(*module_names: str) -> threading.Thread:
+    """
+    Imports modules in a background thread, e.g. the agent framework while the mailbox is fetched.
+    Importing one of them from another thread waits until it is loaded.
+    """
+    def load():
+        for module_name in module_names:
+            importlib.import_module(module_name)
+
+    thread = threading.Thread(target=load, name="preload", daemon=True)
+    thread.start()
+    return thread
+
+
+def fetch_all_emails(gmail_service, max_unread_emails_limit, service_factory=None, concurrency=8, cache=None,
+                     incremental_sync=False, fetch_format="full", verbose=True):
+    unread_emails = list(iter_unread_emails(
+        gmail_service, max_unread_emails_limit, service_factory, concurrency, cache, incremental_sync, fetch_format
+    ))
+
+    for idx, ue in enumerate(unread_emails if verbose else []):
+        print(
+            f"Unread email {idx + 1} from {ue['from']}: thread_id {ue['thread_id']}, message_id {ue['message_id']}, subject {ue['subject']} body {(ue['body'] or '')[:10]}")
+
+    return unread_emails
+
 
-    return user_email, gmail_service
+def iter_unread_emails(gmail_service, max_unread_emails_limit, service_factory=None, concurrency=8, cache=None,
+                       incremental_sync=False, fetch_format="full", page_size=MAX_BATCH_SIZE):
+    """
+    Yields the parsed unread emails as they are fetched, one page of `page_size` at a time, so the
+    first emails can be triaged while the next pages are still loading. See fetch_all_emails for
+    the arguments.
+    """
+    if incremental_sync and cache is not None:
+        # Only the changes since the last run are listed, the unread set is kept in the cache
+        unread_ids = sync_unread_ids(gmail_service, cache)[:max_unread_emails_limit]
+        for start in range(0, len(unread_ids), page_size):
+            yield from fetch_messages(
+                gmail_service, [{"id": message_id} for message_id in unread_ids[start:start + page_size]], cache,
+                fetch_format)
+    elif service_factory is not None:
+        # Pipelined ingestion: listing, fetching and parsing overlap across threads
+        yield from ingest_messages(
+            service_factory,
+            max_messages=max_unread_emails_limit,
+            filter_by=['UNREAD'],
+            concurrency=concurrency,
+            cache=cache,
+            format=fetch_format,
+        )
+    else:
+        yield from iter_emails_in_batches(gmail_service, max_unread_emails_limit, cache, fetch_format)
 
 
-def fetch_all_emails(gmail_service, max_unread_emails_limit):
-    # Loop through pages to fetch all unread emails
-    unread_emails = []
+def iter_emails_in_batches(gmail_service, max_unread_emails_limit, cache=None, fetch_format="full"):
+    # Loop through pages to fetch all unread emails, yielding each page once it is fetched
+    fetched = 0
     page_token = None
 
     while True:
@@ -39,58 +112,195 @@ def fetch_all_emails(gmail_service, max_unread_emails_limit):
         if not messages:
             break
 
-        for msg in messages:
-            email_data = parse_email_data(gmail_service, msg)
-            if email_data:
-                unread_emails.append(email_data)
-            if len(unread_emails) >= max_unread_emails_limit:
-                break
-        if not page_token or len(unread_emails) >= max_unread_emails_limit:
+        remaining = max_unread_emails_limit - fetched
+        for email_data in fetch_messages(gmail_service, messages[:remaining], cache, fetch_format):
+            fetched += 1
+            yield email_data
+        if not page_token or fetched >= max_unread_emails_limit:
             break
-    u_emails = {
-        ue["from"]: {
-            "message_id": ue["message_id"],
-            "thread_id": ue["thread_id"],
-            "subject": ue["subject"],
-            "body": ue["body"][:10]
-        }
-        for ue in unread_emails
-    }
-    for idx, (f, info) in enumerate(u_emails.items()):
-        print(
-            f"Unread email {idx + 1} from {f}: thread_id {info['thread_id']}, message_id {info['message_id']}, subject {info['subject']} body {info['body']}")
 
-    return unread_emails
+
+def fetch_messages(gmail_service, messages, cache=None, fetch_format="full"):
+    # Look up the listed unread messages in the cache, and fetch the others
+    cached_emails = cache.get_messages(msg["id"] for msg in messages) if cache else {}
+    for email_data in cached_emails.values():
+        # The message was listed as unread, whatever the cached labels say
+        if "UNREAD" not in email_data["labels"]:
+            email_data["labels"].append("UNREAD")
+
+    # Fetch in batch requests instead of one round trip per message
+    fetched_emails = batch_parse_email_data(
+        gmail_service, [msg for msg in messages if msg["id"] not in cached_emails], format=fetch_format
+    )
+    if cache:
+        cache.put_messages(fetched_emails)
+
+    emails_by_id = {**cached_emails, **{ue["message_id"]: ue for ue in fetched_emails}}
+    return [emails_by_id[msg["id"]] for msg in messages if msg["id"] in emails_by_id]
 
 
 def sort_and_trim_emails(grouped_emails):
-    sorted_grouped_emails_tuple = sorted(
-        grouped_emails.items(), key=lambda x: len(x[1]), reverse=True
+    # Senders are already normalized to their address, see group_emails_by_sender and ContextBuilder
+    return dict(sorted(grouped_emails.items(), key=lambda x: len(x[1]), reverse=True))
+
+
+# Default size of the emails context put in the triage agent's system message
+DEFAULT_CONTEXT_TOKEN_BUDGET = 4000
+
+# Share of the budget kept for the one-line summaries of the emails that do not fit
+SUMMARY_BUDGET_SHARE = 0.2
+
+
+def estimate_tokens(text):
+    # About four characters per token for English text with the OpenAI tokenizers
+    return len(text) // 4 + 1
+
+
+def format_email_context(email):
+    return (
+        f"Email ID: {email['message_id']}\n"
+        f"Thread ID: {email['thread_id']}\n"
+        f"From: {email['from']}\n"
+        f"Subject: {email['subject']}\n"
+    )
+
+
+def format_sender_summary(sender, emails, max_subjects=3):
+    subjects = "; ".join(email["subject"] for email in emails[:max_subjects])
+    if len(emails) > max_subjects:
+        subjects += "; ..."
+    return f"{len(emails)} mails from {sender}, subjects: {subjects}\n"
+
+
+def format_decision_context(email, decision):
+    return (
+        f"Email ID: {email['message_id']} | From: {email['from']} | Subject: {email['subject']} | "
+        f"{decision.classification}: {decision.summary}\n"
+    )
+
+
+def format_preclassified_header(count):
+    return (
+        f"{count} more emails were pre-classified as bulk mail (newsletters, promotions, "
+        f"notifications) to mark as read, use get_preclassified_emails to review them.\n"
     )
 
-    email_regex = re.compile(r'<([^>]+)>')
 
-    sorted_grouped_emails = {}
+TRIAGED_HEADER = "Emails already triaged in a previous run, do not classify them again:\n"
+
+
+class ContextBuilder:
+    """
+    Assembles the emails context of the triage agent one email at a time, see get_context.
+
+    Adding an email costs O(1): it is listed while it fits in the budget, otherwise it joins the
+    per-sender groups summarized at the end. The context can be rendered at any point, so it can
+    follow a stream of emails instead of waiting for the whole inbox.
+    """
+
+    def __init__(self, token_budget=DEFAULT_CONTEXT_TOKEN_BUDGET, decisions=None):
+        self.token_budget = token_budget
+        self.summary_budget = int(token_budget * SUMMARY_BUDGET_SHARE)
+        self.decisions = decisions if decisions is not None else {}
+        self.used_tokens = 0
+        self.entries = []
+        self.triaged_entries = []
+        # Emails not listed individually, and the same grouped by normalized sender address
+        self.overflow = []
+        self.overflow_by_sender = {}
+        self.preclassified = []
+        self._overflowing = False
+        self._triaged_overflowing = False
+        self._triaged_header_counted = False
+
+    def add_preclassified(self, emails):
+        if emails and not self.preclassified:
+            self.used_tokens += estimate_tokens(format_preclassified_header(len(emails)))
+        self.preclassified.extend(emails)
+
+    def add(self, email):
+        decision = self.decisions.get(email["message_id"])
+        if decision is None:
+            entry = format_email_context(email) + "\n"
+            overflowing = self._overflowing
+        else:
+            # Emails with a cached decision take one line each, after the emails still to classify
+            if not self._triaged_header_counted:
+                self.used_tokens += estimate_tokens(TRIAGED_HEADER)
+                self._triaged_header_counted = True
+            entry = format_decision_context(email, decision)
+            overflowing = self._triaged_overflowing
+        tokens = estimate_tokens(entry)
+        if overflowing or self.used_tokens + tokens > self.token_budget - self.summary_budget:
+            if decision is None:
+                self._overflowing = True
+            else:
+                self._triaged_overflowing = True
+            self.overflow.append(email)
+            self.overflow_by_sender.setdefault(parse_sender(email.get("from", "Unknown Sender")).address, []).append(email)
+            return
+        (self.entries if decision is None else self.triaged_entries).append(entry)
+        self.used_tokens += tokens
+
+    def add_all(self, emails):
+        for email in emails:
+            self.add(email)
+
+    def context_text(self):
+        entries = list(self.entries)
+        if self.triaged_entries:
+            entries.append(TRIAGED_HEADER)
+            entries.extend(self.triaged_entries)
+
+        if self.overflow:
+            header = f"{len(self.overflow)} more emails are not listed individually, use get_more_emails to list them.\n"
+            used_tokens = self.used_tokens + estimate_tokens(header)
+            entries.append(header)
+            for sender, emails in sort_and_trim_emails(self.overflow_by_sender).items():
+                summary = format_sender_summary(sender, emails)
+                tokens = estimate_tokens(summary)
+                if used_tokens + tokens > self.token_budget:
+                    break
+                entries.append(summary)
+                used_tokens += tokens
+
+        if self.preclassified:
+            entries.append(format_preclassified_header(len(self.preclassified)))
+        return "".join(entries)
+
+    def context_variables(self):
+        return {
+            "user_emails_context": f"""Here is what you know about the user's email details: {self.context_text()}
+    """,
+            "omitted_email_ids": [email["message_id"] for email in self.overflow],
+            "preclassified_email_ids": [email["message_id"] for email in self.preclassified],
+        }
 
-    for sender, emails in sorted_grouped_emails_tuple:
-        match = email_regex.search(sender)
-        stripped_sender = match.group(1) if match else sender
-        sorted_grouped_emails[stripped_sender] = emails
 
-    # print(f"Sorted_grouped_emails: {sorted_grouped_emails}")
+def get_context(unread_emails, token_budget=DEFAULT_CONTEXT_TOKEN_BUDGET, preclassified_emails=(), decisions=None):
+    """
+    Builds the emails context of the triage agent within a token budget.
 
-    return sorted_grouped_emails
+    Emails are listed one by one while they fit in the budget. The emails that do not fit are
+    summarized in one line per sender, largest groups first, as long as the summaries fit too.
 
+    Args:
+        unread_emails: Parsed unread emails, in order of priority.
+        token_budget: Estimated maximum number of tokens of the context.
+        preclassified_emails: Emails already flagged as bulk mail by the pre-classifier, only counted
+            in the context.
+        decisions: Cached triage decisions by message id (see utils/decisions.py), listed in one line
+            per email instead of being classified again.
 
-def get_context(unread_emails):
-    context = ""
-    for email in unread_emails:
-        context += f"Email ID: {email['message_id']}\n"
-        context += f"Thread ID: {email['thread_id']}\n"
-        context += f"From: {email['from']}\n"
-        context += f"Subject: {email['subject']}\n"
-        context += "\n"
-    context_variables = {
-        "user_emails_context": f"""Here is what you know about the user's email details: {context}
-    """}
-    return context_variables
+    Returns:
+        The context variables: "user_emails_context" with the context text, "omitted_email_ids"
+        with the ids of the emails that are not listed individually, to be paged with a tool call,
+        and "preclassified_email_ids".
+    """
+    decisions = decisions or {}
+    builder = ContextBuilder(token_budget, decisions)
+    builder.add_preclassified(list(preclassified_emails))
+    # The emails still to classify get the budget first
+    builder.add_all(email for email in unread_emails if email["message_id"] not in decisions)
+    builder.add_all(email for email in unread_emails if email["message_id"] in decisions)
+    return builder.context_variables()
@@ -0,0 +1,150 @@
+import html as html_lib
+import re
+from typing import Callable, Dict, Optional
+
+from utils.instrumentation import traced
+
+# HTML larger than this is truncated before conversion: past this size, marketing mails are
+# mostly markup and the text beyond it is rarely useful for triage
+DEFAULT_MAX_HTML_CHARS = 512 * 1024
+
+# Elements whose content is never visible text
+SKIPPED_ELEMENTS = ("script", "style", "head", "title", "noscript", "template")
+
+# Elements that start a new line in the extracted text
+BLOCK_ELEMENTS = frozenset((
+    "address", "article", "aside", "blockquote", "br", "center", "dd", "div", "dl", "dt", "footer",
+    "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr", "li", "main", "nav", "ol", "p",
+    "pre", "section", "table", "tbody", "td", "tfoot", "th", "thead", "tr", "ul",
+))
+
+TAG_REGEX = re.compile(r"<!--.*?-->|<!\[CDATA\[.*?\]\]>|<[!?][^>]*>|<(/?)([a-zA-Z][a-zA-Z0-9]*)(?:\s[^>]*)?/?>", re.S)
+SKIPPED_END_REGEXES = {
+    name: re.compile(rf"</{name}\s*>", re.I) for name in SKIPPED_ELEMENTS
+}
+HORIZONTAL_SPACE_REGEX = re.compile(r"[^\S\n]+")
+NEWLINES_REGEX = re.compile(r"\s*\n\s*")
+XML_DECLARATION_REGEX = re.compile(r"^\s*<\?xml[^>]*\?>", re.I)
+
+
+def tokenizer_html_to_text(html: str) -> str:
+    """
+    Converts HTML to text with a single regex scan, without building a document tree.
+
+    Text between tags is kept, script/style/head content is dropped, block elements become
+    line breaks, entities are unescaped and whitespace is collapsed.
+    """
+    chunks = []
+    position = 0
+    length = len(html)
+    while position < length:
+        match = TAG_REGEX.search(html, position)
+        if match is None:
+            chunks.append(html[position:])
+            break
+        chunks.append(html[position:match.start()])
+        position = match.end()
+
+        name = match.group(2)
+        if name is None:
+            # Comment, doctype, CDATA or processing instruction
+            continue
+        name = name.lower()
+        if name in BLOCK_ELEMENTS:
+            chunks.append("\n")
+        elif not match.group(1) and name in SKIPPED_END_REGEXES:
+            # Jump straight past the matching end tag
+            end = SKIPPED_END_REGEXES[name].search(html, position)
+            if end:
+                position = end.end()
+            elif name != "head":
+                # Unclosed script or style: browsers treat the rest of the document as its content
+                position = length
+
+    return collapse_whitespace(html_lib.unescape("".join(chunks)))
+
+
+def lxml_html_to_text(html: str) -> str:
+    """
+    Converts HTML to text with lxml, much faster than BeautifulSoup on large documents.
+
+    HTML that lxml rejects (empty documents, only whitespace or comments) is converted by the tokenizer instead.
+    """
+    import lxml.etree
+    import lxml.html
+
+    # lxml refuses str input with an encoding declaration, common in newsletters
+    html = XML_DECLARATION_REGEX.sub("", html, count=1)
+    try:
+        document = lxml.html.fromstring(html)
+    except (lxml.etree.ParserError, ValueError):
+        return tokenizer_html_to_text(html)
+    for element in list(document.iter(*SKIPPED_ELEMENTS)):
+        element.drop_tree()
+    return collapse_whitespace("\n".join(document.itertext()))
+
+
+def bs4_html_to_text(html: str) -> str:
+    """Converts HTML to text with BeautifulSoup and the pure-Python html.parser."""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "html.parser")
+    return soup.get_text(separator="\n").strip()
+
+
+def collapse_whitespace(text: str) -> str:
+    text = HORIZONTAL_SPACE_REGEX.sub(" ", text)
+    return NEWLINES_REGEX.sub("\n", text).strip()
+
+
+HTML_TEXT_ENGINES: Dict[str, Callable[[str], str]] = {
+    "tokenizer": tokenizer_html_to_text,
+    "lxml": lxml_html_to_text,
+    "bs4": bs4_html_to_text,
+}
+
+_default_engine = "tokenizer"
+
+
+def lxml_available() -> bool:
+    try:
+        import lxml.html  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def set_html_engine(engine: str) -> None:
+    """
+    Sets the engine used by html_to_text when none is given.
+
+    Args:
+        engine (str): "tokenizer" (default), "lxml" (requires the lxml package), "bs4" (BeautifulSoup),
+            or "auto" to use lxml when it is installed and the tokenizer otherwise.
+    """
+    global _default_engine
+    if engine == "auto":
+        engine = "lxml" if lxml_available() else "tokenizer"
+    if engine not in HTML_TEXT_ENGINES:
+        raise ValueError(f"Unknown HTML engine {engine}, expected one of {', '.join(HTML_TEXT_ENGINES)}")
+    if engine == "lxml" and not lxml_available():
+        raise ValueError("The lxml HTML engine requires the lxml package")
+    _default_engine = engine
+
+
+@traced("html_to_text_seconds")
+def html_to_text(html: str, engine: Optional[str] = None, max_chars: Optional[int] = DEFAULT_MAX_HTML_CHARS) -> str:
+    """
+    Converts an HTML email body to plain text.
+
+    Args:
+        html (str): The HTML to convert.
+        engine (Optional[str]): One of HTML_TEXT_ENGINES, defaults to the engine set with set_html_engine.
+        max_chars (Optional[int]): HTML beyond this many characters is ignored, None to convert everything.
+
+    Returns:
+        str: The visible text of the HTML.
+    """
+    if max_chars is not None and len(html) > max_chars:
+        html = html[:max_chars]
+    return HTML_TEXT_ENGINES[engine or _default_engine](html)
@@ -0,0 +1,212 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Union
+
+from googleapiclient.discovery import Resource
+
+from utils.cache import MessageCache
+from utils.email_utils import get_message_request, list_messages_request, parse_email_message
+from utils.scheduler import execute_request
+
+# Marks the end of the listing stage in the message queue
+_END_OF_LISTING = object()
+
+
+def ingest_messages(
+    service_factory: Callable[[], Resource],
+    max_messages: Optional[int] = None,
+    filter_by: Optional[Union[str, List[str]]] = ["UNREAD"],
+    concurrency: int = 8,
+    max_in_flight: Optional[int] = None,
+    cache: Optional[MessageCache] = None,
+    format: str = "full",
+) -> Iterator[Dict[str, Union[str, List[str]]]]:
+    """
+    Pipelined ingestion of messages: list, fetch and parse run as overlapping stages.
+
+    - A listing thread pages through messages().list and feeds message ids into a bounded queue,
+      so page N+1 is listed while the messages of page N are still being fetched.
+    - A pool of `concurrency` worker threads runs messages().get. httplib2 is not thread-safe,
+      so every worker (and the listing thread) builds its own service with `service_factory`.
+      The workers share the quota of the scheduler in utils/scheduler.py.
+    - The calling thread parses the fetched messages, yielding them in listing order.
+
+    At most `max_in_flight` messages are queued or being fetched at any time, which bounds memory
+    regardless of the mailbox size.
+
+    Args:
+        service_factory (Callable[[], Resource]): Builds a new Gmail API service instance.
+        max_messages (Optional[int]): Stop after this many messages have been listed.
+        filter_by (Optional[Union[str, List[str]]]): Label ids to list.
+        concurrency (int): Number of worker threads running messages().get.
+        max_in_flight (Optional[int]): Maximum number of listed but not yet parsed messages.
+            Defaults to four times `concurrency`.
+        cache (Optional[MessageCache]): If set, cached messages are not fetched again and new ones are stored.
+        format (str): "full", or "metadata" to leave the bodies for load_email_body.
+
+    Yields:
+        Dict[str, Union[str, List[str]]]: Parsed email data, in the order the messages were listed.
+
+    Raises:
+        Exception: The error of the listing thread (building its service or listing a page, once the
+            scheduler gave up retrying), after the messages listed before it are yielded.
+    """
+    concurrency = max(1, concurrency)
+    max_in_flight = max_in_flight or 4 * concurrency
+    message_queue: queue.Queue = queue.Queue(maxsize=max_in_flight)
+    stop = threading.Event()
+    local = threading.local()
+
+    def put(item) -> bool:
+        # Block while the queue is full, but give up as soon as the consumer stops
+        while not stop.is_set():
+            try:
+                message_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    # Error of the listing thread, raised by the consumer instead of ending with a truncated inbox
+    listing_error: Optional[Exception] = None
+
+    def list_messages():
+        nonlocal listing_error
+        listed = 0
+        page_token = None
+        try:
+            gmail = service_factory()
+            while not stop.is_set():
+                results = execute_request(list_messages_request(gmail, page_token, filter_by))
+                messages, page_token = results.get("messages", []), results.get("nextPageToken")
+                for message_info in messages:
+                    if max_messages is not None and listed >= max_messages:
+                        return
+                    if not put(message_info):
+                        return
+                    listed += 1
+                if not messages or not page_token:
+                    return
+        except Exception as e:
+            listing_error = e
+        finally:
+            put(_END_OF_LISTING)
+
+    def fetch_message(message_info: Dict) -> Optional[Dict]:
+        if not hasattr(local, "gmail"):
+            local.gmail = service_factory()
+        try:
+            return execute_request(get_message_request(local.gmail, message_info["id"], format))
+        except Exception as e:
+            print(f"Failed to fetch email data: {e}")
+            return None
+
+    lister = threading.Thread(target=list_messages, name="gmail-lister", daemon=True)
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="gmail-fetch")
+    in_flight = deque()
+
+    def parse_next() -> Optional[Dict]:
+        cached_email, future = in_flight.popleft()
+        if cached_email is not None:
+            return cached_email
+        msg = future.result()
+        if not msg:
+            return None
+        email_data = parse_email_message(msg, include_body=format == "full")
+        if cache is not None and email_data:
+            cache.put_messages([email_data])
+        return email_data
+
+    lister.start()
+    try:
+        while True:
+            message_info = message_queue.get()
+            if message_info is _END_OF_LISTING:
+                break
+            cached_email = cache.get_message(message_info["id"]) if cache is not None else None
+            if cached_email is not None:
+                in_flight.append((cached_email, None))
+            else:
+                in_flight.append((None, executor.submit(fetch_message, message_info)))
+            # Backpressure: parse the oldest message before taking more work
+            if len(in_flight) >= max_in_flight:
+                email_data = parse_next()
+                if email_data:
+                    yield email_data
+
+        while in_flight:
+            email_data = parse_next()
+            if email_data:
+                yield email_data
+        if listing_error is not None:
+            raise listing_error
+    finally:
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class BackgroundLoader:
+    """
+    Consumes a stream of parsed emails (e.g. iter_unread_emails) in two steps: the first emails
+    synchronously with `take`, the rest in a background thread after `start`.
+
+    The emails loaded in the background are buffered until `drain` hands them over, so the
+    consumer (e.g. the agent tools) keeps its own data structures single-threaded. The stream must
+    not share its Gmail service with the calling thread, since httplib2 is not thread-safe.
+    """
+
+    def __init__(self, emails: Iterator[Dict[str, Union[str, List[str]]]]):
+        self._emails = emails
+        self._loaded: deque = deque()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._done = threading.Event()
+        self.error: Optional[Exception] = None
+
+    @property
+    def done(self) -> bool:
+        """True once the stream is exhausted (or failed, see `error`)."""
+        return self._done.is_set()
+
+    def take(self, count: int) -> List[Dict[str, Union[str, List[str]]]]:
+        """Consumes up to `count` emails in the calling thread, before `start`."""
+        emails = []
+        if count <= 0:
+            return emails
+        for email_data in self._emails:
+            emails.append(email_data)
+            if len(emails) >= count:
+                return emails
+        self._done.set()
+        return emails
+
+    def start(self) -> None:
+        """Loads the rest of the stream in a daemon thread."""
+        if self._done.is_set() or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._load, name="email-loader", daemon=True)
+        self._thread.start()
+
+    def _load(self) -> None:
+        try:
+            for email_data in self._emails:
+                with self._lock:
+                    self._loaded.append(email_data)
+        except Exception as e:
+            print(f"Failed to load more emails: {e}")
+            self.error = e
+        finally:
+            self._done.set()
+
+    def drain(self) -> List[Dict[str, Union[str, List[str]]]]:
+        """Returns the emails loaded since the previous call."""
+        with self._lock:
+            emails = list(self._loaded)
+            self._loaded.clear()
+        return emails
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Waits for the stream to be exhausted, returns `done`."""
+        return self._done.wait(timeout)
@@ -0,0 +1,242 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_enabled = False
+_lock = threading.Lock()
+_counters: Dict[Tuple[str, Labels], float] = {}
+_gauges: Dict[Tuple[str, Labels], float] = {}
+_histograms: Dict[Tuple[str, Labels], "Histogram"] = {}
+_span_log = None
+_current_span: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+
+
+class Histogram:
+    """Cumulative-bucket histogram, as exported in the Prometheus text format."""
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+def enable(span_log_path: Optional[str] = None) -> None:
+    """
+    Starts recording metrics.
+
+    Args:
+        span_log_path (Optional[str]): If set, every span is also appended to this file as one
+            OpenTelemetry-style JSON object per line.
+    """
+    global _enabled, _span_log
+    with _lock:
+        if _span_log is not None:
+            _span_log.close()
+        _span_log = open(span_log_path, "a", encoding="utf-8") if span_log_path else None
+        _enabled = True
+
+
+def disable() -> None:
+    """Stops recording, the instrumented functions then only pay for one flag check."""
+    global _enabled, _span_log
+    with _lock:
+        _enabled = False
+        if _span_log is not None:
+            _span_log.close()
+            _span_log = None
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def increment(name: str, value: float = 1, **labels) -> None:
+    if not _enabled:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    if not _enabled:
+        return
+    with _lock:
+        _gauges[(name, _labels(labels))] = value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    if not _enabled:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(value)
+
+
+class Span:
+    """A timed operation, nested under the span that was current when it started."""
+
+    __slots__ = ("name", "attributes", "trace_id", "span_id", "parent_id", "start", "start_ns", "status", "_token")
+
+    def __init__(self, name: str, attributes: Dict[str, Any]):
+        parent = _current_span.get()
+        self.name = name
+        self.attributes = attributes
+        self.span_id = os.urandom(8).hex()
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.status = "OK"
+        self.start_ns = time.time_ns()
+        self.start = time.perf_counter()
+        self._token = _current_span.set(self)
+
+    def end(self, error: Optional[BaseException] = None) -> float:
+        """Ends the span, writes it to the span log and returns its duration in seconds."""
+        duration = time.perf_counter() - self.start
+        _current_span.reset(self._token)
+        if error is not None:
+            self.status = "ERROR"
+            self.attributes["error.type"] = type(error).__name__
+        if _span_log is not None:
+            record = {
+                "trace_id": self.trace_id,
+                "span_id": self.span_id,
+                "parent_span_id": self.parent_id,
+                "name": self.name,
+                "start_time_unix_nano": self.start_ns,
+                "end_time_unix_nano": self.start_ns + int(duration * 1e9),
+                "attributes": self.attributes,
+                "status": self.status,
+            }
+            with _lock:
+                if _span_log is not None:
+                    _span_log.write(json.dumps(record, default=str) + "\n")
+        return duration
+
+
+def start_span(name: str, **attributes) -> Optional[Span]:
+    """Starts a span, or returns None when instrumentation is disabled."""
+    if not _enabled:
+        return None
+    return Span(name, attributes)
+
+
+def traced(metric: str) -> Callable:
+    """
+    Decorator recording the latency of each call in the histogram `metric` (labeled with the
+    function name), the errors in `<metric>_errors_total`, and a span named after the function.
+
+    functools.wraps keeps the signature and docstring, so decorated agent tools are still
+    described correctly to the LLM.
+    """
+    def decorator(function: Callable) -> Callable:
+        labels = {"function": function.__name__}
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            span = Span(function.__name__, dict(labels))
+            error = None
+            try:
+                return function(*args, **kwargs)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                duration = span.end(error)
+                observe(metric, duration, **labels)
+                if error is not None:
+                    increment(f"{metric}_errors_total", **labels)
+
+        return wrapper
+
+    return decorator
+
+
+def record_llm_usage(agent: Any) -> None:
+    """Records the tokens and cost used so far by an AG2 agent, as gauges labeled with the agent and model."""
+    if not _enabled:
+        return
+    usage = agent.get_total_usage() or {}
+    for model, model_usage in usage.items():
+        if not isinstance(model_usage, dict):
+            continue
+        for kind in ("prompt_tokens", "completion_tokens", "total_tokens"):
+            set_gauge("llm_tokens", model_usage.get(kind, 0), agent=agent.name, model=model, kind=kind)
+        set_gauge("llm_cost_usd", model_usage.get("cost", 0), agent=agent.name, model=model)
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for key, value in pairs
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def prometheus_text() -> str:
+    """Returns the recorded metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        for metrics, metric_type in ((_counters, "counter"), (_gauges, "gauge")):
+            typed = set()
+            for (name, labels), value in sorted(metrics.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} {metric_type}")
+                    typed.add(name)
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        typed = set()
+        for (name, labels), histogram in sorted(_histograms.items(), key=lambda item: item[0]):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, ('le', str(bound)))} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {histogram.count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path: str) -> None:
+    """Writes the recorded metrics to a Prometheus text file, e.g. for the node_exporter textfile collector."""
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(prometheus_text())
@@ -0,0 +1,139 @@
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+from utils.senders import SenderAggregator, parse_sender
+
+EmailData = Dict[str, Union[str, List[str]]]
+
+
+def normalize_sender(sender: str) -> str:
+    """Returns the lowercased address of a From header, e.g. 'News <A@x.com>' -> 'a@x.com'."""
+    return parse_sender(sender).address
+
+
+class MailboxStore:
+    """
+    In-memory store of parsed emails, indexed by message id, thread id, normalized sender address and label.
+
+    Lookups are O(1) and the indexes are updated incrementally when emails are added, removed or relabeled,
+    so all the agent tools can share one store instead of scanning the list of unread emails.
+
+    `senders` aggregates the emails carrying `tracked_label` (all emails if None) by sender and domain.
+    """
+
+    def __init__(self, emails: Iterable[EmailData] = (), tracked_label: Optional[str] = "UNREAD"):
+        self.tracked_label = tracked_label
+        self.senders = SenderAggregator()
+        self._emails: Dict[str, EmailData] = {}
+        # Dicts with None values are insertion-ordered sets of message ids
+        self._by_thread: Dict[str, Dict[str, None]] = defaultdict(dict)
+        self._by_sender: Dict[str, Dict[str, None]] = defaultdict(dict)
+        self._by_label: Dict[str, Dict[str, None]] = defaultdict(dict)
+        self.add_all(emails)
+
+    def __len__(self) -> int:
+        return len(self._emails)
+
+    def __iter__(self) -> Iterator[EmailData]:
+        return iter(list(self._emails.values()))
+
+    def __contains__(self, message_id: str) -> bool:
+        return message_id in self._emails
+
+    def add(self, email_data: EmailData) -> None:
+        message_id = email_data["message_id"]
+        if message_id in self._emails:
+            self.remove(message_id)
+        self._emails[message_id] = email_data
+        self._by_thread[email_data["thread_id"]][message_id] = None
+        self._by_sender[normalize_sender(email_data.get("from", ""))][message_id] = None
+        for label in email_data.get("labels") or []:
+            self._by_label[label][message_id] = None
+        if self._is_tracked(email_data):
+            self.senders.add(email_data)
+
+    def _is_tracked(self, email_data: EmailData) -> bool:
+        return self.tracked_label is None or self.tracked_label in (email_data.get("labels") or [])
+
+    def add_all(self, emails: Iterable[EmailData]) -> None:
+        for email_data in emails:
+            self.add(email_data)
+
+    def remove(self, message_id: str) -> Optional[EmailData]:
+        email_data = self._emails.pop(message_id, None)
+        if email_data is None:
+            return None
+        self._discard(self._by_thread, email_data["thread_id"], message_id)
+        self._discard(self._by_sender, normalize_sender(email_data.get("from", "")), message_id)
+        for label in email_data.get("labels") or []:
+            self._discard(self._by_label, label, message_id)
+        if self._is_tracked(email_data):
+            self.senders.remove(email_data)
+        return email_data
+
+    @staticmethod
+    def _discard(index: Dict[str, Dict[str, None]], key: str, message_id: str) -> None:
+        message_ids = index.get(key)
+        if message_ids is not None:
+            message_ids.pop(message_id, None)
+            if not message_ids:
+                del index[key]
+
+    def get(self, message_id: str) -> Optional[EmailData]:
+        return self._emails.get(message_id)
+
+    def by_thread(self, thread_id: str) -> List[EmailData]:
+        return [self._emails[message_id] for message_id in self._by_thread.get(thread_id, ())]
+
+    def by_sender(self, sender: str, label: Optional[str] = None) -> List[EmailData]:
+        """
+        Returns the emails of a sender.
+
+        Args:
+            sender (str): Sender address or From header, e.g. 'News <a@x.com>' or 'a@x.com'.
+            label (Optional[str]): If set, only the emails with this label are returned.
+
+        Returns:
+            List[EmailData]: The emails, in the order they were added.
+        """
+        message_ids = self._by_sender.get(normalize_sender(sender), ())
+        if label is not None:
+            labeled_ids = self._by_label.get(label, {})
+            message_ids = [message_id for message_id in message_ids if message_id in labeled_ids]
+        return [self._emails[message_id] for message_id in message_ids]
+
+    def by_label(self, label: str) -> List[EmailData]:
+        return [self._emails[message_id] for message_id in self._by_label.get(label, ())]
+
+    def sender_counts(self) -> Dict[str, int]:
+        """Returns the number of emails of each normalized sender address."""
+        return {sender: len(message_ids) for sender, message_ids in self._by_sender.items()}
+
+    def update_labels(
+        self,
+        message_ids: Iterable[str],
+        add_label_ids: Optional[List[str]] = None,
+        remove_label_ids: Optional[List[str]] = None,
+    ) -> None:
+        add_label_ids = add_label_ids or []
+        remove_label_ids = remove_label_ids or []
+        for message_id in message_ids:
+            email_data = self._emails.get(message_id)
+            if email_data is None:
+                continue
+            was_tracked = self._is_tracked(email_data)
+            labels = [label for label in email_data.get("labels") or [] if label not in remove_label_ids]
+            labels.extend(label for label in add_label_ids if label not in labels)
+            email_data["labels"] = labels
+            for label in remove_label_ids:
+                self._discard(self._by_label, label, message_id)
+            for label in add_label_ids:
+                self._by_label[label][message_id] = None
+            is_tracked = self._is_tracked(email_data)
+            if was_tracked and not is_tracked:
+                self.senders.remove(email_data)
+            elif is_tracked and not was_tracked:
+                self.senders.add(email_data)
+
+    def mark_as_read(self, message_ids: Iterable[str]) -> None:
+        self.update_labels(message_ids, remove_label_ids=["UNREAD"])
@@ -0,0 +1,98 @@
+import re
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Union
+
+from utils.functions import estimate_tokens, format_email_context
+from utils.senders import parse_sender
+
+EmailData = Dict[str, Union[str, List[str]]]
+
+NOREPLY_REGEX = re.compile(r"^(no[-_.]?reply|do[-_.]?not[-_.]?reply|mailer-daemon|notifications?)([-_.+].*)?@")
+
+# Labels of the emails that are never pre-classified, whatever their headers say
+DEFAULT_KEEP_LABELS = ("IMPORTANT", "STARRED")
+
+
+class Rule(NamedTuple):
+    """A local rule flagging an email as a bulk "mark as read" candidate."""
+
+    name: str
+    description: str
+    matches: Callable[[EmailData], bool]
+
+
+def has_label(label: str) -> Callable[[EmailData], bool]:
+    return lambda email_data: label in (email_data.get("labels") or [])
+
+
+def is_bulk_precedence(email_data: EmailData) -> bool:
+    return (email_data.get("precedence") or "").strip().lower() in ("bulk", "list", "junk")
+
+
+def is_noreply_sender(email_data: EmailData) -> bool:
+    return NOREPLY_REGEX.match(parse_sender(email_data.get("from") or "").address) is not None
+
+
+DEFAULT_RULES = [
+    Rule("list_unsubscribe", "has a List-Unsubscribe header", lambda email_data: bool(email_data.get("list_unsubscribe"))),
+    Rule("bulk_precedence", "is sent with Precedence: bulk", is_bulk_precedence),
+    Rule("promotions", "is in the Gmail Promotions category", has_label("CATEGORY_PROMOTIONS")),
+    Rule("updates", "is in the Gmail Updates category", has_label("CATEGORY_UPDATES")),
+    Rule("noreply_sender", "comes from a no-reply address", is_noreply_sender),
+]
+
+
+class Preclassification(NamedTuple):
+    # Emails flagged as "mark as read" candidates, in their original order
+    candidates: List[EmailData]
+    # Emails left for the triage agent
+    remainder: List[EmailData]
+    # Names of the rules matched by each candidate, by message id
+    reasons: Dict[str, List[str]]
+    # Estimated prompt tokens of listing the candidates individually in the triage context
+    tokens_saved: int
+
+
+def preclassify_emails(
+    emails: Iterable[EmailData],
+    rules: Sequence[Rule] = DEFAULT_RULES,
+    min_matches: int = 1,
+    keep_labels: Sequence[str] = DEFAULT_KEEP_LABELS,
+    enabled_rules: Optional[Sequence[str]] = None,
+) -> Preclassification:
+    """
+    Flags the obvious bulk mail from its headers and labels, so it does not take room in the LLM prompt.
+
+    Args:
+        emails (Iterable[EmailData]): Parsed emails.
+        rules (Sequence[Rule]): Rules to apply, see DEFAULT_RULES.
+        min_matches (int): Number of rules an email must match to be a candidate.
+        keep_labels (Sequence[str]): Emails with any of these labels are always left to the agent.
+        enabled_rules (Optional[Sequence[str]]): Names of the rules to apply, all of them if None.
+
+    Returns:
+        Preclassification: The candidates with the rules they matched, the remaining emails and the
+        estimated number of prompt tokens saved.
+    """
+    if enabled_rules is not None:
+        rules = [rule for rule in rules if rule.name in enabled_rules]
+    candidates, remainder, reasons = [], [], {}
+    tokens_saved = 0
+    for email_data in emails:
+        labels = email_data.get("labels") or []
+        matched = [] if any(label in labels for label in keep_labels) else [
+            rule.name for rule in rules if rule.matches(email_data)
+        ]
+        if min_matches and len(matched) >= min_matches:
+            candidates.append(email_data)
+            reasons[email_data["message_id"]] = matched
+            tokens_saved += estimate_tokens(format_email_context(email_data) + "\n")
+        else:
+            remainder.append(email_data)
+    return Preclassification(candidates, remainder, reasons, tokens_saved)
+
+
+def format_candidate(email_data: EmailData, reasons: Dict[str, List[str]], rules: Sequence[Rule] = DEFAULT_RULES) -> str:
+    """Formats a candidate like format_email_context, with the rules it matched."""
+    descriptions = {rule.name: rule.description for rule in rules}
+    matched = ", ".join(descriptions.get(name, name) for name in reasons.get(email_data["message_id"], []))
+    return format_email_context(email_data) + f"Pre-classified because it {matched}\n"
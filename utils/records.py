@@ -0,0 +1,197 @@
+import hashlib
+import mmap
+import os
+import sys
+import tempfile
+import threading
+from collections.abc import MutableMapping
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple
+
+# Keys of the parsed email data, see parse_email_message
+EMAIL_FIELDS = (
+    "message_id",
+    "thread_id",
+    "subject",
+    "to",
+    "from",
+    "cc",
+    "received_time",
+    "internal_date",
+    "list_id",
+    "list_unsubscribe",
+    "precedence",
+    "labels",
+    "history_id",
+    "snippet",
+    "body",
+    "attachments",
+)
+
+# Slot holding each key, "from" being a keyword
+_SLOT_NAMES = {field: "sender" if field == "from" else field for field in EMAIL_FIELDS if field != "body"}
+
+# Fields repeated across many emails, interned so all the records share one string
+INTERNED_FIELDS = frozenset(("thread_id", "to", "from", "cc", "list_id", "precedence"))
+
+
+class BodyStore:
+    """
+    Append-only file of email bodies, read back through a memory map.
+
+    Bodies are written once and never rewritten, so a record only keeps the offset and length of
+    its body; the bytes stay in the page cache instead of the Python heap. A body is stored once: the
+    same text appended again, as when a cached email is read back or relabeled, returns the offset it
+    already has. Without a path, the store is an anonymous temporary file, deleted when it is closed.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._file = open(path, "a+b") if path else tempfile.TemporaryFile()
+        self._file.seek(0, os.SEEK_END)
+        self._size = self._file.tell()
+        self._map: Optional[mmap.mmap] = None
+        # Offset and length of the bodies appended by this process, by digest of their bytes
+        self._offsets: Dict[bytes, Tuple[int, int]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def append(self, text: str) -> Tuple[int, int]:
+        """Stores a body, unless it is already stored, returns its offset and length in bytes."""
+        data = text.encode("utf-8")
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        with self._lock:
+            stored = self._offsets.get(digest)
+            if stored is not None:
+                return stored
+            offset = self._size
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(data)
+            self._size += len(data)
+            self._offsets[digest] = offset, len(data)
+        return offset, len(data)
+
+    def read(self, offset: int, length: int) -> str:
+        if not length:
+            return ""
+        with self._lock:
+            if self._map is None or offset + length > len(self._map):
+                # The file grew since it was mapped
+                self._file.flush()
+                if self._map is not None:
+                    self._map.close()
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._map[offset:offset + length].decode("utf-8")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self._file.close()
+
+
+_default_body_store: Optional[BodyStore] = None
+_default_body_store_lock = threading.Lock()
+
+
+def get_body_store() -> BodyStore:
+    """Returns the body store of the records, an anonymous temporary file unless set_body_store was called."""
+    global _default_body_store
+    if _default_body_store is None:
+        with _default_body_store_lock:
+            if _default_body_store is None:
+                _default_body_store = BodyStore()
+    return _default_body_store
+
+
+def set_body_store(store: BodyStore) -> None:
+    global _default_body_store
+    _default_body_store = store
+
+
+def _intern(value: Any) -> Any:
+    return sys.intern(value) if type(value) is str else value
+
+
+class EmailRecord(MutableMapping):
+    """
+    Compact parsed email, used in place of the email data dict: it reads and writes like one
+    (record["from"], record.get("labels"), dict(record)), with the keys of EMAIL_FIELDS.
+
+    Fields are slots instead of a per-record dict, the sender, recipients, thread id, list headers
+    and labels are interned, and the body lives in a BodyStore, only decoded when it is read.
+    """
+
+    __slots__ = tuple(_SLOT_NAMES.values()) + ("_body_offset", "_body_length", "_store")
+
+    def __init__(self, email_data: Optional[Mapping] = None, store: Optional[BodyStore] = None):
+        for slot in _SLOT_NAMES.values():
+            object.__setattr__(self, slot, None)
+        self._body_offset = -1
+        self._body_length = 0
+        self._store = store
+        if email_data:
+            for key, value in email_data.items():
+                # Keys of other versions of the parsed data are dropped
+                if key in _SLOT_NAMES or key == "body":
+                    self[key] = value
+
+    def __getitem__(self, key: str) -> Any:
+        if key == "body":
+            if self._body_offset < 0:
+                return None
+            return self._store.read(self._body_offset, self._body_length)
+        try:
+            slot = _SLOT_NAMES[key]
+        except KeyError:
+            raise KeyError(key) from None
+        return getattr(self, slot)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key == "body":
+            if value is None:
+                self._body_offset, self._body_length = -1, 0
+            else:
+                if self._store is None:
+                    self._store = get_body_store()
+                self._body_offset, self._body_length = self._store.append(value)
+            return
+        try:
+            slot = _SLOT_NAMES[key]
+        except KeyError:
+            raise KeyError(f"EmailRecord has no field {key!r}") from None
+        if key == "labels" and value is not None:
+            value = [_intern(label) for label in value]
+        elif key in INTERNED_FIELDS:
+            value = _intern(value)
+        setattr(self, slot, value)
+
+    def __delitem__(self, key: str) -> None:
+        raise TypeError("EmailRecord fields cannot be deleted, set them to None")
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(EMAIL_FIELDS)
+
+    def __len__(self) -> int:
+        return len(EMAIL_FIELDS)
+
+    def __contains__(self, key: object) -> bool:
+        return key in _SLOT_NAMES or key == "body"
+
+    def __repr__(self) -> str:
+        return f"EmailRecord({dict(self)!r})"
+
+    def __reduce__(self):
+        # Pickled with the body, the store stays in this process
+        return EmailRecord, (dict(self),)
+
+    @property
+    def has_body(self) -> bool:
+        return self._body_offset >= 0
+
+
+def to_records(emails: List[Mapping], store: Optional[BodyStore] = None) -> List[EmailRecord]:
+    return [email_data if isinstance(email_data, EmailRecord) else EmailRecord(email_data, store) for email_data in emails]
@@ -0,0 +1,347 @@
+import multiprocessing
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional, Tuple
+
+from googleapiclient.errors import HttpError
+
+from utils import instrumentation
+
+# Gmail enforces a moving average of 250 quota units per second per user
+DEFAULT_UNITS_PER_SECOND = 250
+
+# Quota units of each Gmail API method, by the method id of the discovery document
+# https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    "gmail.users.getProfile": 1,
+    "gmail.users.drafts.create": 10,
+    "gmail.users.drafts.get": 5,
+    "gmail.users.drafts.list": 5,
+    "gmail.users.drafts.send": 100,
+    "gmail.users.history.list": 2,
+    "gmail.users.labels.list": 1,
+    "gmail.users.messages.attachments.get": 5,
+    "gmail.users.messages.batchModify": 50,
+    "gmail.users.messages.get": 5,
+    "gmail.users.messages.list": 5,
+    "gmail.users.messages.modify": 5,
+    "gmail.users.messages.send": 100,
+    "gmail.users.threads.get": 10,
+    "gmail.users.threads.list": 10,
+}
+
+# Gmail also enforces 1,200,000 quota units per minute for the whole project, across all users
+PROJECT_UNITS_PER_SECOND = 20000
+
+# Cost assumed for the methods missing from QUOTA_UNITS
+DEFAULT_QUOTA_UNITS = 5
+
+# Methods that must not be repeated after a server error: the server may have acted before failing,
+# so a retry could duplicate the draft or send the email twice. Rate limits are still retried.
+NON_IDEMPOTENT_METHODS = frozenset((
+    "gmail.users.drafts.create",
+    "gmail.users.drafts.send",
+    "gmail.users.messages.send",
+))
+
+# After a rate limit error the rate is halved, but never below this share of the configured rate
+MIN_RATE_SHARE = 0.1
+
+# Share of the configured rate recovered after each successful request
+RATE_RECOVERY_SHARE = 0.05
+
+
+def request_units(request: Any) -> int:
+    """Returns the quota units of a googleapiclient HttpRequest, from its method id."""
+    return QUOTA_UNITS.get(getattr(request, "methodId", None), DEFAULT_QUOTA_UNITS)
+
+
+def instrument_request(request: Any) -> None:
+    """Counts the response bytes of a googleapiclient HttpRequest, also when it is sent in a batch."""
+    postproc = getattr(request, "postproc", None)
+    if not instrumentation.is_enabled() or postproc is None:
+        return
+    method = getattr(request, "methodId", None) or "unknown"
+
+    def counting_postproc(response, content):
+        instrumentation.increment("gmail_response_bytes_total", len(content or b""), method=method)
+        return postproc(response, content)
+
+    request.postproc = counting_postproc
+
+
+def error_response(error: Exception) -> Tuple[Optional[int], Any, str]:
+    """Returns the status code, headers and body of an HttpError or httpx.HTTPStatusError."""
+    if isinstance(error, HttpError):
+        return error.resp.status, error.resp, str(error)
+    response = getattr(error, "response", None)
+    if response is not None and hasattr(response, "status_code"):
+        return response.status_code, response.headers, response.text
+    return None, {}, ""
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Returns True for 429 and 403 rateLimitExceeded/userRateLimitExceeded errors."""
+    status, _, content = error_response(error)
+    if status == 429:
+        return True
+    return status == 403 and any(
+        reason in content for reason in ("rateLimitExceeded", "userRateLimitExceeded")
+    )
+
+
+def is_retryable_error(error: Exception, retry_server_errors: bool = True) -> bool:
+    """
+    Returns True for errors worth retrying: rate limits (429, 403 rateLimitExceeded), and 5xx
+    unless `retry_server_errors` is False, see retries_server_errors.
+    """
+    status, _, _ = error_response(error)
+    if status is None:
+        return False
+    return (retry_server_errors and status >= 500) or is_rate_limit_error(error)
+
+
+def retries_server_errors(method_id: Optional[str]) -> bool:
+    """Returns False for the methods of NON_IDEMPOTENT_METHODS, whose server errors are not retried."""
+    return method_id not in NON_IDEMPOTENT_METHODS
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Returns the delay requested by the Retry-After header of an error, in seconds or as a date."""
+    _, headers, _ = error_response(error)
+    value = headers.get("retry-after") if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class SharedTokenBucket:
+    """
+    Token bucket shared by the processes of a multiprocessing pool, e.g. for the per-project quota
+    when several mailboxes are processed at once.
+
+    It lives in shared memory, so it must be created before the pool and handed to the workers
+    through the pool initializer, see RequestScheduler(shared_bucket=...).
+    """
+
+    def __init__(self, units_per_second: float = PROJECT_UNITS_PER_SECOND, burst: Optional[float] = None):
+        self.units_per_second = units_per_second
+        self.burst = burst or units_per_second
+        self._lock = multiprocessing.Lock()
+        self._tokens = multiprocessing.Value("d", self.burst, lock=False)
+        # time.monotonic is system-wide, so the processes agree on it
+        self._updated = multiprocessing.Value("d", time.monotonic(), lock=False)
+
+    def reserve(self, units: float) -> float:
+        """Takes `units` from the bucket without waiting, returns the seconds to wait before using them."""
+        with self._lock:
+            now = time.monotonic()
+            tokens = min(self.burst, self._tokens.value + (now - self._updated.value) * self.units_per_second)
+            self._updated.value = now
+            self._tokens.value = tokens - units
+            return max(0.0, (units - tokens) / self.units_per_second)
+
+
+class RequestScheduler:
+    """
+    Paces Gmail API calls to the per-user quota and retries the ones that are rate limited.
+
+    A token bucket refilled at `units_per_second` is shared by every thread using the scheduler:
+    each request takes its quota units (see QUOTA_UNITS) and waits when the bucket is empty.
+    Rate limit and server errors are retried with jittered exponential backoff, honoring the
+    Retry-After header, and a rate limit error halves the refill rate until requests succeed again.
+    The time spent waiting is reported by `stats`.
+
+    With a `shared_bucket`, each request also takes its units from a bucket shared with other
+    processes, and waits for whichever bucket is emptier.
+    """
+
+    def __init__(
+        self,
+        units_per_second: float = DEFAULT_UNITS_PER_SECOND,
+        burst: Optional[float] = None,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 64.0,
+        shared_bucket: Optional[SharedTokenBucket] = None,
+    ):
+        self.units_per_second = units_per_second
+        self.burst = burst or units_per_second
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.shared_bucket = shared_bucket
+        self._rate = units_per_second
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "units": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "throttled_seconds": 0.0,
+            "backoff_seconds": 0.0,
+        }
+
+    @property
+    def rate(self) -> float:
+        """Current refill rate in units per second, lower than units_per_second after rate limit errors."""
+        return self._rate
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._stats)
+
+    def reserve(self, units: float) -> float:
+        """
+        Takes `units` from the bucket without waiting.
+
+        Returns:
+            float: Seconds to wait before sending the request, 0 if the bucket had enough units.
+        """
+        shared_delay = self.shared_bucket.reserve(units) if self.shared_bucket is not None else 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            self._tokens -= units
+            self._stats["requests"] += 1
+            self._stats["units"] += units
+            delay = max(shared_delay, -self._tokens / self._rate)
+            if delay <= 0:
+                return 0.0
+            self._stats["throttled_seconds"] += delay
+        instrumentation.increment("gmail_throttle_seconds_total", delay)
+        return delay
+
+    def acquire(self, units: float) -> None:
+        """Waits until the bucket has `units` for the calling thread."""
+        delay = self.reserve(units)
+        if delay:
+            time.sleep(delay)
+
+    def on_success(self) -> None:
+        if self._rate < self.units_per_second:
+            with self._lock:
+                self._rate = min(self.units_per_second, self._rate + self.units_per_second * RATE_RECOVERY_SHARE)
+
+    def retry_delay(self, attempt: int, error: Optional[Exception] = None) -> float:
+        """
+        Records a retry and returns how long to wait before it.
+
+        Args:
+            attempt (int): Number of the failed attempt, starting at 0.
+            error (Optional[Exception]): The error of the failed attempt.
+
+        Returns:
+            float: The Retry-After delay of the error if any, else an exponential delay with jitter.
+        """
+        delay = retry_after_seconds(error) if error is not None else None
+        if delay is None:
+            delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+            delay = delay / 2 + random.uniform(0, delay / 2)
+        with self._lock:
+            self._stats["retries"] += 1
+            self._stats["backoff_seconds"] += delay
+            rate_limited = error is not None and is_rate_limit_error(error)
+            if rate_limited:
+                self._stats["rate_limited"] += 1
+                self._rate = max(self.units_per_second * MIN_RATE_SHARE, self._rate / 2)
+        instrumentation.increment("gmail_retries_total", rate_limited=rate_limited)
+        instrumentation.increment("gmail_backoff_seconds_total", delay)
+        return delay
+
+    def execute(self, request: Any, units: Optional[float] = None) -> Any:
+        """
+        Executes a googleapiclient HttpRequest within the quota, retrying rate limit and server errors
+        (only rate limits for the methods of NON_IDEMPOTENT_METHODS).
+
+        Args:
+            request (HttpRequest): The request to execute.
+            units (Optional[float]): Quota units of the request, defaults to the cost of its method.
+
+        Returns:
+            Any: The response of the request.
+
+        Raises:
+            Exception: The last error, once it is not retryable or `max_retries` retries failed.
+        """
+        if not instrumentation.is_enabled():
+            return self._execute(request, units)
+        method = getattr(request, "methodId", None) or "unknown"
+        instrument_request(request)
+        span = instrumentation.start_span(f"gmail {method}", method=method)
+        error = None
+        try:
+            return self._execute(request, units)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            instrumentation.observe("gmail_request_seconds", span.end(error), method=method)
+
+    def _execute(self, request: Any, units: Optional[float] = None) -> Any:
+        units = request_units(request) if units is None else units
+        retry_server_errors = retries_server_errors(getattr(request, "methodId", None))
+        for attempt in range(self.max_retries + 1):
+            self.acquire(units)
+            try:
+                response = request.execute()
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable_error(e, retry_server_errors):
+                    raise
+                time.sleep(self.retry_delay(attempt, e))
+                continue
+            self.on_success()
+            return response
+
+    def execute_batch(self, batch: Any, units: float) -> None:
+        """
+        Executes a BatchHttpRequest within the quota, without retrying.
+
+        Each sub-request is billed separately, so `units` is the sum of their costs. Failed
+        sub-requests are reported to the batch callback and retried by the caller.
+        """
+        self.acquire(units)
+        span = instrumentation.start_span("gmail batch", units=units)
+        if span is None:
+            batch.execute()
+            return
+        error = None
+        try:
+            batch.execute()
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            instrumentation.observe("gmail_request_seconds", span.end(error), method="batch")
+
+
+_default_scheduler = RequestScheduler()
+
+
+def get_scheduler() -> RequestScheduler:
+    """Returns the scheduler shared by the Gmail calls of email_utils and the async client."""
+    return _default_scheduler
+
+
+def set_scheduler(scheduler: RequestScheduler) -> None:
+    """Replaces the shared scheduler, e.g. to change the quota with RequestScheduler(units_per_second=...)."""
+    global _default_scheduler
+    _default_scheduler = scheduler
+
+
+def execute_request(request: Any, units: Optional[float] = None) -> Any:
+    """Executes a googleapiclient HttpRequest through the shared scheduler, see RequestScheduler.execute."""
+    return _default_scheduler.execute(request, units)
@@ -0,0 +1,148 @@
+import heapq
+import sys
+from email.utils import parseaddr
+from functools import lru_cache
+from typing import Dict, Iterable, List, NamedTuple, Optional, Union
+
+EmailData = Dict[str, Union[str, List[str]]]
+
+
+class ParsedSender(NamedTuple):
+    address: str
+    display_name: str
+    domain: str
+
+
+@lru_cache(maxsize=65536)
+def parse_sender(sender: str) -> ParsedSender:
+    """
+    Parses a From header once; the same header string always returns the same interned strings.
+
+    Args:
+        sender (str): From header, e.g. 'News <A@x.com>' or 'a@x.com'.
+
+    Returns:
+        ParsedSender: Lowercased address, display name and domain of the sender.
+    """
+    display_name, address = parseaddr(sender)
+    address = (address or sender).strip().lower()
+    domain = address.rpartition("@")[2] if "@" in address else ""
+    return ParsedSender(sys.intern(address), display_name.strip(), sys.intern(domain))
+
+
+class SenderStats:
+    """Counters of the emails from one sender address or one domain."""
+
+    __slots__ = ("key", "display_name", "list_ids", "_dates", "_oldest", "_newest")
+
+    def __init__(self, key: str):
+        self.key = key
+        self.display_name = ""
+        self.list_ids: Dict[str, int] = {}
+        # Internal date of each email, by message id
+        self._dates: Dict[str, int] = {}
+        # Running extremes of _dates, only rescanned when one of them is removed
+        self._oldest: Optional[int] = None
+        self._newest: Optional[int] = None
+
+    @property
+    def count(self) -> int:
+        return len(self._dates)
+
+    @property
+    def oldest(self) -> Optional[int]:
+        return self._oldest
+
+    @property
+    def newest(self) -> Optional[int]:
+        return self._newest
+
+    def _update_extremes(self, removed_date: Optional[int]) -> None:
+        if removed_date is not None and removed_date in (self._oldest, self._newest):
+            self._oldest = min(self._dates.values()) if self._dates else None
+            self._newest = max(self._dates.values()) if self._dates else None
+
+    @property
+    def message_ids(self) -> List[str]:
+        return list(self._dates)
+
+    def add(self, email_data: EmailData, display_name: str) -> None:
+        date = int(email_data.get("internal_date") or 0)
+        previous_date = self._dates.get(email_data["message_id"])
+        self._dates[email_data["message_id"]] = date
+        if previous_date is not None and previous_date != date:
+            # The email was added again with another date
+            self._update_extremes(previous_date)
+        if self._oldest is None or date < self._oldest:
+            self._oldest = date
+        if self._newest is None or date > self._newest:
+            self._newest = date
+        if display_name:
+            self.display_name = display_name
+        list_id = email_data.get("list_id")
+        if list_id:
+            self.list_ids[list_id] = self.list_ids.get(list_id, 0) + 1
+
+    def remove(self, email_data: EmailData) -> None:
+        date = self._dates.pop(email_data["message_id"], None)
+        if date is None:
+            return
+        self._update_extremes(date)
+        list_id = email_data.get("list_id")
+        if list_id in self.list_ids:
+            self.list_ids[list_id] -= 1
+            if not self.list_ids[list_id]:
+                del self.list_ids[list_id]
+
+    def describe(self) -> str:
+        name = f"{self.display_name} <{self.key}>" if self.display_name else self.key
+        description = f"{self.count} mails from {name}"
+        if self.list_ids:
+            description += f", mailing list {', '.join(self.list_ids)}"
+        return description
+
+
+class SenderAggregator:
+    """
+    Incremental per-sender and per-domain counters of a set of emails.
+
+    From headers are parsed once and normalized to the lowercased address, so 'News <a@x.com>'
+    and 'a@x.com' are the same sender. Counters are updated as emails are added or removed,
+    and the top senders are picked with a heap instead of sorting every sender.
+    """
+
+    def __init__(self, emails: Iterable[EmailData] = ()):
+        self.senders: Dict[str, SenderStats] = {}
+        self.domains: Dict[str, SenderStats] = {}
+        for email_data in emails:
+            self.add(email_data)
+
+    def add(self, email_data: EmailData) -> None:
+        sender = parse_sender(email_data.get("from") or "Unknown Sender")
+        if sender.address not in self.senders:
+            self.senders[sender.address] = SenderStats(sender.address)
+        self.senders[sender.address].add(email_data, sender.display_name)
+        if sender.domain not in self.domains:
+            self.domains[sender.domain] = SenderStats(sender.domain)
+        self.domains[sender.domain].add(email_data, "")
+
+    def remove(self, email_data: EmailData) -> None:
+        sender = parse_sender(email_data.get("from") or "Unknown Sender")
+        for index, key in ((self.senders, sender.address), (self.domains, sender.domain)):
+            stats = index.get(key)
+            if stats is None:
+                continue
+            stats.remove(email_data)
+            if not stats.count:
+                del index[key]
+
+    def get(self, sender: str) -> Optional[SenderStats]:
+        return self.senders.get(parse_sender(sender).address)
+
+    def top_senders(self, k: int = 10) -> List[SenderStats]:
+        """Returns the k senders with the most emails, largest first."""
+        return heapq.nlargest(k, self.senders.values(), key=lambda stats: stats.count)
+
+    def top_domains(self, k: int = 10) -> List[SenderStats]:
+        """Returns the k domains with the most emails, largest first."""
+        return heapq.nlargest(k, self.domains.values(), key=lambda stats: stats.count)
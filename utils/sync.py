@@ -0,0 +1,98 @@
+from typing import List
+
+from googleapiclient.discovery import Resource
+from googleapiclient.errors import HttpError
+
+from utils.cache import MessageCache
+from utils.email_utils import fetch_history, list_messages_request
+from utils.scheduler import execute_request
+
+HISTORY_ID_KEY = "unread_history_id"
+
+
+def sync_unread_ids(gmail: Resource, cache: MessageCache, label_id: str = "UNREAD") -> List[str]:
+    """
+    Brings the local unread set up to date and returns it.
+
+    When a history id from a previous sync is available, only the changes since then are
+    fetched with users.history.list and applied in place. The whole label is listed again
+    on the first run, or when Gmail no longer has the history for the stored id.
+
+    Args:
+        gmail (Resource): Gmail API service instance.
+        cache (MessageCache): Cache holding the unread set and the last synced history id.
+        label_id (str): Label tracked by the local set.
+
+    Returns:
+        List[str]: Unread message ids, newest first.
+    """
+    start_history_id = cache.get_state(HISTORY_ID_KEY)
+    if start_history_id:
+        try:
+            history_id = apply_history(gmail, cache, start_history_id, label_id)
+            cache.set_state(HISTORY_ID_KEY, history_id or start_history_id)
+            return cache.get_unread_ids()
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            print(f"History {start_history_id} expired, listing all emails again")
+
+    full_sync_unread_ids(gmail, cache, label_id)
+    return cache.get_unread_ids()
+
+
+def full_sync_unread_ids(gmail: Resource, cache: MessageCache, label_id: str = "UNREAD") -> None:
+    """
+    Lists the whole label into the local unread set and stores the history id to sync from next time.
+
+    Raises:
+        Exception: The error of a page that could not be listed. The cache is left unchanged: storing a
+            partial set with a new history id would hide the missing emails from every later sync.
+    """
+    # Take the history id before listing, so changes made during the listing are replayed next time
+    history_id = execute_request(gmail.users().getProfile(userId="me")).get("historyId")
+
+    message_ids = []
+    page_token = None
+    while True:
+        results = execute_request(list_messages_request(gmail, page_token, [label_id]))
+        messages, page_token = results.get("messages", []), results.get("nextPageToken")
+        message_ids.extend(msg["id"] for msg in messages)
+        if not messages or not page_token:
+            break
+
+    cache.replace_unread_ids(message_ids)
+    cache.set_state(HISTORY_ID_KEY, history_id)
+
+
+def apply_history(gmail: Resource, cache: MessageCache, start_history_id: str, label_id: str = "UNREAD") -> str:
+    """Applies the mailbox changes since `start_history_id` to the cache and returns the new history id."""
+    history_id = None
+    page_token = None
+    while True:
+        records, page_token, history_id = fetch_history(gmail, start_history_id, page_token)
+        for record in records:
+            for added in record.get("messagesAdded", []):
+                message = added["message"]
+                if label_id in message.get("labelIds", []):
+                    cache.add_unread_ids([message["id"]])
+
+            for deleted in record.get("messagesDeleted", []):
+                message_id = deleted["message"]["id"]
+                cache.remove_unread_ids([message_id])
+                cache.invalidate_messages([message_id])
+
+            for change in record.get("labelsAdded", []):
+                message_id = change["message"]["id"]
+                cache.update_labels([message_id], add_label_ids=change["labelIds"])
+                if label_id in change["labelIds"]:
+                    cache.add_unread_ids([message_id])
+
+            for change in record.get("labelsRemoved", []):
+                message_id = change["message"]["id"]
+                cache.update_labels([message_id], remove_label_ids=change["labelIds"])
+                if label_id in change["labelIds"]:
+                    cache.remove_unread_ids([message_id])
+
+        if not page_token:
+            return history_id
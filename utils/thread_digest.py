@@ -0,0 +1,249 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Sequence, Union
+
+from utils.cache import DEFAULT_CACHE_PATH
+from utils.decisions import prompt_version
+from utils.triage import DEFAULT_MAX_WORKERS, Completion
+
+EmailData = Dict[str, Union[str, List[str]]]
+
+# Latest messages of a thread returned in full, the older ones are summarized
+DEFAULT_FULL_BODIES = 2
+
+# Messages summarized per LLM call, and characters of each body sent to it
+SUMMARY_CHUNK_SIZE = 10
+SUMMARY_BODY_CHARS = 3000
+
+# Length of the summaries, LLM or extractive
+SUMMARY_MAX_CHARS = 300
+
+# Least recently used summaries beyond this number are evicted
+DEFAULT_MAX_SUMMARIES = 20000
+
+SUMMARY_SYSTEM_MESSAGE = f"""You summarize the messages of an email thread, so a reply can be drafted without reading them in full.
+For each message, write one or two sentences (at most {SUMMARY_MAX_CHARS} characters) with its requests, decisions, dates and figures.
+Answer with a JSON object of the form:
+{{"summaries": [{{"message_id": "<Message ID>", "summary": "<summary>"}}]}}
+with one entry for every message."""
+
+
+def thread_summary_version(llm_config: Dict) -> str:
+    """Version of the message summaries made with the given models: editing the prompt or the model invalidates them."""
+    models = (config.get("model", "") for config in llm_config["config_list"])
+    return prompt_version(SUMMARY_SYSTEM_MESSAGE, *models)
+
+
+def extractive_summary(body: Optional[str], max_chars: int = SUMMARY_MAX_CHARS) -> str:
+    """Summary without the LLM: the first sentences of the body, leaving out quoted lines."""
+    lines = [line for line in (body or "").splitlines() if not line.lstrip().startswith(">")]
+    text = re.sub(r"\s+", " ", " ".join(lines)).strip()
+    if len(text) <= max_chars:
+        return text
+    summary = ""
+    for sentence in re.split(r"(?<=[.!?])\s+", text):
+        if len(summary) + len(sentence) + 1 > max_chars:
+            break
+        summary = f"{summary} {sentence}".strip()
+    # A first sentence longer than the summary is cut
+    return summary or text[:max_chars - 3].rstrip() + "..."
+
+
+def format_summary_chunk(emails: Sequence[EmailData]) -> str:
+    entries = []
+    for email in emails:
+        body = (email.get("body") or "")[:SUMMARY_BODY_CHARS]
+        entries.append(f"Message ID: {email['message_id']}\nFrom: {email['from']}\nDate: {email.get('date')}\n"
+                       f"Subject: {email['subject']}\n{body}\n")
+    return "\n".join(entries)
+
+
+def parse_summaries(text: str, message_ids: Sequence[str]) -> Dict[str, str]:
+    """Parses the JSON answer of the LLM, keeping the summaries of the given messages."""
+    try:
+        answer = json.loads(text)
+    except (TypeError, ValueError) as e:
+        print(f"Failed to parse the thread summaries: {e}")
+        return {}
+    entries = answer.get("summaries", []) if isinstance(answer, dict) else answer
+    wanted = set(message_ids)
+    summaries = {}
+    for entry in entries if isinstance(entries, list) else []:
+        if not isinstance(entry, dict):
+            continue
+        message_id = entry.get("message_id")
+        summary = entry.get("summary")
+        if message_id in wanted and isinstance(summary, str) and summary.strip():
+            summaries[message_id] = summary.strip()[:SUMMARY_MAX_CHARS]
+    return summaries
+
+
+def summarize_chunk(complete: Completion, emails: Sequence[EmailData]) -> Dict[str, str]:
+    """Summarizes one chunk of messages with a single LLM call."""
+    messages = [
+        {"role": "system", "content": SUMMARY_SYSTEM_MESSAGE},
+        {"role": "user", "content": format_summary_chunk(emails)},
+    ]
+    try:
+        text = complete(messages)
+    except Exception as e:
+        print(f"Failed to summarize {len(emails)} thread messages: {e}")
+        return {}
+    return parse_summaries(text, [email["message_id"] for email in emails])
+
+
+class ThreadSummaryCache:
+    """
+    On-disk SQLite cache of the message summaries, keyed by message id and summary version.
+
+    Messages never change once sent, so a summary stays valid until the prompt or model changes
+    (see thread_summary_version); the least recently used ones are evicted beyond `max_entries`.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_entries: int = DEFAULT_MAX_SUMMARIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # Shared with the MessageCache and the DecisionCache, see MessageCache
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS thread_summaries (
+                    message_id TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    summary TEXT NOT NULL,
+                    last_used_at REAL NOT NULL,
+                    PRIMARY KEY (message_id, version)
+                );
+                CREATE INDEX IF NOT EXISTS thread_summaries_last_used_at ON thread_summaries (last_used_at);
+                """
+            )
+
+    def get_summaries(self, message_ids: Iterable[str], version: str) -> Dict[str, str]:
+        """Looks up the summaries of messages, and marks them as recently used."""
+        message_ids = list(message_ids)
+        now = time.time()
+        found = {}
+        with self._lock, self._conn:
+            # Stay well below SQLite's limit on the number of bound parameters
+            for start in range(0, len(message_ids), 500):
+                chunk = message_ids[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT message_id, summary FROM thread_summaries "
+                    f"WHERE version = ? AND message_id IN ({', '.join('?' * len(chunk))})",
+                    [version] + chunk,
+                ).fetchall()
+                found.update(rows)
+            self._conn.executemany(
+                "UPDATE thread_summaries SET last_used_at = ? WHERE message_id = ? AND version = ?",
+                [(now, message_id, version) for message_id in found],
+            )
+        return found
+
+    def put_summaries(self, summaries: Dict[str, str], version: str) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO thread_summaries (message_id, version, summary, last_used_at) "
+                "VALUES (?, ?, ?, ?)",
+                [(message_id, version, summary, now) for message_id, summary in summaries.items()],
+            )
+
+    def invalidate(self, version: str) -> int:
+        """Deletes the summaries of other versions, returns how many were deleted."""
+        with self._lock, self._conn:
+            return self._conn.execute("DELETE FROM thread_summaries WHERE version != ?", (version,)).rowcount
+
+    def evict(self) -> int:
+        """Deletes the least recently used summaries beyond max_entries."""
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "DELETE FROM thread_summaries WHERE rowid IN "
+                "(SELECT rowid FROM thread_summaries ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class ThreadDigester:
+    """
+    Turns a thread, as returned by fetch_email_thread, into a compact digest for the writer agent:
+    a summary of each older message and the latest `full_bodies` messages in full.
+
+    Each message is summarized once: summaries are cached by message id, so a thread that grew
+    since the last call only costs the LLM calls of its new messages. Without `complete`, or when
+    the LLM fails, messages get an extractive summary, which is not cached.
+    """
+
+    def __init__(
+        self,
+        cache: ThreadSummaryCache,
+        version: str,
+        complete: Optional[Completion] = None,
+        full_bodies: int = DEFAULT_FULL_BODIES,
+        chunk_size: int = SUMMARY_CHUNK_SIZE,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+    ):
+        self.cache = cache
+        self.version = version
+        self.complete = complete
+        self.full_bodies = full_bodies
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+
+    def summarize(self, emails: Sequence[EmailData]) -> Dict[str, str]:
+        """Returns the summary of each message, by message id, summarizing only the ones not cached yet."""
+        summaries = self.cache.get_summaries((email["message_id"] for email in emails), self.version)
+        pending = [email for email in emails if email["message_id"] not in summaries and email.get("body")]
+        if pending and self.complete is not None:
+            chunks = [pending[start:start + self.chunk_size] for start in range(0, len(pending), self.chunk_size)]
+            new_summaries = {}
+            with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(chunks)))) as executor:
+                for chunk_summaries in executor.map(lambda chunk: summarize_chunk(self.complete, chunk), chunks):
+                    new_summaries.update(chunk_summaries)
+            self.cache.put_summaries(new_summaries, self.version)
+            summaries.update(new_summaries)
+        for email in emails:
+            if email["message_id"] not in summaries:
+                summaries[email["message_id"]] = extractive_summary(email.get("body"))
+        return summaries
+
+    def digest(self, emails: Sequence[EmailData]) -> str:
+        """
+        Formats a thread as a digest.
+
+        Args:
+            emails (Sequence[EmailData]): Messages of the thread, oldest first, see fetch_email_thread.
+
+        Returns:
+            str: One line per summarized message, then the latest messages with their full body.
+        """
+        if not emails:
+            return "Thread not found."
+        split = max(0, len(emails) - self.full_bodies)
+        older, latest = emails[:split], emails[split:]
+        lines = [f"Thread {emails[0]['thread_id']}: {len(emails)} messages, "
+                 f"{len(older)} summarized and the last {len(latest)} in full.\n"]
+        summaries = self.summarize(older) if older else {}
+        for index, email in enumerate(older, 1):
+            lines.append(f"{index}. {email.get('date')} - From: {email['from']} - "
+                         f"{summaries[email['message_id']] or '(no text)'}")
+        for index, email in enumerate(latest, split + 1):
+            attachments = email.get("attachments")
+            lines.append(
+                f"\n--- Message {index} of {len(emails)} ---\n"
+                f"Message ID: {email['message_id']}\nFrom: {email['from']}\nTo: {email['to']}\n"
+                f"Date: {email.get('date')}\nSubject: {email['subject']}\n"
+                + (f"Attachments: {', '.join(attachments)}\n" if attachments else "")
+                + f"\n{email.get('body') or ''}"
+            )
+        return "\n".join(lines)
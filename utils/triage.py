@@ -0,0 +1,193 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, NamedTuple, Sequence, Union
+
+from utils.decisions import prompt_version
+from utils.email_utils import group_emails_by_sender
+from utils.functions import format_email_context
+
+EmailData = Dict[str, Union[str, List[str]]]
+
+# Sends chat messages to the LLM and returns the text of its answer
+Completion = Callable[[List[Dict[str, str]]], str]
+
+MARK_AS_READ = "Mark as read"
+READ_FULL_EMAIL = "Read full email to decide"
+TRIAGE_CLASSES = (MARK_AS_READ, READ_FULL_EMAIL)
+
+DEFAULT_CHUNK_SIZE = 20
+DEFAULT_MAX_WORKERS = 4
+
+# A sender gets a bulk suggestion when it has at least this many emails, all to mark as read
+MIN_BULK_EMAILS = 2
+
+CHUNK_SYSTEM_MESSAGE = f"""You are a triage agent for emails.
+Classify each email into:
+- "{MARK_AS_READ}": if the email could be marked as read based on subject, sender and snippet.
+- "{READ_FULL_EMAIL}": if you need to read the full email to decide.
+Answer with a JSON object of the form:
+{{"emails": [{{"email_id": "<Email ID>", "classification": "{MARK_AS_READ}" or "{READ_FULL_EMAIL}", "reason": "<one short sentence>"}}]}}
+with one entry for every email."""
+
+# Instructions of the interactive triage agent, hashed into the version of the cached triage decisions
+# with CHUNK_SYSTEM_MESSAGE: editing either invalidates the cache
+TRIAGE_INSTRUCTIONS = """
+1. Classify ALL the emails into:
+- "Mark as read": If you think the email could be marked as read based on subject, from and body's email. Explain why the mail was classified like this.
+- "Read full email to decide": If you need to read the full email to decide. Explain why the mail was classified like this.
+Record each classification with record_triage_decision, so the email is not classified again at the next run.
+
+2. After full emails are retrieved, outline the key points in short, concise sentences for each email. Make it short and informative.
+Record the final classification and key points with record_triage_decision.
+
+3. Please identify what sender's email are less important and can be marked as read in bulk.
+Emails pre-classified as bulk mail are already "Mark as read" candidates: review them with get_preclassified_emails and propose them to the user together.
+Given your suggestions on what emails by sender can be marked as read and always ask the user for confirmation before marking them as read.
+
+4. Identify if any email requires a response and suggest this action.
+
+If no further actions are needed, please reply with TERMINATE.
+"""
+
+
+class Classification(NamedTuple):
+    classification: str
+    reason: str
+
+
+class BulkSuggestion(NamedTuple):
+    sender: str
+    email_ids: List[str]
+    reasons: List[str]
+
+
+class TriageResult(NamedTuple):
+    # Classification of each email, by message id
+    classifications: Dict[str, Classification]
+    # Senders whose emails can be marked as read together, largest first
+    bulk_suggestions: List[BulkSuggestion]
+    # Emails the LLM did not classify, left to the interactive triage
+    unclassified_ids: List[str]
+
+
+def triage_prompt_version(llm_config: Dict) -> str:
+    """Version of the triage decisions made with the given models, shared by main.py and batch_triage.py."""
+    models = (config.get("model", "") for config in llm_config["config_list"])
+    return prompt_version(TRIAGE_INSTRUCTIONS, CHUNK_SYSTEM_MESSAGE, *models)
+
+
+def format_chunk(emails: Sequence[EmailData]) -> str:
+    entries = []
+    for email in emails:
+        snippet = email.get("snippet") or (email.get("body") or "")[:200]
+        entries.append(format_email_context(email) + (f"Snippet: {snippet}\n" if snippet else ""))
+    return "\n".join(entries)
+
+
+def parse_classifications(text: str, email_ids: Sequence[str]) -> Dict[str, Classification]:
+    """Parses the JSON answer of the LLM, keeping the valid classifications of the given emails."""
+    try:
+        answer = json.loads(text)
+    except (TypeError, ValueError) as e:
+        print(f"Failed to parse the triage answer: {e}")
+        return {}
+    entries = answer.get("emails", []) if isinstance(answer, dict) else answer
+    wanted = set(email_ids)
+    classifications = {}
+    for entry in entries if isinstance(entries, list) else []:
+        if not isinstance(entry, dict):
+            continue
+        email_id = entry.get("email_id")
+        classification = entry.get("classification")
+        if email_id in wanted and classification in TRIAGE_CLASSES:
+            classifications[email_id] = Classification(classification, str(entry.get("reason") or ""))
+    return classifications
+
+
+def classify_chunk(complete: Completion, emails: Sequence[EmailData]) -> Dict[str, Classification]:
+    """Classifies one chunk of emails with a single LLM call."""
+    messages = [
+        {"role": "system", "content": CHUNK_SYSTEM_MESSAGE},
+        {"role": "user", "content": format_chunk(emails)},
+    ]
+    try:
+        text = complete(messages)
+    except Exception as e:
+        print(f"Failed to classify a chunk of {len(emails)} emails: {e}")
+        return {}
+    return parse_classifications(text, [email["message_id"] for email in emails])
+
+
+def suggest_bulk_senders(
+    emails: Sequence[EmailData], classifications: Dict[str, Classification], min_emails: int = MIN_BULK_EMAILS
+) -> List[BulkSuggestion]:
+    """Reduce step: the senders whose emails were all classified as "Mark as read"."""
+    suggestions = []
+    for sender, sender_emails in group_emails_by_sender(emails).items():
+        email_ids = [email["message_id"] for email in sender_emails]
+        if len(email_ids) < min_emails:
+            continue
+        sender_classifications = [classifications.get(email_id) for email_id in email_ids]
+        if all(item is not None and item.classification == MARK_AS_READ for item in sender_classifications):
+            reasons = list(dict.fromkeys(item.reason for item in sender_classifications if item.reason))
+            suggestions.append(BulkSuggestion(sender, email_ids, reasons[:3]))
+    suggestions.sort(key=lambda suggestion: len(suggestion.email_ids), reverse=True)
+    return suggestions
+
+
+def map_reduce_triage(
+    emails: Sequence[EmailData],
+    complete: Completion,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+) -> TriageResult:
+    """
+    Classifies emails in chunks with concurrent LLM calls, then merges the results into per-sender
+    bulk suggestions.
+
+    Each chunk gets a short prompt of its own, so latency stays flat as the inbox grows and the
+    model never sees a long prompt. At most `max_workers` calls are in flight.
+
+    Args:
+        emails (Sequence[EmailData]): Parsed emails to classify.
+        complete (Completion): Sends chat messages to the LLM and returns its answer, see
+            llm_completion; any function with the same signature can stand in for the LLM.
+        chunk_size (int): Number of emails per LLM call.
+        max_workers (int): Maximum number of concurrent LLM calls.
+
+    Returns:
+        TriageResult: Classifications, bulk suggestions and the ids of the emails left unclassified.
+    """
+    chunks = [emails[start:start + chunk_size] for start in range(0, len(emails), chunk_size)]
+    classifications = {}
+    if chunks:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks))),
+                                thread_name_prefix="triage") as executor:
+            for chunk_classifications in executor.map(lambda chunk: classify_chunk(complete, chunk), chunks):
+                classifications.update(chunk_classifications)
+    unclassified_ids = [email["message_id"] for email in emails if email["message_id"] not in classifications]
+    return TriageResult(classifications, suggest_bulk_senders(emails, classifications), unclassified_ids)
+
+
+def format_bulk_suggestions(suggestions: Sequence[BulkSuggestion]) -> str:
+    lines = []
+    for suggestion in suggestions:
+        reasons = f" ({'; '.join(suggestion.reasons)})" if suggestion.reasons else ""
+        lines.append(
+            f"{len(suggestion.email_ids)} mails from {suggestion.sender} can be marked as read{reasons}, "
+            f"email ids: {', '.join(suggestion.email_ids)}\n"
+        )
+    return "".join(lines)
+
+
+def llm_completion(llm_config: Dict) -> Completion:
+    """Returns a Completion calling the LLM of an AG2 llm_config, asking for a JSON answer."""
+    from autogen import OpenAIWrapper
+
+    client = OpenAIWrapper(**llm_config)
+
+    def complete(messages: List[Dict[str, str]]) -> str:
+        response = client.create(messages=messages, response_format={"type": "json_object"}, cache=None)
+        return client.extract_text_or_completion_object(response)[0]
+
+    return complete